@@ -0,0 +1,124 @@
+import os
+import shutil
+import threading
+
+from dirCatalog import in_dir
+
+SIZE_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(text):
+    """ Bytes from '500M', '2G', '1.5TB' or a plain number. """
+    text = text.strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    if text and text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+class AdmissionRefused(Exception):
+    """ A transfer the receiver can't take: it needed more than the named limit still allows. """
+    def __init__(self, limit, needed, available):
+        super().__init__(limit)
+        self.limit = limit
+        self.needed = needed
+        self.available = max(0, available)
+
+
+class Reservation:
+    """ Room set aside for one file being received. """
+    def __init__(self, sender, rel_path, size):
+        self.sender = sender
+        self.rel_path = rel_path
+        self.size = size
+        self.file = None    # the WriteBehindFile once the data phase starts
+
+    def outstanding(self):
+        """ Bytes this transfer has yet to take from the disk. """
+        if self.file is None:
+            return self.size
+        if self.file.preallocated:
+            return 0
+        return max(0, self.size - self.file.bytes_written)
+
+    def written(self):
+        return self.file.bytes_written if self.file else 0
+
+
+class AdmissionControl:
+    """ Decides whether the receiver can take a file before any of its data moves.
+
+        Free space is what the volume reports less what in-flight transfers have yet to write.
+        Optional limits cap the size of any one file, the bytes each sender may deliver during
+        this run, and the total size of chosen directories under the save directory.
+    """
+    def __init__(self, save_dir, catalog, max_file_size=None, sender_quota=None, dir_quotas=None, min_free=0):
+        self.save_dir = save_dir
+        self.catalog = catalog
+        self.max_file_size = max_file_size
+        self.sender_quota = sender_quota
+        self.dir_quotas = {os.path.normpath(d): quota for d, quota in (dir_quotas or {}).items()}
+        self.min_free = min_free
+        self.lock = threading.Lock()
+        self.reservations = set()
+        self.delivered = {}     # sender -> bytes written by its finished transfers
+        for rel_dir in self.dir_quotas:
+            catalog.track(rel_dir)
+
+    def free_space(self):
+        with self.lock:
+            return self._free_space()
+
+    def _free_space(self):
+        # Called with the lock held, connection threads add and remove reservations
+        reserved = sum(r.outstanding() for r in self.reservations)
+        return shutil.disk_usage(self.save_dir).free - self.min_free - reserved
+
+    def _check(self, sender, needs):
+        """ Raise AdmissionRefused unless every (rel_path, size, bytes needed) fits at once. """
+        for rel_path, size, _ in needs:
+            if self.max_file_size is not None and size > self.max_file_size:
+                raise AdmissionRefused(f'the maximum file size ({rel_path})', size, self.max_file_size)
+        total = sum(needed for _, _, needed in needs)
+        free = self._free_space()
+        if total > free:
+            raise AdmissionRefused('the free space', total, free)
+        if self.sender_quota is not None:
+            used = self.delivered.get(sender, 0) + sum(r.size for r in self.reservations if r.sender == sender)
+            if used + total > self.sender_quota:
+                raise AdmissionRefused(f'the quota for {sender}', total, self.sender_quota - used)
+        for rel_dir, quota in self.dir_quotas.items():
+            needed = sum(n for rel_path, _, n in needs if in_dir(rel_path, rel_dir))
+            if not needed:
+                continue
+            used = self.catalog.usage(rel_dir) + sum(r.size for r in self.reservations if in_dir(r.rel_path, rel_dir))
+            if used + needed > quota:
+                raise AdmissionRefused(f'the quota for {rel_dir}', needed, quota - used)
+
+    def admit(self, sender, file_path, size, needed):
+        """ Reserve room for needed more bytes of a size byte file, raises AdmissionRefused if there is none. """
+        rel_path = os.path.relpath(file_path, self.save_dir)
+        with self.lock:
+            self._check(sender, [(rel_path, size, needed)])
+            reservation = Reservation(sender, rel_path, needed)
+            self.reservations.add(reservation)
+        return reservation
+
+    def release(self, reservation):
+        with self.lock:
+            if reservation in self.reservations:
+                self.reservations.remove(reservation)
+                self.delivered[reservation.sender] = self.delivered.get(reservation.sender, 0) + reservation.written()
+
+    def check_plan(self, sender, entries):
+        """ Check a whole batch of (rel_path, size) at once, raises AdmissionRefused if it can't all fit.
+
+            Files already here only need the bytes they are short of, as for a resume or an overwrite.
+        """
+        needs = []
+        for rel_path, size in entries:
+            entry = self.catalog.get(os.path.join(self.save_dir, rel_path))
+            needs.append((rel_path, size, max(0, size - (entry[0] if entry else 0))))
+        with self.lock:
+            self._check(sender, needs)
@@ -0,0 +1,263 @@
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import weakref
+import zlib
+
+TUNING_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'NetworkFileCopyNinja', 'tuning.json')
+TUNE_WINDOW = 2.0           # seconds of throughput behind each decision
+TUNE_MAX_STREAMS = 8        # most files sent at once
+TUNE_GAIN = 0.1             # a change must win this share of throughput to be kept
+TUNE_HOLD = 5               # windows to stay put after a probe that didn't pay off
+TUNE_MIN_BYTES = 64 << 20   # single files smaller than this are over before tuning could help
+MIN_BLOCK = 64 << 10
+MAX_BLOCK = 1 << 20
+BLOCKS_PER_SECOND = 1000    # block size grows until a stream makes no more sends than this
+MAX_SNDBUF = 16 << 20
+COMPRESS_SAMPLE = 256 << 10     # bytes read from each sampled file to judge compression
+COMPRESS_SAMPLE_FILES = 16
+TCP_INFO_RTT = 68           # offset of tcpi_rtt (microseconds) in Linux's struct tcp_info
+
+
+def tcp_rtt(sock):
+    """ The kernel's smoothed round trip time for a connection in seconds, None where it won't say. """
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+        rtt = struct.unpack_from('I', info, TCP_INFO_RTT)[0]
+    except (OSError, struct.error):
+        return None
+    return rtt / 1e6 if rtt else None
+
+
+def max_sndbuf():
+    """ Largest send buffer an unprivileged process may ask for, None if unknown. """
+    try:
+        with open('/proc/sys/net/core/wmem_max') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def load_tuning(cache_path=TUNING_CACHE):
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def compression_estimate(paths):
+    """ (compressed / original size, bytes compressed per second) of a sample of the files, at the level tar's gz uses. """
+    step = max(1, len(paths) // COMPRESS_SAMPLE_FILES)
+    original = compressed = 0
+    seconds = 0.0
+    for path in paths[::step][:COMPRESS_SAMPLE_FILES]:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read(COMPRESS_SAMPLE)
+        except OSError:
+            continue
+        start = time.perf_counter()
+        compressed += len(zlib.compress(data, 9))
+        seconds += time.perf_counter() - start
+        original += len(data)
+    if not original:
+        return 1.0, 0.0
+    return compressed / original, original / seconds if seconds else float('inf')
+
+
+class LinkTuner:
+    """ Tunes the sending side to the link to one receiver while a transfer runs.
+
+        Every TUNE_WINDOW seconds the throughput of the window decides on:
+         - streams: how many files are sent at once, hill climbing by doubling or halving
+           and keeping a change only if it pays off, then probing again now and then
+         - block_size: bigger reads and sends as a stream gets faster
+         - sndbuf: a bigger socket buffer when a stream is limited by its window (throughput
+           x RTT fills the buffer), as long as the kernel lets us grow it
+        Senders pick up changes whenever generation moves. What was settled on is kept per
+        host in cache_path and is where the next session starts.
+    """
+    def __init__(self, host, cache_path=TUNING_CACHE, max_streams=TUNE_MAX_STREAMS):
+        self.host = host
+        self.cache_path = cache_path
+        self.max_streams = max_streams
+        cached = load_tuning(cache_path).get(host, {})
+        self.from_cache = bool(cached)
+        self.streams = max(1, min(max_streams, cached.get('streams', 1)))
+        self.block_size = cached.get('block_size', MIN_BLOCK)
+        self.sndbuf = cached.get('sndbuf')      # None leaves the kernel to size buffers itself
+        self.throughput = cached.get('throughput')
+        self.rtt = cached.get('rtt')
+        self.generation = 0
+        self.tail = False           # no files left to start, stream counts can't be judged any more
+        self.sockets = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.best = None            # (throughput, streams) to beat
+        self.trial = None           # streams to go back to if the probe running now doesn't pay off
+        self.probe_up = True
+        self.hold = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def watch(self, sock, connect_seconds=None):
+        """ Follow a new connection: give it the socket buffer settled on and sample its RTT. """
+        self.apply(sock)
+        rtt = tcp_rtt(sock) or connect_seconds
+        with self.lock:
+            if rtt:
+                self.rtt = rtt if self.rtt is None else (self.rtt + rtt) / 2
+            self.sockets.add(sock)
+
+    def apply(self, sock):
+        if self.sndbuf:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+            except OSError:
+                pass
+
+    def start(self, sent_bytes):
+        """ Start judging windows, sent_bytes() returns the running total of bytes sent. """
+        self.thread = threading.Thread(target=self._monitor, args=(sent_bytes,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def _monitor(self, sent_bytes):
+        last_bytes, last_time = sent_bytes(), time.monotonic()
+        while not self.stopped.wait(TUNE_WINDOW):
+            now, sent = time.monotonic(), sent_bytes()
+            rate = (sent - last_bytes) / (now - last_time)
+            last_bytes, last_time = sent, now
+            with self.lock:
+                rtts = [r for r in (tcp_rtt(s) for s in list(self.sockets)) if r]
+                if rtts:
+                    self.rtt = min(rtts)
+            self.update(rate)
+
+    def update(self, rate):
+        """ Judge one window's throughput in bytes per second. """
+        if rate <= 0:
+            return
+        with self.lock:
+            self.throughput = rate if self.throughput is None else (self.throughput + rate) / 2
+            changed = self._tune_streams(rate)
+            changed = self._tune_block(rate) or changed
+            changed = self._tune_sndbuf(rate) or changed
+            if changed:
+                self.generation += 1
+
+    def _tune_streams(self, rate):
+        if self.tail:
+            return False
+        if self.best is None:
+            self.best = (rate, self.streams)
+            return False
+        best_rate = self.best[0]
+        if self.trial is not None:
+            # The probe has run for a window
+            previous, self.trial = self.trial, None
+            if rate > best_rate * (1 + TUNE_GAIN):
+                # Worth it, carry on the same way
+                self.best = (rate, self.streams)
+                self.probe_up = self.streams > previous
+                return False
+            self.probe_up = not self.probe_up
+            self.hold = TUNE_HOLD
+            if self.streams < previous and rate >= best_rate * (1 - TUNE_GAIN):
+                # As fast with fewer, keep the cheaper setting
+                self.best = (rate, self.streams)
+                return False
+            self.streams = previous
+            return True
+        if self.hold > 0:
+            self.hold -= 1
+            if rate < best_rate / 2:
+                # Conditions changed, what was best before says little now
+                self.best = (rate, self.streams)
+                self.hold = 0
+            return False
+        # Probe, against how the current setting does now
+        self.best = (rate, self.streams)
+        up = self.streams * 2 if self.streams < self.max_streams else None
+        down = self.streams // 2 if self.streams > 1 else None
+        new = up if (self.probe_up and up) or not down else down
+        if new is None:
+            self.hold = TUNE_HOLD
+            return False
+        self.trial, self.streams = self.streams, min(new, self.max_streams)
+        return True
+
+    def _tune_block(self, rate):
+        per_stream = rate / self.streams
+        block = MIN_BLOCK
+        while block < MAX_BLOCK and block * BLOCKS_PER_SECOND < per_stream:
+            block *= 2
+        if block == self.block_size:
+            return False
+        self.block_size = block
+        return True
+
+    def _tune_sndbuf(self, rate):
+        if not self.rtt:
+            return False
+        current = self.sndbuf or self._kernel_sndbuf()
+        if not current or rate / self.streams * self.rtt < 0.7 * current:
+            return False    # not limited by the window
+        target = min(MAX_SNDBUF, current * 2, max_sndbuf() or MAX_SNDBUF)
+        if target <= current:
+            return False
+        self.sndbuf = target
+        return True
+
+    def _kernel_sndbuf(self):
+        """ Data a watched connection's send buffer holds now, Linux reports twice that for bookkeeping. """
+        for sock in list(self.sockets):
+            try:
+                return sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) // 2
+            except OSError:
+                continue
+        return None
+
+    def choose_compression(self, paths):
+        """ 'gz' if compressing the files would get them across faster than sending them as they are, else 'tar'. """
+        if not self.throughput:
+            return 'tar', f'no throughput known for {self.host} yet'
+        ratio, speed = compression_estimate(paths)
+        # Compressed, the files go at the compressor's pace or the link's pace inflated by the ratio
+        effective = min(speed, self.throughput / ratio) if ratio else speed
+        reason = (f'compresses to {ratio:.0%} at {speed / 1e6:.0f} MB/s against a link of '
+                  f'{self.throughput / 1e6:.1f} MB/s')
+        return ('gz' if effective > self.throughput * (1 + TUNE_GAIN) else 'tar'), reason
+
+    def report(self):
+        with self.lock:
+            rate = f'{self.throughput / 1e6:.1f} MB/s' if self.throughput else 'no throughput measured'
+            rtt = f'RTT {self.rtt * 1000:.2f} ms' if self.rtt else 'RTT unknown'
+            sndbuf = f'{self.sndbuf >> 10} kB socket buffers' if self.sndbuf else 'kernel sized socket buffers'
+            return (f'{self.host}: {self.streams} stream(s), {self.block_size >> 10} kB blocks, {sndbuf}, '
+                    f'{rate}, {rtt}')
+
+    def save(self):
+        """ Remember the settings for the next session with this host. """
+        with self.lock:
+            settings = {'streams': self.streams, 'block_size': self.block_size, 'sndbuf': self.sndbuf,
+                        'throughput': self.throughput, 'rtt': self.rtt, 'updated': time.time()}
+        cache = load_tuning(self.cache_path)
+        cache[self.host] = settings
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), mode=0o700, exist_ok=True)
+            tmp_path = self.cache_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, indent=1)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f'Could not save tuning for {self.host}: {e}')
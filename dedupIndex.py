@@ -0,0 +1,75 @@
+import hashlib
+import os
+import threading
+
+DIGEST_SIZE = 32    # sha256
+
+
+def calculate_sha256(file_path):
+    """ Calculate the SHA-256 digest of a file. """
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.digest()
+
+
+class DedupIndex:
+    """ Finds files under a directory by content digest.
+
+        Files are grouped by size when the index is first used, and only candidates with a
+        matching size are ever hashed. Digests are cached against each file's size and mtime.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.by_size = None
+        self.digests = {}   # path -> (size, mtime, digest)
+        self.lock = threading.Lock()
+
+    def build(self):
+        by_size = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    by_size.setdefault(os.path.getsize(path), set()).add(path)
+                except OSError:
+                    continue
+        self.by_size = by_size
+
+    def digest_of(self, path):
+        st = os.stat(path)
+        cached = self.digests.get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return cached[2]
+        digest = calculate_sha256(path)
+        self.digests[path] = (st.st_size, st.st_mtime, digest)
+        return digest
+
+    def find(self, size, digest):
+        """ Return the path of a file holding exactly this content, or None. """
+        with self.lock:
+            if self.by_size is None:
+                self.build()
+            for path in list(self.by_size.get(size, ())):
+                try:
+                    if os.path.getsize(path) == size and self.digest_of(path) == digest:
+                        return path
+                except OSError:
+                    # Gone or unreadable since it was indexed
+                    self.by_size[size].discard(path)
+                    self.digests.pop(path, None)
+            return None
+
+    def add(self, path, digest=None):
+        """ Record a file that just landed, with its digest if the sender already told us. """
+        with self.lock:
+            if self.by_size is None:
+                return  # picked up when the index is built
+            try:
+                st = os.stat(path)
+            except OSError:
+                return
+            self.by_size.setdefault(st.st_size, set()).add(path)
+            if digest is not None:
+                self.digests[path] = (st.st_size, st.st_mtime, digest)
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+CATALOG_WORKERS = 8
+CATALOG_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'NetworkFileCopyNinja')
+VERSION_RE = re.compile(r'^(.*)\((\d+)\)$')     # 'name(3)' as made by keep-both
+
+
+def in_dir(rel_path, rel_dir):
+    """ True if rel_path is somewhere under rel_dir, '.' being the whole tree. """
+    return rel_dir == '.' or rel_path.startswith(rel_dir + os.sep)
+
+
+def version_key(rel_path):
+    """ Split 'dir/name(3).ext' into (('dir', 'name', '.ext'), 3), or a version of 0 for 'dir/name.ext'. """
+    directory, filename = os.path.split(rel_path)
+    base, ext = os.path.splitext(filename)
+    match = VERSION_RE.match(base)
+    if match:
+        return (directory, match.group(1), ext), int(match.group(2))
+    return (directory, base, ext), 0
+
+
+class DirCatalog:
+    """ In-memory index of everything under a receiver's save directory.
+
+        Each file maps to [size, mtime_ns, source_mtime], the last being the sender's mtime
+        for files that arrived through us. A snapshot is saved between runs so the catalog is
+        usable straight away at startup, while a fresh one is built in parallel behind it.
+        Until that build finishes an entry can be stale, so existing files are always stat'ed
+        before use and new ones are created exclusively.
+    """
+    def __init__(self, root, snapshot_path=None):
+        self.root = os.path.abspath(root)
+        if snapshot_path is None:
+            digest = hashlib.sha1(self.root.encode('utf-8')).hexdigest()[:16]
+            snapshot_path = os.path.join(CATALOG_DIR, f'catalog-{digest}.json')
+        self.snapshot_path = snapshot_path
+        self.lock = threading.Lock()
+        self.files = {}
+        self.versions = {}      # version key -> set of versions in use
+        self.next_version = {}  # version key -> first version worth trying
+        self.ready = False
+        self.changes = None     # updates made while a build is running, replayed over its result
+        self.tracked = {}       # relative directory -> total size of the files under it
+
+    def rel(self, file_path):
+        return os.path.relpath(file_path, self.root)
+
+    # Building
+
+    def start(self):
+        """ Load the last snapshot, then rebuild from disk on a background thread. """
+        self.load()
+        thread = threading.Thread(target=self.build, daemon=True)
+        thread.start()
+        return thread
+
+    def load(self):
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                files = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            self._replace(files)
+
+    def save(self):
+        with self.lock:
+            files = dict(self.files)
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+            tmp_path = self.snapshot_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(files, f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            print(f'Could not save catalog of {self.root}: {e}')
+
+    def _scan_dir(self, rel_dir):
+        files, subdirs = {}, []
+        try:
+            with os.scandir(os.path.join(self.root, rel_dir)) as entries:
+                for entry in entries:
+                    rel_path = os.path.join(rel_dir, entry.name)
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(rel_path)
+                        elif entry.is_file():
+                            st = entry.stat()
+                            files[rel_path] = [st.st_size, st.st_mtime_ns, None]
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return files, subdirs
+
+    def build(self, workers=CATALOG_WORKERS):
+        """ Scan the save directory, one directory per task across a pool of threads. """
+        with self.lock:
+            self.changes = []
+            previous = self.files
+        files = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = [pool.submit(self._scan_dir, '')]
+            while pending:
+                found, subdirs = pending.pop().result()
+                files.update(found)
+                pending += [pool.submit(self._scan_dir, d) for d in subdirs]
+        # Keep sender mtimes for files that haven't changed since the snapshot
+        for rel_path, entry in files.items():
+            old = previous.get(rel_path)
+            if old and old[:2] == entry[:2]:
+                entry[2] = old[2]
+        with self.lock:
+            for rel_path, entry in self.changes:
+                if entry is None:
+                    files.pop(rel_path, None)
+                else:
+                    files[rel_path] = entry
+            self.changes = None
+            self._replace(files)
+            self.ready = True
+        self.save()
+
+    def _replace(self, files):
+        self.files = files
+        self.versions = {}
+        self.next_version = {}
+        for rel_path in files:
+            key, version = version_key(rel_path)
+            self.versions.setdefault(key, set()).add(version)
+        for rel_dir in self.tracked:
+            self.tracked[rel_dir] = self._total(rel_dir)
+
+    def _total(self, rel_dir):
+        return sum(entry[0] for rel_path, entry in self.files.items() if in_dir(rel_path, rel_dir))
+
+    # Lookups and updates
+
+    def _set(self, rel_path, entry):
+        if self.changes is not None:
+            self.changes.append((rel_path, entry))
+        if self.tracked:
+            old = self.files.get(rel_path)
+            change = (entry[0] if entry else 0) - (old[0] if old else 0)
+            for rel_dir in self.tracked:
+                if in_dir(rel_path, rel_dir):
+                    self.tracked[rel_dir] += change
+        if entry is None:
+            self.files.pop(rel_path, None)
+            return
+        self.files[rel_path] = entry
+        key, version = version_key(rel_path)
+        self.versions.setdefault(key, set()).add(version)
+
+    def exists(self, file_path):
+        with self.lock:
+            return self.rel(file_path) in self.files
+
+    def get(self, file_path):
+        """ The [size, mtime_ns, source_mtime] entry for a file, or None. """
+        with self.lock:
+            return self.files.get(self.rel(file_path))
+
+    def refresh(self, file_path):
+        """ Re-read one file from disk, returns its size or None if it is gone. """
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            st = None
+        rel_path = self.rel(file_path)
+        with self.lock:
+            old = self.files.get(rel_path)
+            if st is None:
+                self._set(rel_path, None)
+                return None
+            source_mtime = old[2] if old and old[:2] == [st.st_size, st.st_mtime_ns] else None
+            self._set(rel_path, [st.st_size, st.st_mtime_ns, source_mtime])
+        return st.st_size
+
+    def add(self, file_path, source_mtime=None):
+        """ Record a file that just landed, with the sender's mtime if it came over the network. """
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return
+        with self.lock:
+            self._set(self.rel(file_path), [st.st_size, st.st_mtime_ns, source_mtime])
+
+    def next_free_version(self, file_path):
+        """ Reserve the first 'name(n).ext' variant of file_path not in use, returns (path, n). """
+        directory, filename = os.path.split(file_path)
+        base, ext = os.path.splitext(filename)
+        key = (os.path.dirname(self.rel(file_path)), base, ext)
+        with self.lock:
+            used = self.versions.setdefault(key, set())
+            version = self.next_version.get(key, 1)
+            while True:
+                while version in used:
+                    version += 1
+                new_file_path = os.path.join(directory, f'{base}({version}){ext}')
+                # A file we haven't caught up with yet may hold the name, skip it and carry on
+                if self.ready or not os.path.exists(new_file_path):
+                    break
+                used.add(version)
+            # Hold the name until the file lands, so concurrent transfers can't pick it too
+            self._set(self.rel(new_file_path), [0, 0, None])
+            self.next_version[key] = version + 1
+        return new_file_path, version
+
+    def track(self, rel_dir):
+        """ Keep a running total of the size of everything under rel_dir, for usage(). """
+        with self.lock:
+            self.tracked[rel_dir] = self._total(rel_dir)
+
+    def usage(self, rel_dir):
+        with self.lock:
+            return self.tracked[rel_dir]
+
+    def manifest(self, rel_paths):
+        """ (size, source_mtime) for each relative path, (-1, 0.0) for files we don't have. """
+        with self.lock:
+            entries = [self.files.get(rel_path) for rel_path in rel_paths]
+        return [(entry[0], entry[2] or 0.0) if entry else (-1, 0.0) for entry in entries]
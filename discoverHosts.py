@@ -1,11 +1,20 @@
+import random
+import select
 import socket
 import struct
 import threading
+import time
 
 from DiscoveryConsts import *
-from netInterfaces import GetNetInfo
 
-DEFAULT_TIMEOUT = 2
+DEFAULT_TIMEOUT = 2     # longest a discovery round may take
+QUIET_PERIOD = 0.4      # finish early once no new host has answered for this long
+PROBE_RETRIES = 3       # probes per round, in case one is dropped
+PROBE_INTERVAL = 0.15   # base delay between probes, jittered up to double
+HOST_TTL = 60           # seconds a host stays in the registry without answering
+REFRESH_INTERVAL = 20   # seconds between background discovery rounds
+ACTIVE_WEIGHT = 64 << 20    # when spreading, a transfer a receiver already runs counts as this many bytes to come
+BUSY_SECONDS = 10       # and the data it is taking in from others as this many seconds of its recent throughput
 
 
 def get_broadcast_address(ip, subnet_mask):
@@ -16,63 +25,228 @@ def get_broadcast_address(ip, subnet_mask):
     return broadcast_address
 
 
-def send_discovery_message(broadcast_address, port, message):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    sock.sendto(message.encode(), (broadcast_address, port))
-    sock.close()
-
+def get_broadcast_addresses():
+    """ Broadcast address of every IPv4 interface, falling back to the limited broadcast. """
+    try:
+        from netInterfaces import get_ipv4_interfaces
+        addresses = {get_broadcast_address(ip, mask) for _, ip, mask in get_ipv4_interfaces()}
+    except Exception as e:
+        print(f"Could not list network interfaces: {e}")
+        addresses = set()
+    return sorted(addresses) or ['255.255.255.255']
+
+
+def parse_response(data, addr):
+    # Newer hosts append ';key=value' fields after the port
+    hostname, host_port = data.decode().split(";", 1)[0].rsplit(":", 1)
+    return hostname, addr[0], host_port
+
+
+def parse_load(data):
+    """ The load a receiver advertises after its address, as a dict.
+
+        proto is the protocol version it speaks (1 if it doesn't say), active its transfers in
+        progress and rate the bytes per second it took in lately. free is the space it has room
+        for, None if it doesn't say, as older receivers don't.
+    """
+    fields = dict(f.split('=', 1) for f in data.decode().split(';')[1:] if '=' in f)
+
+    def number(key, default):
+        try:
+            return int(fields[key])
+        except (KeyError, ValueError):
+            return default
+    return {'proto': number('proto', 1), 'free': number('free', None), 'active': number('active', 0),
+            'rate': number('rate', 0)}
+
+
+def describe_load(load):
+    """ A short summary of a receiver's load for people. """
+    if not load:
+        return "load unknown"
+    free = f", {load['free'] / 1e9:.1f} GB free" if load['free'] is not None else ""
+    busy = f", {load['rate'] / 1e6:.1f} MB/s in" if load['rate'] else ""
+    return f"{load['active']} active{busy}{free}"
+
+
+def rank_receivers(receivers, needed=0):
+    """ (hostname, ip, port, load) receivers with room for needed bytes, least loaded first. """
+    roomy = [r for r in receivers if r[3]['free'] is None or r[3]['free'] >= needed]
+    return sorted(roomy, key=lambda r: (r[3]['active'], r[3]['rate'], -(r[3]['free'] or 0)))
+
+
+class LoadSpreader:
+    """ Hands each file of a batch to whichever receiver would then be the least loaded.
+
+        A receiver's load is what it was handed so far plus what it was already busy with
+        when discovered (see ACTIVE_WEIGHT and BUSY_SECONDS). Receivers whose advertised free
+        space the file no longer fits in are passed over. Giving it the largest files first
+        evens out the shares best.
+    """
+    def __init__(self, receivers):
+        self.receivers = list(receivers)
+        self.assigned = {(r[1], r[2]): 0 for r in self.receivers}
+        self.files = {(r[1], r[2]): 0 for r in self.receivers}
+        self.lock = threading.Lock()
+
+    def cost(self, receiver):
+        load = receiver[3]
+        return self.assigned[(receiver[1], receiver[2])] + load['active'] * ACTIVE_WEIGHT + load['rate'] * BUSY_SECONDS
+
+    def assign(self, size):
+        """ (ip, port) to send a size byte file to, None if it fits nowhere. """
+        with self.lock:
+            roomy = [r for r in self.receivers
+                     if r[3]['free'] is None or r[3]['free'] - self.assigned[(r[1], r[2])] >= size]
+            if not roomy:
+                return None
+            receiver = min(roomy, key=self.cost)
+            key = (receiver[1], receiver[2])
+            self.assigned[key] += size
+            self.files[key] += 1
+            return key
+
+
+def discover_hosts_iter(timeout=DEFAULT_TIMEOUT, quiet_period=QUIET_PERIOD, port=DiscoveryPort, with_load=False):
+    """ Yield (hostname, ip, port) for each host as soon as it answers, with its load appended if with_load.
+
+        Probes go out on every interface a few times with jitter. Replies come back to the
+        probing socket, and the round ends once the probes are done and nobody new has
+        answered for quiet_period, or after timeout at the latest.
+    """
+    probe = f"{DiscoveryCode}:{random.getrandbits(32):08x}".encode()
+    broadcasts = get_broadcast_addresses()
 
-def listen_for_responses(port, timeout=DEFAULT_TIMEOUT, lst=None):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('', port+1))
-    sock.settimeout(timeout)
-
-    if lst is None:
-        print("Listening for responses...")
-
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.bind(('', 0))
+
+    seen = set()
+    start = time.monotonic()
+    deadline = start + timeout
+    last_activity = start
+    next_probe = start
+    probes_sent = 0
     try:
         while True:
-            data, addr = sock.recvfrom(1024)
-            if lst is None:
-                print(f"Received response from {addr}: {data.decode()}")
-            else:
-                hostname, hostPort = data.decode().split(":")
-                lst.append((hostname, addr[0], hostPort))
-    except socket.timeout:
-        if lst is None:
-            print("Listening timed out.")
-
-
-def discover_hosts(ip, subnet_mask, port, message):
-    broadcast_address = get_broadcast_address(ip, subnet_mask)
-    print(f"Broadcast address: {broadcast_address}")
-
-    listener_thread = threading.Thread(target=listen_for_responses, args=(port,))
-    listener_thread.start()
-
-    send_discovery_message(broadcast_address, port, message)
-
-
-def discover_and_list_hosts():
-    port = DiscoveryPort
-    message = DiscoveryCode
-    ip, subnet_mask = GetNetInfo()
-    broadcast_address = get_broadcast_address(ip, subnet_mask)
-
+            now = time.monotonic()
+            if probes_sent < PROBE_RETRIES and now >= next_probe:
+                for broadcast_address in broadcasts:
+                    try:
+                        sock.sendto(probe, (broadcast_address, port))
+                    except OSError:
+                        continue    # interface went away or does not allow broadcast
+                probes_sent += 1
+                last_activity = now
+                next_probe = now + PROBE_INTERVAL * (1 + random.random())
+
+            if now >= deadline or (probes_sent >= PROBE_RETRIES and now >= last_activity + quiet_period):
+                return
+
+            wake = deadline if probes_sent >= PROBE_RETRIES else min(deadline, next_probe)
+            if probes_sent >= PROBE_RETRIES:
+                wake = min(wake, last_activity + quiet_period)
+            readable, _, _ = select.select([sock], [], [], max(0, wake - now))
+            if not readable:
+                continue
+            try:
+                data, addr = sock.recvfrom(1024)
+                host = parse_response(data, addr)
+                load = parse_load(data)
+            except (OSError, ValueError, UnicodeDecodeError):
+                continue
+            if (host[1], host[2]) in seen:
+                continue    # answer to a retried probe
+            seen.add((host[1], host[2]))
+            last_activity = time.monotonic()
+            yield host + (load,) if with_load else host
+    finally:
+        sock.close()
+
+
+def discover_and_list_hosts(timeout=DEFAULT_TIMEOUT, on_host=None, with_load=False):
     list_of_hosts = []
+    for host in discover_hosts_iter(timeout, with_load=with_load):
+        list_of_hosts.append(host)
+        if on_host:
+            on_host(host)
+    return list_of_hosts
 
-    listener_thread = threading.Thread(target=listen_for_responses, args=(port, DEFAULT_TIMEOUT, list_of_hosts))
-    listener_thread.start()
-
-    send_discovery_message(broadcast_address, port, message)
 
-    listener_thread.join()
-    return list_of_hosts
+class HostRegistry:
+    """ Hosts found by discovery, kept fresh by a background thread so lookups never wait.
+
+        Hosts that stop answering drop out after ttl seconds. The load each advertised in its
+        last answer is kept too, see get_receivers.
+    """
+    def __init__(self, ttl=HOST_TTL, refresh_interval=REFRESH_INTERVAL):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.hosts = {}     # (ip, port) -> (hostname, ip, port, last_seen, load)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.refreshing = False
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def refresh_now(self):
+        """ Ask the background thread for a new discovery round without waiting for it. """
+        self.wakeup.set()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.refresh()
+            self.wakeup.wait(self.refresh_interval)
+            self.wakeup.clear()
+
+    def refresh(self):
+        self.refreshing = True
+        try:
+            for host in discover_hosts_iter(with_load=True):
+                self.update(host)
+        except Exception as e:
+            print(f"Host discovery failed: {e}")
+        finally:
+            self.refreshing = False
+
+    def update(self, host):
+        hostname, ip, port = host[:3]
+        load = host[3] if len(host) > 3 else None
+        with self.lock:
+            self.hosts[(ip, port)] = (hostname, ip, port, time.monotonic(), load)
+
+    def _current(self):
+        cutoff = time.monotonic() - self.ttl
+        with self.lock:
+            for key in [k for k, v in self.hosts.items() if v[3] < cutoff]:
+                del self.hosts[key]
+            return sorted(self.hosts.values())
+
+    def get_hosts(self):
+        """ Current (hostname, ip, port) list, without waiting on the network. """
+        return [v[:3] for v in self._current()]
+
+    def get_receivers(self):
+        """ Current (hostname, ip, port, load) list, with the load each host advertised last, see parse_load. """
+        return [v[:3] + (v[4] or parse_load(b''),) for v in self._current()]
+
+
+HOST_REGISTRY = HostRegistry()
 
 
 if __name__ == "__main__":
-    # Replace with your network details
-    my_ip, my_subnet_mask = GetNetInfo()
-
-    discover_hosts(my_ip, my_subnet_mask, DiscoveryPort, DiscoveryCode)
+    print(f"Broadcasting on: {', '.join(get_broadcast_addresses())}")
+    count = 0
+    for found in discover_hosts_iter(with_load=True):
+        count += 1
+        print(f"Received response from {found[1]}: {found[0]}:{found[2]} ({describe_load(found[3])})")
+    print(f"Discovery finished, {count} hosts found.")
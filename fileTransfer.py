@@ -1,46 +1,115 @@
 import socket
 import argparse
 import os
-import struct
+import sys
 import threading
 import datetime
 import time
 import zlib
+import struct
 import select
+import queue
+import tarfile
+import errno
+import random
+import contextlib
+import collections
 
 from DiscoveryConsts import *
+from transferIO import WriteBehindFile, ReadAheadFile, FSYNC_BATCH, FSYNC_MODES, WRITE_QUEUE_DEPTH, READ_AHEAD_DEPTH, \
+    is_sparse, map_data_extents, clone_file, CLONE_MODES, LocalCopy, file_identity, readable_by
+from dedupIndex import DedupIndex, calculate_sha256
+from wireProtocol import *
+from transferJournal import TransferJournal
+from dirCatalog import DirCatalog
+from admissionControl import AdmissionControl, AdmissionRefused, parse_size
+from tlsTransport import TlsClient, ensure_certificate, make_server_context, certificate_fingerprint, accept_tls, \
+    tls_pending, idle_but_open
+from transferSession import SESSION, SessionData, bound_session, session_thread
+from autoTune import LinkTuner, TUNE_MIN_BYTES
+from discoverHosts import parse_load, rank_receivers, describe_load, discover_and_list_hosts, LoadSpreader
 
-BUFFER_SIZE = 4096
-SENT_DATA = {
+BUFFER_SIZE = 64 * 1024
+FANOUT_QUEUE_DEPTH = 32     # chunks a slow receiver may fall behind before it holds back the others
+JOURNAL_CHECKPOINT = 64 << 20   # journal the progress of a large file every this many bytes
+ARCHIVE_MODES = ['tar', 'gz', 'xz']
+QUICK_CHECK_WINDOW = 1e-3   # seconds two mtimes may differ by and still match, mtimes pass through a double
+RETRY_ATTEMPTS = 3          # times a file is retried after a dropped connection before it is given up on
+RETRY_DELAY = 1.0           # seconds before the first retry, doubling with each one after
+RETRY_MAX_DELAY = 30.0
+CRC_CHECKPOINT = 4 << 20    # remember the CRC of what was sent every this many bytes, for resuming after a retry
+STALL_TIMEOUT = 60          # seconds the data phase may be unable to send anything before the connection counts as dropped
+LOAD_WINDOW = 10            # seconds of received data behind the throughput a receiver advertises
+TAKEOVER_TIMEOUT = 30       # seconds a receiver waits for an abandoned connection to let go of a file
+NETWORK_ERRNOS = {errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ENETDOWN, errno.ENETRESET, errno.EHOSTDOWN,
+                  errno.ETIMEDOUT}
+# Settings and counters of the sending and receiving sessions, see transferSession
+SENT_DATA = SessionData("sent", {
     "bytesSent": 0,
     "failed_files": 0,
     "processed_files": 0,
     "using_gui": False,
     "gui_response": None,
     "file_info": ("", 0, 0),
+    "conflict_policy": "prompt",
+    "read_ahead": READ_AHEAD_DEPTH,
+    "sparse": True,
+    "dedup": False,
+    "deduplicated_files": 0,
+    "protocol": "auto",
+    "journal": None,
+    "journal_skipped": 0,
+    "checksum": False,
+    "tls": None,
+    "cache_limit": None,
+    "direct_io": False,
+    "local_copy": True,
+    "local_copies": 0,
+    "retries": RETRY_ATTEMPTS,
+    "retry_delay": RETRY_DELAY,
+    "retried": 0,
+    "recovered_files": 0,
+    "auto_tune": False,
+    "tuner": None,
+    "on_file": None,
     "canceled": False
-    }
+    })
+PROMPT_LOCK = threading.Lock()
 
-RECV_DATA = {
+RECV_DATA = SessionData("recv", {
     "received_files": 0,
     "rejected_files": 0,
     "failed_files": 0,
+    "deduplicated_files": 0,
     "data_received": 0,
     "overwrite": False,
+    "conflict_policy": "prompt",
+    "fsync_mode": "none",
+    "write_queue_depth": WRITE_QUEUE_DEPTH,
+    "cache_limit": None,
+    "direct_io": False,
+    "local_copy": "off",
+    "dedup": None,
+    "relay": None,
+    "tls": None,
+    "admission": None,
+    "partial_crcs": None,
     "in_progress": False,
+    "active_transfers": 0,
+    "port": None,
+    "on_file": None,
     "canceled": False
-    }
-
-ALL_GOOD_MSG = "0xB00B1E5"
-REJECTED_MSG = "0xD6EC7ED"
-REQ_CRC32_MSG = "AC710271BE"
-RESUME_MSG = "0x7E50BE"
-SAME_COPY_MSG = "0x5ABEC097"
-DIFF_FILE_MSG = "0xD1FFF1113"
-REQ_OVERWRITE_MSG = "0x0B37717E"
-KEEP_BOTH_MSG = "0x4EE9B074"
-SKIP_FILE_MSG = "0x5419F111E"
+    })
+RECV_LOCK = threading.Lock()
+ACTIVE_FILES = {}   # file path -> channel receiving it, guarded by RECV_LOCK
 
+# Conflict policies, sent to the receiver as their index in this list
+CONFLICT_POLICIES = ['prompt', 'overwrite', 'keep-both', 'skip', 'newer', 'larger']
+# Prompt responses and the policy they become when applied to all remaining files
+CONFLICT_CHOICES = {'O': 'overwrite', 'B': 'keep-both', 'S': 'skip'}
+CONFLICT_RESPONSES = list(CONFLICT_CHOICES) + [f"{c}!" for c in CONFLICT_CHOICES]
+# Which senders a receiver copies files from itself when it can see them: same host only, any, or none
+LOCAL_COPY_MODES = ['auto', 'any', 'off']
 
 def calculate_crc32(file_path):
     """ Calculate the CRC32 checksum of a file. """
@@ -51,11 +120,14 @@ def calculate_crc32(file_path):
     return crc32
 
 
-def calculate_partial_crc32(file_path, length):
-    """ Calculate the CRC32 checksum of the first 'length' bytes of a file. """
-    crc32 = 0
+def calculate_partial_crc32(file_path, length, start=0, crc32=0):
+    """ Calculate the CRC32 checksum of the first 'length' bytes of a file.
+
+        Given the crc32 of the first start bytes, only the rest is read.
+    """
     with open(file_path, 'rb') as f:
-        remaining = length
+        f.seek(start)
+        remaining = length - start
         while remaining > 0:
             chunk = f.read(min(4096, remaining))
             if not chunk:  # Handle case if read returns empty
@@ -65,6 +137,48 @@ def calculate_partial_crc32(file_path, length):
     return crc32
 
 
+class CrcCheckpoints:
+    """ CRC32s of prefixes of a file, so a resume needn't re-read what we already hashed or sent.
+
+        Only good while the file is unchanged, they are forgotten if its size or mtime moves.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.stamp = self._stamp()
+        self.points = {0: 0}    # prefix length -> its CRC32
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.file_path)
+            return st.st_size, st.st_mtime_ns
+        except OSError:
+            return None
+
+    def add(self, length, crc32):
+        self.points[length] = crc32
+
+    def crc_at(self, length):
+        """ CRC32 of the first length bytes, reading only past the nearest checkpoint below it. """
+        stamp = self._stamp()
+        if stamp != self.stamp:
+            self.stamp, self.points = stamp, {0: 0}
+        start = max(p for p in self.points if p <= length)
+        crc32 = calculate_partial_crc32(self.file_path, length, start, self.points[start])
+        self.points[length] = crc32
+        return crc32
+
+
+class RunningCrc:
+    """ CRC32 of the first length bytes of a file, kept up to date as data is appended to it. """
+    def __init__(self, length=0, crc32=0):
+        self.length = length
+        self.crc32 = crc32
+
+    def update(self, chunk):
+        self.crc32 = zlib.crc32(chunk, self.crc32)
+        self.length += len(chunk)
+
+
 def convert_path_to_os_style(filepath):
     if os.path.sep == '/':
         # Current system is Unix-like (Linux, macOS)
@@ -94,6 +208,62 @@ def append_to_filename(file_path, append_str):
     return os.path.join(directory, new_base + ext)
 
 
+def next_free_version(file_path):
+    """ Find the first 'name(n).ext' variant of file_path that is not in use. """
+    file_version = 1
+    new_file_path = append_to_filename(file_path, f"({file_version})")
+    while os.path.exists(new_file_path):
+        file_version += 1
+        new_file_path = append_to_filename(file_path, f"({file_version})")
+    return new_file_path, file_version
+
+
+def resolve_conflict(policy, sender_file_size, sender_mtime, local_file_size, local_mtime):
+    """ Turn a conflict policy into an 'O', 'B' or 'S' decision, or None if the user must be asked. """
+    if policy == 'overwrite':
+        return 'O'
+    if policy == 'keep-both':
+        return 'B'
+    if policy == 'skip':
+        return 'S'
+    if policy == 'newer':
+        # Without both times (v1 headers carry none) there is no telling which is newer, keep ours
+        return 'O' if sender_mtime is not None and local_mtime is not None and sender_mtime > local_mtime else 'S'
+    if policy == 'larger':
+        return 'O' if sender_file_size > local_file_size else 'S'
+    return None
+
+
+def receive_file_data(conn, file, extents=None, relay=None, crc=None):
+    """ Copy the data phase of a transfer into file, returns False if the receiver was canceled.
+
+        Without extents data is appended until the sender closes the connection. With extents
+        each (offset, length) range is read in turn and written at its offset, leaving holes between.
+        A relay gets every chunk forwarded as it is written, a RunningCrc every chunk hashed.
+    """
+    for offset, length in extents if extents is not None else [(None, None)]:
+        if offset is not None:
+            file.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = conn.recv(BUFFER_SIZE if remaining is None else min(BUFFER_SIZE, remaining))
+            if not chunk:
+                if remaining:
+                    raise ConnectionError("Connection closed mid-extent")
+                break
+            if RECV_DATA["canceled"]:
+                return False
+            file.write(chunk)
+            if relay:
+                relay.forward(chunk)
+            if crc:
+                crc.update(chunk)
+            RECV_DATA["data_received"] += len(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return True
+
+
 def report_data_size(size):
     units = ['bytes', 'kB', 'MB', 'GB', 'TB']
     unit_index = 0
@@ -105,315 +275,2175 @@ def report_data_size(size):
     return f"{size:.2f} {units[unit_index]}"
 
 
-def send_file(filename, root_dir, base_dir, host, port):
+def ask_conflict_response(rel_path, full_rel_path, dest_file_size, file_size, host_label=None):
+    """ Ask the user (console or GUI) how to settle a conflict, one file at a time. """
+    with PROMPT_LOCK:
+        # Another file may have been answered with "apply to all" while we waited our turn
+        for letter, policy in CONFLICT_CHOICES.items():
+            if SENT_DATA["conflict_policy"] == policy:
+                return letter
+
+        if not SENT_DATA["using_gui"]:
+            on_host = f"host {host_label}" if host_label else "host machine"
+            response = input(f"  {full_rel_path}({report_data_size(dest_file_size)}) already exists on {on_host}.\n"
+                             f"  {full_rel_path}({report_data_size(file_size)}) local copy.\n"
+                             " What would you like to do? "
+                             "'O' to Overwrite, 'B' to Keep Both, 'S' to Skip "
+                             "(add '!' to apply to all remaining files): ").strip().upper()
+            while response not in CONFLICT_RESPONSES:
+                response = input("Invalid input. Please enter 'O' to Overwrite, 'B' to Keep Both, or 'S' to Skip "
+                                 "(add '!' to apply to all remaining files): ").strip().upper()
+        else:
+            # Set some data for the prompt to use
+            SENT_DATA["file_info"] = (f"{host_label}: {rel_path}" if host_label else rel_path, dest_file_size, file_size)
+            # flag for response
+            SENT_DATA["gui_response"] = "NEEDED"
+            # wait for response
+            while SENT_DATA["gui_response"] not in CONFLICT_RESPONSES:
+                time.sleep(.3)
+            response = SENT_DATA["gui_response"]
+        return response
+
+
+def negotiate_send(ch, filename, rel_path, full_rel_path, file_size, sparse=False, digest=None, host_label=None,
+                   policy=None, mtime=None, crc_limit=None, keep_open=False, checkpoints=None, local=False):
+    """ Send the file header and settle with the receiver what, if anything, it still needs.
+
+        Returns (outcome, resume_at_byte) where outcome is 'send' (data phase follows),
+        'done' (the receiver already has the file) or 'failed'. Relays, whose local copy is
+        still arriving, pass crc_limit and get 'deferred' when asked about bytes past it.
+        checkpoints are the CrcCheckpoints already known for the file, from the journal or an
+        earlier attempt, that save re-reading that prefix. The CRC of the prefix being resumed
+        from is left in ch.prefix_crc.
+        With local the receiver may take the file straight from our disk, ch.local then says
+        it will and the data phase is just waiting for it to report back.
+    """
     resume_at_byte = False
+    if policy is None:
+        policy = SENT_DATA["conflict_policy"]
 
-    def failed_to_send():
-        SENT_DATA["failed_files"] += 1
-        SENT_DATA["processed_files"] += 1
+    def no_room():
+        print(f'[{datetime.datetime.now()}] Error sending {full_rel_path}({report_data_size(file_size)}): '
+              f'No room on host, it can take {report_data_size(ch.value)} more')
+        return 'failed', 0
+    if mtime is None:
+        mtime = os.path.getmtime(filename)
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+    # Send the relative path and size, with the modification time and conflict policy so the
+    # receiver can settle conflicts itself
+    flags = (FLAG_SPARSE if sparse else 0) | (FLAG_DIGEST if digest else 0) | (FLAG_KEEP_OPEN if keep_open else 0) | \
+            (0 if SENT_DATA["checksum"] else FLAG_QUICK_CHECK) | (FLAG_LOCAL if local and ch.version >= 2 else 0)
+    ch.send_header(full_rel_path, file_size, mtime, CONFLICT_POLICIES.index(policy), flags, digest)
+    ch.local = False
+    if flags & FLAG_LOCAL and ch.peek_opcode() == OP_LOCAL:
+        # The receiver may share our filesystem, tell it where the file is so it can check
+        ch.recv_local_request()
+        ch.send_local_source(os.path.abspath(filename), file_identity(os.stat(filename)))
+        ch.local = ch.recv_local_reply()
+
+    # Wait for receiver message
+        #allgood    #crcReq     #prompt     #skip
+    msg = ch.recv_msg()
+
+    if msg == REQ_CRC32_MSG:
+        # The receiver's file length comes with the message
+        dest_file_size = ch.value
+        if crc_limit is not None and dest_file_size > crc_limit:
+            return 'deferred', 0
+        # Calc crc32 at that length and send back
+        if checkpoints:
+            crc32 = checkpoints.crc_at(dest_file_size)
+        else:
+            crc32 = calculate_partial_crc32(filename, dest_file_size)
+        ch.prefix_crc = crc32
+        ch.send_crc(crc32)
+
+        # A matching prefix can be resumed, otherwise the receiver answers as it would have straight away
+        msg = ch.recv_msg()
+        if msg == RESUME_MSG:
+            resume_at_byte = dest_file_size
+            msg = ALL_GOOD_MSG
+
+    # handle message from receiver
+    if msg == ALL_GOOD_MSG:
+        pass
+    elif msg == REJECTED_MSG:
+        print(f'[{datetime.datetime.now()}] Error sending {filename}({report_data_size(file_size)}): File Rejected')
+        return 'failed', 0
+    elif msg == SKIP_FILE_MSG:
+        print(f'[{datetime.datetime.now()}] {full_rel_path}({report_data_size(file_size)}) skipped by conflict policy')
+        return 'failed', 0
+    elif msg == NO_ROOM_MSG:
+        return no_room()
+    elif msg == SAME_COPY_MSG:
+        # The host has this exact file, by size and modification time or by checksum
+        print(f'[{datetime.datetime.now()}] {full_rel_path}({report_data_size(file_size)}) already exists on host machine')
+        return 'done', 0
+    elif msg == DEDUP_MSG:
+        # Host already holds this content elsewhere and made its own copy
+        print(f'[{datetime.datetime.now()}] {full_rel_path}({report_data_size(file_size)}) deduplicated on host machine')
+        SENT_DATA["deduplicated_files"] += 1
+        return 'done', 0
+    elif msg == DIFF_FILE_MSG:
+        # The receiver's file length comes with the message
+        dest_file_size = ch.value
+        # v1 receivers never heard our policy, settle it here if it doesn't need the user
+        response = resolve_conflict(policy, file_size, mtime, dest_file_size, None)
+        if response:
+            print(f'[{datetime.datetime.now()}] {full_rel_path} conflict settled by \'{policy}\' policy')
+        else:
+            # Transfer requires user intervention
+            response = ask_conflict_response(rel_path, full_rel_path, dest_file_size, file_size, host_label)
+        if response.endswith('!'):
+            # Announce this choice with every remaining file so the receiver settles it without asking
+            response = response[0]
+            SENT_DATA["conflict_policy"] = CONFLICT_CHOICES[response]
+        # Send messages
+        if response == 'O':
+            # Send Request Overwrite Message
+            ch.send_msg(REQ_OVERWRITE_MSG)
+        if response == 'B':
+            # Send Keep Both Message
+            ch.send_msg(KEEP_BOTH_MSG)
+        if response == 'S':
+            # Send Skip Message
+            ch.send_msg(SKIP_FILE_MSG)
+            return 'failed', 0
+
+        # Wait for receiver message
+        msg = ch.recv_msg()
+        if msg == ALL_GOOD_MSG:
+            pass
+        elif msg == REJECTED_MSG:
+            print(f'[{datetime.datetime.now()}]  Error sending {full_rel_path}({report_data_size(file_size)}) : Rejected by host.')
+            return 'failed', 0
+        elif msg == NO_ROOM_MSG:
+            return no_room()
+        else:
+            print(f'[{datetime.datetime.now()}]  Error sending {full_rel_path}({report_data_size(file_size)}) : Host error.')
+            return 'failed', 0
+    else:
+        print(f'[{datetime.datetime.now()}]  Error sending {full_rel_path}({report_data_size(file_size)}) : Host error.')
+        return 'failed', 0
+    return 'send', resume_at_byte
+
+
+PEER_VERSIONS = {}      # host -> protocol version it advertised
+
+
+def query_load(host, timeout=0.5, port=DiscoveryPort):
+    """ Ask a host's discovery listener for the load it advertises (see parse_load), None if it doesn't answer. """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    try:
+        sock.sendto(f"{DiscoveryCode}:{os.getpid():08x}".encode(), (host, port))
+        data, _ = sock.recvfrom(1024)
+        return parse_load(data)
+    except (OSError, ValueError):
+        return None
+    finally:
+        sock.close()
+
+
+def query_protocol_version(host, timeout=0.5, port=DiscoveryPort):
+    """ Ask a host's discovery listener which protocol it speaks, 1 if it doesn't say. """
+    load = query_load(host, timeout, port)
+    return load['proto'] if load else 1
+
+
+def peer_protocol(host):
+    setting = SENT_DATA["protocol"]
+    if setting != 'auto':
+        return int(setting)
+    if host not in PEER_VERSIONS:
+        PEER_VERSIONS[host] = min(query_protocol_version(host), PROTOCOL_VERSION)
+    return PEER_VERSIONS[host]
+
+
+def open_channel(host, port, source_addr=None):
+    """ Connect to a receiver and agree on a protocol version with it.
+
+        v2 is only tried with hosts that advertise it (or when forced with --protocol), and a
+        failed greeting in auto mode marks the host as v1 and connects again.
+    """
+    version = peer_protocol(host)
+    while True:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
+            if source_addr:
+                device = STRIPE_DEVICES.get(source_addr)
+                if device:
+                    # Leave through the address's own NIC, whatever the routing table says
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, device.encode())
+                # Leave through a specific local address (striped sends)
+                s.bind((source_addr, 0))
+            started = time.monotonic()
             s.connect((host, port))
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if SENT_DATA["tuner"]:
+                SENT_DATA["tuner"].watch(s, time.monotonic() - started)
+            if SENT_DATA["tls"]:
+                s = SENT_DATA["tls"].wrap(s, host, port)
+            return client_handshake(s, version)
+        except ProtocolError:
+            s.close()
+            if version == 1 or SENT_DATA["protocol"] != 'auto':
+                raise
+            PEER_VERSIONS[host] = version = 1
+        except Exception:
+            s.close()
+            raise
+
+
+def reset_connection(sock):
+    """ Make closing sock send a reset, so a receiver reading to the end of the stream sees a failure, not a short file. """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    except OSError:
+        pass
+
+
+def report_file(callback, *details):
+    """ Hand a finished file to a session's on_file callback, which mustn't break the transfer. """
+    if callback:
+        try:
+            callback(*details)
         except Exception as e:
-            print(f'[{datetime.datetime.now()}] Error sending {filename}: Could not establish connection : {e}')
-            failed_to_send()
-            return 0
-        file_data_sent = 0
-        # Construct the relative path to maintain directory structure
-        rel_path = os.path.relpath(filename, root_dir)
-        full_rel_path = os.path.join(base_dir, rel_path)
+            print(f'[{datetime.datetime.now()}] on_file callback failed for {details[0]}: {e}')
+
+
+def file_finished(filename, ok):
+    """ Count a file the sender is done with, and report it to the session. """
+    SENT_DATA["processed_files"] += 1
+    if not ok:
+        SENT_DATA["failed_files"] += 1
+    results = getattr(SESSION, "results", None)
+    if results is not None:
+        results.append((filename, bool(ok)))
+    report_file(SENT_DATA["on_file"], filename, bool(ok))
+
+
+def skip_journaled(filename, host, port):
+    """ True if the journal says host already has this exact file, so it needn't be negotiated again. """
+    journal = SENT_DATA["journal"]
+    if journal and journal.is_done(f"{host}:{port}", filename):
+        SENT_DATA["journal_skipped"] += 1
+        file_finished(filename, True)
+        return True
+    return False
+
+
+class TransferInterrupted(Exception):
+    """ The connection dropped part way through a file that may still be retried. """
+
+
+def dropped_connection(e):
+    """ True for errors that mean the network let us down, rather than the file or the receiver. """
+    return isinstance(e, (ConnectionError, TimeoutError)) or (isinstance(e, OSError) and e.errno in NETWORK_ERRNOS)
+
+
+def retry_delay(attempt):
+    """ Exponential backoff with jitter, so senders cut off together don't all come back at once. """
+    delay = min(RETRY_MAX_DELAY, SENT_DATA["retry_delay"] * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
 
-        # Send the relative path length and relative path first
-        rel_path_bytes = full_rel_path.encode('utf-8')
+
+def with_retries(filename, attempt, *args):
+    """ Run attempt(*args, checkpoints=, retryable=) for a file, reconnecting after dropped connections.
+
+        Each attempt resumes from what the receiver confirms it has, the CRC checkpoints of what
+        earlier attempts sent spare re-reading that prefix. Returns what the last attempt did.
+    """
+    checkpoints = CrcCheckpoints(filename)
+    retries = SENT_DATA["retries"]
+    for n in range(retries + 1):
         try:
-            s.send(struct.pack('I', len(rel_path_bytes)))
-            s.send(rel_path_bytes)
-            # Send file size
-            file_size = os.path.getsize(filename)
-            if not file_size:
-                file_size = 0  # prevent errors
-            s.send(struct.pack('Q', file_size))
-
-            # Wait for receiver message
-                #allgood    #crcReq     #prompt
-            msg_length = struct.unpack('I', s.recv(4))[0]
-            msg = s.recv(msg_length).decode('utf-8')
-
-            # handle message from receiver
-            if msg == ALL_GOOD_MSG:
-                pass
-            elif msg == REJECTED_MSG:
-                print(f'[{datetime.datetime.now()}] Error sending {filename}({report_data_size(file_size)}): File Rejected')
-                failed_to_send()
-                return 0
-            elif msg == REQ_CRC32_MSG:
-                # Receive file length
-                dest_file_size = struct.unpack('Q', s.recv(8))[0]
-                # Calc crc32 at that length and send back
-                crc32 = calculate_partial_crc32(filename, dest_file_size)
-                s.send(struct.pack('I', crc32))
-
-                # Wait for receiver message
-                msg_length = struct.unpack('I', s.recv(4))[0]
-                msg = s.recv(msg_length).decode('utf-8')
-                if msg == SAME_COPY_MSG:
-                    # File already exists on host machine
-                    print(f'[{datetime.datetime.now()}] {full_rel_path}({report_data_size(file_size)}) already exists on host machine')
-                    SENT_DATA["processed_files"] += 1
-                    return 1
-                if msg == RESUME_MSG:
-                    resume_at_byte = dest_file_size
-            elif msg == DIFF_FILE_MSG:
-                # Receive file length
-                dest_file_size = struct.unpack('Q', s.recv(8))[0]
-                # Transfer requires user intervention
-                response = None
-                if not SENT_DATA["using_gui"]:
-                    response = input(f"  {full_rel_path}({report_data_size(dest_file_size)}) already exists on host machine.\n"
-                                     f"  {full_rel_path}({report_data_size(file_size)}) local copy.\n"
-                                     " What would you like to do? "
-                                     "'O' to Overwrite, 'B' to Keep Both, 'S' to Skip: ").strip().upper()
-                    while response not in ['O', 'B', 'S']:
-                        response = input("Invalid input. Please enter 'O' to Overwrite, 'B' to Keep Both, or 'S' to Skip: ").strip().upper()
-                else:
-                    # Set some data for the prompt to use
-                    SENT_DATA["file_info"] = (rel_path, dest_file_size, file_size)
-                    # flag for response
-                    SENT_DATA["gui_response"] = "NEEDED"
-                    # wait for response
-                    while SENT_DATA["gui_response"] not in ['O', 'B', 'S']:
-                        time.sleep(.3)
-                    response = SENT_DATA["gui_response"]
-                # Send messages
-                if response == 'O':
-                    # Send Request Overwrite Message
-                    s.send(struct.pack('I', len(REQ_OVERWRITE_MSG)))
-                    s.send(REQ_OVERWRITE_MSG.encode())
-                if response == 'B':
-                    # Send Keep Both Message
-                    s.send(struct.pack('I', len(KEEP_BOTH_MSG)))
-                    s.send(KEEP_BOTH_MSG.encode())
-                if response == 'S':
-                    # Send Skip Message
-                    s.send(struct.pack('I', len(SKIP_FILE_MSG)))
-                    s.send(SKIP_FILE_MSG.encode())
-                    failed_to_send()
+            result = attempt(*args, checkpoints=checkpoints, retryable=n < retries)
+        except TransferInterrupted as e:
+            delay = retry_delay(n)
+            SENT_DATA["retried"] += 1
+            print(f'[{datetime.datetime.now()}] Transfer of {filename} interrupted: {e}. '
+                  f'Retrying in {delay:.1f}s ({n + 1} of {retries})')
+            deadline = time.monotonic() + delay
+            while time.monotonic() < deadline:
+                if SENT_DATA["canceled"]:
+                    print(f'[{datetime.datetime.now()}] User canceled transfer')
+                    file_finished(filename, False)
                     return 0
+                time.sleep(min(.1, delay))
+            continue
+        if n and result:
+            SENT_DATA["recovered_files"] += 1
+        return result
 
-                # Wait for receiver message
-                msg_length = struct.unpack('I', s.recv(4))[0]
-                msg = s.recv(msg_length).decode('utf-8')
-                if msg == ALL_GOOD_MSG:
-                    pass
-                elif msg == REJECTED_MSG:
-                    print(f'[{datetime.datetime.now()}]  Error sending {full_rel_path}({report_data_size(file_size)}) : Rejected by host.')
-                    failed_to_send()
-                    return 0
-                else:
-                    print(f'[{datetime.datetime.now()}]  Error sending {full_rel_path}({report_data_size(file_size)}) : Host error.')
-                    failed_to_send()
-                    return 0
+
+@contextlib.contextmanager
+def auto_tuning(host):
+    """ Tune the sends inside the block to the link to host, then report and remember the settings. """
+    tuner = LinkTuner(host)
+    start = 'settings from earlier runs' if tuner.from_cache else 'defaults'
+    print(f'[{datetime.datetime.now()}] Auto-tuning the link to {host}, starting from {start}')
+    session = SENT_DATA.current()
+    session["tuner"] = tuner
+    tuner.start(lambda: session["bytesSent"])
+    try:
+        yield tuner
+    finally:
+        session["tuner"] = None
+        tuner.stop()
+        tuner.save()
+        print(f'[{datetime.datetime.now()}] Auto-tuned {tuner.report()}')
+
+
+def tuning_wanted():
+    """ True if auto-tuning is on and no send further up is tuning already. """
+    return SENT_DATA["auto_tune"] and SENT_DATA["tuner"] is None
+
+
+def send_file(filename, root_dir, base_dir, host, port, source_addr=None, policy=None):
+    if skip_journaled(filename, host, port):
+        return 1
+    if tuning_wanted() and os.path.isfile(filename) and os.path.getsize(filename) >= TUNE_MIN_BYTES:
+        with auto_tuning(host):
+            return send_file(filename, root_dir, base_dir, host, port, source_addr, policy)
+    return with_retries(filename, send_file_attempt, filename, root_dir, base_dir, host, port, source_addr, policy)
+
+
+def send_file_attempt(filename, root_dir, base_dir, host, port, source_addr=None, policy=None, checkpoints=None,
+                      retryable=False):
+    """ One go at sending a file over a connection of its own, see with_retries. """
+    try:
+        ch = open_channel(host, port, source_addr)
+    except Exception as e:
+        print(f'[{datetime.datetime.now()}] Error sending {filename}: Could not establish connection : {e}')
+        if retryable and dropped_connection(e):
+            raise TransferInterrupted(e)
+        file_finished(filename, False)
+        return 0
+    with ch.sock:
+        return send_on_channel(ch, filename, root_dir, base_dir, host, port, policy, checkpoints=checkpoints,
+                               retryable=retryable)
+
+
+def send_on_channel(ch, filename, root_dir, base_dir, host, port, policy=None, keep_open=False, checkpoints=None,
+                    retryable=False):
+    """ Send one file over an open channel, returns 1 on success.
+
+        With keep_open the data phase is exactly the announced length so another file can
+        follow on the same connection. ch.idle tells the caller whether it is safe to.
+        With retryable a dropped connection raises TransferInterrupted rather than failing
+        the file, and checkpoints collects the CRCs of what was sent for the next attempt.
+    """
+    journal = SENT_DATA["journal"]
+    dest = f"{host}:{port}"
+    crc = None
+
+    def failed_to_send(sent=0, error=None):
+        if journal:
+            if sent:
+                journal.record(dest, filename, 'partial', (resume_at_byte or 0) + sent, crc)
+            else:
+                journal.record(dest, filename, 'failed')
+        if retryable and error is not None and dropped_connection(error):
+            if sent and crc is not None:
+                checkpoints.add((resume_at_byte or 0) + sent, crc)
+            raise TransferInterrupted(error)
+        file_finished(filename, False)
+
+    ch.idle = False
+    ch.prefix_crc = None
+    ch.local = False
+    s = ch.sock
+    resume_at_byte = 0
+    file_data_sent = 0
+    # Construct the relative path to maintain directory structure
+    rel_path = os.path.relpath(filename, root_dir)
+    full_rel_path = os.path.join(base_dir, rel_path)
+
+    file_size = 0
+    try:
+        file_size = os.path.getsize(filename)
+        # Mostly-hole files only send their data extents, v1 headers can't say so or carry a digest
+        sparse = SENT_DATA["sparse"] and ch.version >= 2 and is_sparse(filename)
+        digest = calculate_sha256(filename) if SENT_DATA["dedup"] and ch.version >= 2 else None
+        if checkpoints is None:
+            checkpoints = CrcCheckpoints(filename)
+        known = journal.lookup(dest, filename) if journal else None
+        if known and known[0] == 'partial' and known[2] is not None:
+            checkpoints.add(*known[1:])
+        outcome, resume_at_byte = negotiate_send(ch, filename, rel_path, full_rel_path, file_size, sparse, digest,
+                                                 policy=policy, keep_open=keep_open, checkpoints=checkpoints,
+                                                 local=SENT_DATA["local_copy"])
+    except Exception as e:
+        print(f'[{datetime.datetime.now()}] Error sending {filename}({report_data_size(file_size)}): {e}')
+        failed_to_send(error=e)
+        return 0
+    if outcome in ('failed', 'deferred'):
+        ch.idle = outcome == 'failed'
+        failed_to_send()
+        return 0
+    if outcome == 'done':
+        ch.idle = True
+        file_finished(filename, True)
+        if journal:
+            journal.record(dest, filename, 'done')
+        return 1
+
+    if ch.local:
+        return await_local_copy(ch, filename, full_rel_path, file_size, resume_at_byte or 0, host, port,
+                                failed_to_send)
+
+    if (journal or retryable) and not sparse:
+        # Keep a running CRC of what the receiver has so a later resume needn't re-read it
+        crc = ch.prefix_crc if resume_at_byte else 0
+
+    extents = None
+    if sparse:
+        try:
+            extents = map_data_extents(filename, resume_at_byte or 0)
+            ch.send_extent_map(extents)
         except Exception as e:
             print(f'[{datetime.datetime.now()}] Error sending {filename}({report_data_size(file_size)}): {e}')
             failed_to_send()
             return 0
 
-        # Send the file content
-        with open(filename, 'rb') as file:
-            if resume_at_byte:
-                file.seek(resume_at_byte)
-                print(f'[{datetime.datetime.now()}] Resuming {full_rel_path}({report_data_size(file_size)}) transfer to {host}:{port}')
-            else:
-                print(f'[{datetime.datetime.now()}] Sending {full_rel_path}({report_data_size(file_size)}) to {host}:{port}')
-            while chunk := file.read(BUFFER_SIZE):
+    tuner = SENT_DATA["tuner"]
+    tuned = tuner.generation if tuner else None
+    # Send the file content, a reader thread keeps the next buffers filled while the socket drains
+    with ReadAheadFile(filename, resume_at_byte or 0, tuner.block_size if tuner else BUFFER_SIZE,
+                       SENT_DATA["read_ahead"], extents, SENT_DATA["cache_limit"], SENT_DATA["direct_io"]) as file:
+        if extents is not None:
+            data_size = sum(length for _, length in extents)
+            print(f'[{datetime.datetime.now()}] Sparse file {full_rel_path}: {report_data_size(data_size)} of data in {len(extents)} extents')
+        else:
+            data_size = file_size - (resume_at_byte or 0)
+        if resume_at_byte:
+            print(f'[{datetime.datetime.now()}] Resuming {full_rel_path}({report_data_size(file_size)}) transfer to {host}:{port}')
+        else:
+            print(f'[{datetime.datetime.now()}] Sending {full_rel_path}({report_data_size(file_size)}) to {host}:{port}')
+        # A connection that takes no data for this long has dropped, however long TCP would keep trying
+        timeout = s.gettimeout()
+        s.settimeout(STALL_TIMEOUT)
+        try:
+            for chunk in file:
                 if SENT_DATA["canceled"]:
                     print(f'[{datetime.datetime.now()}] User canceled transfer')
-                    failed_to_send()
+                    failed_to_send(file_data_sent)
                     return 0
+                if tuner and tuner.generation != tuned:
+                    tuned = tuner.generation
+                    file.resize(tuner.block_size)
+                    tuner.apply(s)
+                if keep_open:
+                    # The receiver reads exactly what was announced, ignore anything appended since
+                    chunk = chunk[:data_size - file_data_sent]
+                    if not chunk:
+                        break
 
-                try:
-                    s.sendall(chunk)
-                    SENT_DATA["bytesSent"] += len(chunk)
-                    file_data_sent += len(chunk)
-                except Exception as e:
-                    print(f'Error sending {filename}({report_data_size(file_size)}): {e}')
-                    failed_to_send()
-                    return 0
+                s.sendall(chunk)
+                SENT_DATA["bytesSent"] += len(chunk)
+                if crc is not None:
+                    crc = zlib.crc32(chunk, crc)
+                    sent = file_data_sent + len(chunk)
+                    if journal and sent // JOURNAL_CHECKPOINT > file_data_sent // JOURNAL_CHECKPOINT:
+                        journal.record(dest, filename, 'partial', resume_at_byte + sent, crc)
+                    if sent // CRC_CHECKPOINT > file_data_sent // CRC_CHECKPOINT:
+                        checkpoints.add(resume_at_byte + sent, crc)
+                file_data_sent += len(chunk)
+            if keep_open and file_data_sent < data_size:
+                raise IOError("File shrank while it was being sent")
+        except Exception as e:
+            print(f'Error sending {filename}({report_data_size(file_size)}): {e}')
+            failed_to_send(file_data_sent, e)
+            return 0
+        finally:
+            s.settimeout(timeout)
 
-        print(f'[{datetime.datetime.now()}] {full_rel_path} sent successfully [{report_data_size(file_data_sent)}]')
-        SENT_DATA["processed_files"] += 1
-        return 1
+    print(f'[{datetime.datetime.now()}] {full_rel_path} sent successfully [{report_data_size(file_data_sent)}]')
+    ch.idle = True
+    file_finished(filename, True)
+    if journal:
+        journal.record(dest, filename, 'done')
+    return 1
+
+
+def await_local_copy(ch, filename, full_rel_path, file_size, resume_at_byte, host, port, failed_to_send):
+    """ Wait while a receiver that can see our file copies it itself, returns 1 if it did. """
+    print(f'[{datetime.datetime.now()}] {host}:{port} is copying {full_rel_path}({report_data_size(file_size)}) '
+          f'straight from this disk')
+    try:
+        msg = ch.recv_msg()
+    except Exception as e:
+        print(f'[{datetime.datetime.now()}] Error sending {filename}({report_data_size(file_size)}): {e}')
+        failed_to_send(error=e)
+        return 0
+    ch.idle = True
+    if msg != ALL_GOOD_MSG:
+        print(f'[{datetime.datetime.now()}] Error sending {full_rel_path}({report_data_size(file_size)}): Host could not copy it')
+        failed_to_send()
+        return 0
+    SENT_DATA["bytesSent"] += file_size - resume_at_byte
+    SENT_DATA["local_copies"] += 1
+    print(f'[{datetime.datetime.now()}] {full_rel_path} copied by host [{report_data_size(file_size - resume_at_byte)}]')
+    file_finished(filename, True)
+    if SENT_DATA["journal"]:
+        SENT_DATA["journal"].record(f"{host}:{port}", filename, 'done')
+    return 1
+
+
+class SyncConnection:
+    """ Keeps one connection to a receiver open across many files, reconnecting when it breaks.
+
+        Receivers that only speak v1 get a connection per file as before.
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.ch = None
+
+    def idle_connection_alive(self):
+        """ An idle connection has nothing to read unless the receiver hung up, or sent TLS session tickets. """
+        readable, _, _ = select.select([self.ch.sock], [], [], 0)
+        return not readable or idle_but_open(self.ch.sock)
+
+    def send(self, filename, root_dir, base_dir):
+        if skip_journaled(filename, self.host, self.port):
+            return 1
+        if peer_protocol(self.host) < 2:
+            return send_file(filename, root_dir, base_dir, self.host, self.port)
+        return with_retries(filename, self.send_attempt, filename, root_dir, base_dir)
+
+    def send_attempt(self, filename, root_dir, base_dir, checkpoints=None, retryable=False):
+        """ One go at sending a file, reconnecting first if the connection was lost, see with_retries. """
+        if self.ch is not None and not self.idle_connection_alive():
+            self.close()
+        if self.ch is None:
+            try:
+                self.ch = open_channel(self.host, self.port)
+            except Exception as e:
+                print(f'[{datetime.datetime.now()}] Error sending {filename}: Could not establish connection : {e}')
+                if retryable and dropped_connection(e):
+                    raise TransferInterrupted(e)
+                file_finished(filename, False)
+                return 0
+        if self.ch.version < 2:
+            # v1 carries one file per connection
+            self.close()
+            return send_file_attempt(filename, root_dir, base_dir, self.host, self.port, checkpoints=checkpoints,
+                                     retryable=retryable)
+        try:
+            return send_on_channel(self.ch, filename, root_dir, base_dir, self.host, self.port, keep_open=True,
+                                   checkpoints=checkpoints, retryable=retryable)
+        finally:
+            if not self.ch.idle:
+                # Stopped mid-file, the receiver can't tell where the next one starts
+                self.close()
+
+    def manifest(self, rel_paths):
+        """ Ask the receiver about many files at once, see fetch_manifest. """
+        if peer_protocol(self.host) < 2:
+            return None
+        try:
+            if self.ch is None:
+                self.ch = open_channel(self.host, self.port)
+            if self.ch.version < 2:
+                return None
+            self.ch.send_manifest_request(rel_paths)
+            return dict(zip(rel_paths, self.ch.recv_manifest()))
+        except Exception as e:
+            print(f'[{datetime.datetime.now()}] Could not fetch a manifest from {self.host}:{self.port}: {e}')
+            self.close()
+            return None
+
+    def check_plan(self, entries):
+        """ Have the receiver check a batch of (rel_path, size) fits before any of it is sent, see check_plan. """
+        if peer_protocol(self.host) < 2:
+            return None
+        try:
+            if self.ch is None:
+                self.ch = open_channel(self.host, self.port)
+            if self.ch.version < 2:
+                return None
+            self.ch.send_plan(entries)
+            return self.ch.recv_plan_reply()[1] or None
+        except Exception as e:
+            print(f'[{datetime.datetime.now()}] Could not check the batch with {self.host}:{self.port}: {e}')
+            self.close()
+            return None
+
+    def close(self):
+        if self.ch:
+            self.ch.close()
+            self.ch = None
+
+
+def check_plan(host, port, entries):
+    """ Ask a receiver whether a whole batch of (rel_path, size) will fit, before sending any of it.
+
+        Returns the reason it won't, or None if it will or the receiver can't tell (v1).
+    """
+    connection = SyncConnection(host, port)
+    try:
+        return connection.check_plan(entries)
+    finally:
+        connection.close()
+
+
+def plan_refused(reason, host, port, paths):
+    """ Report a batch the receiver refused up front, counting all its files as failed. """
+    print(f'[{datetime.datetime.now()}] {host}:{port} refused the batch of {len(paths)} file(s): {reason}')
+    for path in paths:
+        file_finished(path, False)
+
+
+def fetch_manifest(host, port, rel_paths):
+    """ Ask a receiver which of these files it holds, in one round trip.
+
+        Returns {rel_path: (size, mtime)}, with a size of -1 for missing files and the mtime
+        the file was sent with (0 if unknown), or None if the receiver only speaks v1.
+    """
+    connection = SyncConnection(host, port)
+    try:
+        return connection.manifest(rel_paths)
+    finally:
+        connection.close()
 
 
 def send_directory(directory, host, port):
+    if tuning_wanted():
+        with auto_tuning(host):
+            return send_directory(directory, host, port)
     success = 1
     base_dir = os.path.basename(directory)
-    for root, _, files in os.walk(directory):
+    paths = [os.path.join(root, file) for root, _, files in os.walk(directory) for file in files]
+    journal = SENT_DATA["journal"]
+    # Files the journal shows as sent won't be, so they needn't fit
+    pending = [p for p in paths if not (journal and journal.is_done(f"{host}:{port}", p))]
+    refused = check_plan(host, port, plan_entries(pending, directory, base_dir)) if pending else None
+    if refused:
+        plan_refused(refused, host, port, paths)
+        return 0
+    if SENT_DATA["tuner"]:
+        return send_tuned(paths, directory, base_dir, host, port, SENT_DATA["tuner"])
+    for full_path in paths:
+        if not send_file(full_path, directory, base_dir, host, port):
+            success = 0
+    return success
+
+
+def send_tuned(paths, root_dir, base_dir, host, port, tuner):
+    """ Send files on as many connections at once as the tuner currently wants.
+
+        There is a worker for the most streams the tuner may ask for, those above its
+        current count wait their turn, so streams come and go between files.
+    """
+    pending = queue.Queue()
+    for full_path in paths:
+        pending.put(full_path)
+    results = []
+
+    def stream_worker(n):
+        while not SENT_DATA["canceled"]:
+            if n >= tuner.streams:
+                if pending.empty():
+                    return
+                time.sleep(.1)
+                continue
+            try:
+                full_path = pending.get_nowait()
+            except queue.Empty:
+                # What is left in flight says nothing about how many streams to use
+                tuner.tail = True
+                return
+            results.append(send_file(full_path, root_dir, base_dir, host, port))
+
+    workers = [session_thread(stream_worker, args=(n,)) for n in range(tuner.max_streams)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return int(all(results) and pending.empty())
+
+
+def plan_entries(paths, root_dir, base_dir):
+    """ (receiver path, size) of each file, as checked by check_plan. """
+    entries = []
+    for full_path in paths:
+        try:
+            entries.append((os.path.join(base_dir, os.path.relpath(full_path, root_dir)), os.path.getsize(full_path)))
+        except OSError:
+            continue    # reported when it comes to sending it
+    return entries
+
+
+class ArchiveWriter:
+    """ Write end of a tar stream that goes straight into the socket, in length-prefixed pieces.
+
+        The stream is ended with an empty piece rather than a half-close, which TLS can't do.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, data):
+        if SENT_DATA["canceled"]:
+            raise ConnectionAbortedError("User canceled transfer")
+        if data:
+            self.sock.sendall(ARCHIVE_CHUNK.pack(len(data)) + data)
+            SENT_DATA["bytesSent"] += len(data)
+        return len(data)
+
+    def finish(self):
+        self.sock.sendall(ARCHIVE_CHUNK.pack(0))
+
+
+def send_archive(directory, host, port, compression='tar'):
+    """ Send a whole directory as one streamed tar, optionally gzip or xz compressed.
+
+        There is no per-file negotiation and nothing is staged on disk at either end: the
+        receiver extracts members as they arrive and settles conflicts for each on its own.
+        compression='auto' gzips when a sample of the files compresses fast and well enough
+        to beat the throughput last seen to this host.
+    """
+    if tuning_wanted():
+        with auto_tuning(host):
+            return send_archive(directory, host, port, compression)
+    base_dir = os.path.basename(directory)
+    journal = SENT_DATA["journal"]
+    members = []    # (path, name in the archive), empty directories included
+    for root, dirs, files in os.walk(directory):
+        rel_root = os.path.relpath(root, directory)
+        arc_root = base_dir if rel_root == '.' else os.path.join(base_dir, rel_root)
+        if not dirs and not files:
+            members.append((root, arc_root))
         for file in files:
             full_path = os.path.join(root, file)
-            if not send_file(full_path, directory, base_dir, host, port):
-                success = 0
+            if not skip_journaled(full_path, host, port):
+                members.append((full_path, os.path.join(arc_root, file)))
+    file_paths = [path for path, _ in members if not os.path.isdir(path)]
+    refused = check_plan(host, port, plan_entries(file_paths, directory, base_dir)) if file_paths else None
+    if refused:
+        plan_refused(refused, host, port, file_paths)
+        return 0
+    if compression == 'auto':
+        compression, reason = (SENT_DATA["tuner"] or LinkTuner(host)).choose_compression(file_paths)
+        print(f'[{datetime.datetime.now()}] Sending {base_dir} {"compressed" if compression == "gz" else "uncompressed"}: {reason}')
+    sent = []       # (path, name in the archive)
+    skipped = set() # names the receiver left out
+    unreadable = set()
+
+    def stream_failed():
+        """ None of the files that were to go in the stream made it. """
+        for path in file_paths:
+            if path not in unreadable:
+                file_finished(path, False)
+
+    try:
+        ch = open_channel(host, port)
+    except Exception as e:
+        print(f'[{datetime.datetime.now()}] Error sending {base_dir}: Could not establish connection : {e}')
+        stream_failed()
+        return 0
+    with ch.sock:
+        if ch.version < 2:
+            print(f'[{datetime.datetime.now()}] Error sending {base_dir}: archive streams need a receiver speaking protocol v2')
+            stream_failed()
+            return 0
+        try:
+            ch.send_header(base_dir, 0, os.path.getmtime(directory), CONFLICT_POLICIES.index(SENT_DATA["conflict_policy"]),
+                           FLAG_ARCHIVE | (0 if SENT_DATA["checksum"] else FLAG_QUICK_CHECK))
+            if ch.recv_msg() != ALL_GOOD_MSG:
+                print(f'[{datetime.datetime.now()}] Error sending {base_dir}: Archive Rejected')
+                stream_failed()
+                return 0
+            print(f'[{datetime.datetime.now()}] Sending {base_dir} to {host}:{port} as a {compression} stream')
+            mode = 'w|' if compression == 'tar' else f'w|{compression}'
+            # Hardlinked files go in whole, the receiver can only extract members with their content
+            writer = ArchiveWriter(ch.sock)
+            with tarfile.open(fileobj=writer, mode=mode, bufsize=BUFFER_SIZE, dereference=True) as tar:
+                for path, arc_name in members:
+                    try:
+                        tar.add(path, arc_name, recursive=False)
+                    except (PermissionError, FileNotFoundError) as e:
+                        # Raised before the member's header is written, so the stream is still whole
+                        print(f'[{datetime.datetime.now()}] Error sending {path}: {e}')
+                        unreadable.add(path)
+                        file_finished(path, False)
+                        continue
+                    if not os.path.isdir(path):
+                        sent.append((path, arc_name))
+            # Mark the end of the stream and wait for the receiver to finish extracting it
+            writer.finish()
+            if ch.peek_opcode() == OP_ARCHIVE_SKIPPED:
+                skipped = set(ch.recv_archive_skipped())
+            if ch.recv_msg() != ALL_GOOD_MSG:
+                raise ProtocolError("Receiver did not confirm the archive")
+        except Exception as e:
+            print(f'[{datetime.datetime.now()}] Error sending {base_dir} archive: {e}')
+            stream_failed()
+            return 0
+    # Members only count as delivered once the receiver confirms the whole stream, and not if it left them out
+    delivered = 0
+    for full_path, arc_name in sent:
+        # tarfile stores names with forward slashes
+        ok = arc_name.replace(os.sep, '/') not in skipped
+        delivered += ok
+        file_finished(full_path, ok)
+        if journal:
+            journal.record(f"{host}:{port}", full_path, 'done' if ok else 'failed')
+    left_out = f', {len(sent) - delivered} left out by the receiver' if delivered < len(sent) else ''
+    print(f'[{datetime.datetime.now()}] {base_dir} sent successfully, {delivered} file(s){left_out} '
+          f'[{report_data_size(SENT_DATA["bytesSent"])} sent]')
+    return 1
+
+
+def sync_directory(directory, host, port, watch=False):
+    """ Mirror a directory to a receiver over one kept-open connection, optionally staying to watch it.
+
+        An index of the (size, mtime) of everything sent means only new and modified files go out
+        again. Changes are picked up with inotify where available or by rescanning otherwise, and
+        sent in batches once they settle. Files the receiver refuses are tried again after a
+        backoff, whether or not anything else changes. Deletions are not mirrored.
+    """
+    from syncWatch import scan_tree, rescan_paths, make_watcher, watch_batches
+
+    base_dir = os.path.basename(directory)
+    connection = SyncConnection(host, port)
+    index = {}
+    retry = set()
+    backoff = {"attempts": 0, "due": None}   # when files held back are next tried, with no change to prompt it
+
+    def sync(current, removed):
+        for rel_path in removed:
+            index.pop(rel_path, None)
+        # Every held-back path is rescanned with each batch, those gone since have nothing left to send
+        retry.intersection_update(current)
+        changed = sorted(p for p, stat in current.items() if index.get(p) != stat)
+        if not changed:
+            return
+        refused = connection.check_plan([(os.path.join(base_dir, p), current[p][0]) for p in changed])
+        if refused:
+            print(f'[{datetime.datetime.now()}] {host}:{port} refused {len(changed)} file(s), will retry: {refused}')
+            retry.update(changed)
+            return
+        print(f'[{datetime.datetime.now()}] Syncing {len(changed)} new or modified file(s) to {host}:{port}')
+        for rel_path in changed:
+            if SENT_DATA["canceled"]:
+                return
+            if connection.send(os.path.join(directory, rel_path), directory, base_dir):
+                index[rel_path] = current[rel_path]
+                retry.discard(rel_path)
+            else:
+                retry.add(rel_path)
+
+    def schedule_retry():
+        if retry:
+            backoff["due"] = time.monotonic() + retry_delay(backoff["attempts"])
+            backoff["attempts"] += 1
+        else:
+            backoff.update(attempts=0, due=None)
+
+    # Start watching before the first pass so nothing changed during it is missed
+    watcher = make_watcher(directory) if watch else None
+    try:
+        current = scan_tree(directory)
+        # Files the receiver got from us earlier, and that haven't changed since, needn't be negotiated
+        remote = connection.manifest([os.path.join(base_dir, p) for p in current]) or {}
+        for rel_path, stat in current.items():
+            size, mtime = remote.get(os.path.join(base_dir, rel_path), (-1, 0.0))
+            if size == stat[0] and abs(mtime - stat[1] / 1e9) < 1e-6:
+                index[rel_path] = stat
+        if index:
+            print(f'[{datetime.datetime.now()}] {len(index)} file(s) already up to date on {host}:{port}')
+        sync(current, [])
+        if not watch:
+            return not retry
+        print(f'[{datetime.datetime.now()}] Watching {directory} for changes ({type(watcher).__name__})')
+        schedule_retry()
+        for batch in watch_batches(watcher, lambda: SENT_DATA["canceled"], due=lambda: backoff["due"]):
+            if batch is None:
+                current = scan_tree(directory)
+                sync(current, [p for p in index if p not in current])
+            else:
+                sync(*rescan_paths(directory, batch | retry, index))
+            schedule_retry()
+        return not retry
+    finally:
+        if watcher:
+            watcher.close()
+        connection.close()
+
+
+def clip_extents(extents, offset):
+    """ The part of a list of (offset, length) extents at or after offset. """
+    clipped = []
+    for start, length in extents:
+        if start + length <= offset:
+            continue
+        begin = max(start, offset)
+        clipped.append((begin, start + length - begin))
+    return clipped
+
+
+def send_file_fanout(filename, root_dir, base_dir, destinations, dest_results=None):
+    """ Send one file to several (host, port) receivers, reading it from disk only once.
+
+        Each destination negotiates (conflicts, resume offset) on its own connection. The file
+        is then read once from the earliest offset any of them needs, and every chunk is shared
+        between per-destination sender threads through bounded queues. A slow receiver only
+        holds the others back once its queue is full, a failed one simply drops out.
+    """
+    rel_path = os.path.relpath(filename, root_dir)
+    full_rel_path = os.path.join(base_dir, rel_path)
+    file_size = 0
+    try:
+        file_size = os.path.getsize(filename)
+        sparse = SENT_DATA["sparse"] and is_sparse(filename)
+        digest = calculate_sha256(filename) if SENT_DATA["dedup"] else None
+    except Exception as e:
+        print(f'[{datetime.datetime.now()}] Error sending {filename}: {e}')
+        file_finished(filename, False)
+        return 0
+
+    results = {dest: False for dest in destinations}
+    negotiated = {}
+
+    def negotiate(dest):
+        host, port = dest
+        try:
+            ch = open_channel(host, port)
+        except Exception as e:
+            print(f'[{datetime.datetime.now()}] Error sending {filename} to {host}:{port}: Could not establish connection : {e}')
+            return
+        # v1 receivers get the holes as zeros, and no digest
+        dest_sparse = sparse and ch.version >= 2
+        try:
+            outcome, offset = negotiate_send(ch, filename, rel_path, full_rel_path, file_size, dest_sparse,
+                                             digest if ch.version >= 2 else None, f"{host}:{port}")
+        except Exception as e:
+            print(f'[{datetime.datetime.now()}] Error sending {filename}({report_data_size(file_size)}) to {host}:{port}: {e}')
+            outcome, offset = 'failed', 0
+        if outcome == 'send':
+            negotiated[dest] = (ch, offset or 0, dest_sparse)
+            return
+        ch.close()
+        results[dest] = outcome == 'done'
+
+    threads = [session_thread(negotiate, args=(dest,)) for dest in destinations]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if negotiated:
+        start = min(offset for _, offset, _ in negotiated.values())
+        extents = None
+        if all(dest_sparse for _, _, dest_sparse in negotiated.values()):
+            extents = map_data_extents(filename, start) if sparse else None
+
+        def pump(dest, ch, offset, dest_sparse, chunks):
+            host, port = dest
+            sent = 0
+            try:
+                if dest_sparse:
+                    # Read whole for a v1 receiver alongside, then the file is one extent
+                    ch.send_extent_map(clip_extents(extents or [(0, file_size)], offset))
+                while (item := chunks.get()) is not None:
+                    pos, data = item
+                    if pos + len(data) <= offset:
+                        continue    # this receiver already has this part
+                    view = memoryview(data)[max(0, offset - pos):]
+                    ch.sock.sendall(view)
+                    sent += len(view)
+                if read_failed.is_set() or SENT_DATA["canceled"]:
+                    # The stream stopped short, a clean close would hand the receiver a truncated file
+                    reset_connection(ch.sock)
+                    return
+                results[dest] = True
+                print(f'[{datetime.datetime.now()}] {full_rel_path} sent successfully to {host}:{port} [{report_data_size(sent)}]')
+            except Exception as e:
+                print(f'[{datetime.datetime.now()}] Error sending {filename}({report_data_size(file_size)}) to {host}:{port}: {e}')
+                # Keep draining so the reader never blocks on a dead receiver
+                while chunks.get() is not None:
+                    pass
+            finally:
+                ch.close()
+
+        read_failed = threading.Event()    # set before the pumps are told the file has ended
+        pumps = []
+        queues = []
+        for dest, (ch, offset, dest_sparse) in negotiated.items():
+            chunks = queue.Queue(maxsize=FANOUT_QUEUE_DEPTH)
+            queues.append(chunks)
+            pumps.append(session_thread(pump, args=(dest, ch, offset, dest_sparse, chunks)))
+        for thread in pumps:
+            thread.start()
+
+        print(f'[{datetime.datetime.now()}] Sending {full_rel_path}({report_data_size(file_size)}) to {len(negotiated)} hosts')
+        try:
+            with ReadAheadFile(filename, start, BUFFER_SIZE, SENT_DATA["read_ahead"], extents,
+                               SENT_DATA["cache_limit"], SENT_DATA["direct_io"]) as file:
+                for pos, chunk in file.iter_with_offsets():
+                    if SENT_DATA["canceled"]:
+                        print(f'[{datetime.datetime.now()}] User canceled transfer')
+                        break
+                    data = bytes(chunk)     # one copy, shared by every destination
+                    for chunks in queues:
+                        chunks.put((pos, data))
+                    SENT_DATA["bytesSent"] += len(data)
+        except Exception as e:
+            print(f'[{datetime.datetime.now()}] Error reading {filename}: {e}')
+            read_failed.set()
+            for dest in negotiated:
+                results[dest] = False
+        finally:
+            for chunks in queues:
+                chunks.put(None)
+            for thread in pumps:
+                thread.join()
+        if SENT_DATA["canceled"]:
+            for dest in negotiated:
+                results[dest] = False
+
+    if dest_results is not None:
+        for dest, ok in results.items():
+            dest_results.setdefault(dest, [0, 0])[0 if ok else 1] += 1
+    ok = all(results.values())
+    file_finished(filename, ok)
+    return int(ok)
+
+
+def send_fanout(jobs, destinations):
+    """ Send (file, root_dir, base_dir) jobs to every destination, reading each file once. """
+    success = 1
+    dest_results = {}
+    for filename, root_dir, base_dir in jobs:
+        if SENT_DATA["canceled"]:
+            return 0
+        if not send_file_fanout(filename, root_dir, base_dir, destinations, dest_results):
+            success = 0
+    for (host, port), (ok, failed) in dest_results.items():
+        print(f'[{datetime.datetime.now()}] {host}:{port}: {ok} files delivered, {failed} failed')
     return success
 
 
-def receive_files(save_dir, port, overwrite=False):
+def send_spread(jobs, receivers):
+    """ Spread (file, root_dir, base_dir) jobs over (hostname, ip, port, load) receivers, each file to one of them.
+
+        Files are shared out up front, largest first, by a LoadSpreader, then every receiver
+        gets its share over a connection of its own at the same time as the others.
+    """
+    spreader = LoadSpreader(receivers)
+    shares = {(ip, port): [] for _, ip, port, _ in receivers}
+    unplaced = []
+    unreadable = []
+    sized = []
+    for job in jobs:
+        try:
+            sized.append((os.path.getsize(job[0]), job))
+        except OSError as e:
+            # Gone or unreadable since the scan, the rest are still shared out
+            print(f'[{datetime.datetime.now()}] Error sending {job[0]}: {e}')
+            file_finished(job[0], False)
+            unreadable.append(job[0])
+    for size, job in sorted(sized, key=lambda sj: sj[0], reverse=True):
+        destination = spreader.assign(size)
+        if destination is None:
+            unplaced.append(job[0])
+        else:
+            shares[destination].append(job)
+    for hostname, ip, port, load in receivers:
+        print(f'[{datetime.datetime.now()}] {hostname} ({ip}:{port}, {describe_load(load)}): '
+              f'{spreader.files[(ip, port)]} files, {report_data_size(spreader.assigned[(ip, port)])}')
+    for filename in unplaced:
+        print(f'[{datetime.datetime.now()}] Error sending {filename}: No receiver has room for it')
+        file_finished(filename, False)
+
+    results = []
+
+    def receiver_worker(host, port):
+        for filename, root_dir, base_dir in shares[(host, port)]:
+            if SENT_DATA["canceled"]:
+                results.append(0)
+                return
+            results.append(send_file(filename, root_dir, base_dir, host, port))
+
+    workers = [session_thread(receiver_worker, args=destination) for destination, share in shares.items() if share]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return int(all(results) and not unplaced and not unreadable)
+
+
+def discover_receivers(port=None):
+    """ (hostname, ip, port, load) of every receiver answering discovery, only those on port if given. """
+    print(f'[{datetime.datetime.now()}] Looking for receivers...')
+    receivers = [r for r in discover_and_list_hosts(with_load=True) if port is None or int(r[2]) == port]
+    return [(hostname, ip, int(host_port), load) for hostname, ip, host_port, load in receivers]
+
+
+def parse_destination(text, default_port):
+    """ 'host' or 'host:port' to a (host, port) tuple. """
+    host, _, port = text.rpartition(':') if ':' in text else (text, '', '')
+    return host, int(port) if port else default_port
+
+
+def collect_directory_jobs(directory):
+    """ List (file, root_dir, base_dir) send jobs for every file under directory. """
+    base_dir = os.path.basename(directory)
+    jobs = []
+    for root, _, files in os.walk(directory):
+        for file in files:
+            jobs.append((os.path.join(root, file), directory, base_dir))
+    return jobs
+
+
+STRIPE_DEVICES = {}     # local address -> interface its striped connections are bound to
+
+
+def pin_stripe(source_addr, host):
+    """ Bind connections from source_addr to the interface holding it, where we are allowed to.
+
+        Returns (interface, pinned). Unpinned connections leave through whichever interface
+        the routing table picks for host from that address, which is what's returned then.
+    """
+    try:
+        from netInterfaces import interface_of, route_interface
+    except ImportError:
+        return None, False
+    device = interface_of(source_addr)
+    if device and hasattr(socket, 'SO_BINDTODEVICE'):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            try:
+                # Kernels before 5.7 only allow this with CAP_NET_RAW
+                probe.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, device.encode())
+                STRIPE_DEVICES[source_addr] = device
+                return device, True
+            except OSError:
+                pass
+    return route_interface(host, source_addr), False
+
+
+def get_local_source_addresses():
+    """ Every non-loopback IPv4 address on this machine, one per link we can stripe across. """
+    from netInterfaces import get_ipv4_interfaces
+    return [ip for _, ip, _ in get_ipv4_interfaces()]
+
+
+def send_striped(jobs, host, port, source_addrs=None):
+    """ Send (file, root_dir, base_dir) jobs over one connection per local address at a time.
+
+        Every link pulls the next file from a shared queue as soon as it is free, so faster
+        links take a proportionally larger share. Largest files go first to keep the tail short.
+    """
+    if not source_addrs:
+        source_addrs = get_local_source_addresses()
+    if len(source_addrs) < 2:
+        print(f'[{datetime.datetime.now()}] Only {len(source_addrs)} local address found, sending without striping')
+        source_addrs = source_addrs or [None]
+
+    # Binding to an address alone doesn't choose the NIC, the routing table still does
+    links = {addr: pin_stripe(addr, host) if addr else (None, False) for addr in source_addrs}
+    unpinned = [addr for addr, (_, pinned) in links.items() if addr and not pinned]
+    if unpinned:
+        print(f'[{datetime.datetime.now()}] Could not bind {", ".join(unpinned)} to their interfaces (SO_BINDTODEVICE '
+              f'needs Linux, CAP_NET_RAW before 5.7 and netifaces to find the interface), their traffic follows the routing table. Add source routing rules '
+              f'(ip rule add from <address> table <n>) so each address leaves through its own interface')
+    by_device = collections.defaultdict(list)
+    for addr, (device, _) in links.items():
+        if device:
+            by_device[device].append(addr)
+    for device, addrs in by_device.items():
+        if len(addrs) > 1:
+            print(f'[{datetime.datetime.now()}] Links {", ".join(addrs)} all leave through {device}, '
+                  f'striping across them adds no bandwidth')
+
+    results = []
+    sized = []
+    for job in jobs:
+        try:
+            sized.append((os.path.getsize(job[0]), job))
+        except OSError as e:
+            # Gone or unreadable since the scan, the links carry on with the rest
+            print(f'[{datetime.datetime.now()}] Error sending {job[0]}: {e}')
+            file_finished(job[0], False)
+            results.append(0)
+    pending = queue.Queue()
+    for item in sorted(sized, key=lambda sj: sj[0], reverse=True):
+        pending.put(item)
+
+    link_stats = {addr: {"bytes": 0, "seconds": 0.0, "files": 0, "failed": 0} for addr in source_addrs}
+
+    def link_worker(addr):
+        stats = link_stats[addr]
+        while not SENT_DATA["canceled"]:
+            try:
+                size, (filename, root_dir, base_dir) = pending.get_nowait()
+            except queue.Empty:
+                return
+            start = time.monotonic()
+            ok = send_file(filename, root_dir, base_dir, host, port, source_addr=addr)
+            stats["seconds"] += time.monotonic() - start
+            stats["bytes"] += size if ok else 0
+            stats["files"] += 1
+            stats["failed"] += 0 if ok else 1
+            results.append(ok)
+
+    workers = [session_thread(link_worker, args=(addr,)) for addr in source_addrs]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    for addr, stats in link_stats.items():
+        rate = stats["bytes"] / stats["seconds"] if stats["seconds"] else 0
+        device, pinned = links[addr]
+        via = f' via {device}{"" if pinned else " (routed)"}' if device else ' via an unknown interface'
+        print(f'[{datetime.datetime.now()}] Link {addr or "default"}{via}: {stats["files"]} files ({stats["failed"]} failed), '
+              f'{report_data_size(stats["bytes"])} at {report_data_size(rate)}/s')
+    return int(all(results) and pending.empty())
+
+
+class RelayStream:
+    """ Forwards a file's incoming byte stream to the next receiver in a chain as it is written. """
+    def __init__(self, sock, label, stream_offset, relay_offset):
+        self.sock = sock
+        self.label = label
+        self.position = stream_offset   # file offset of the next incoming byte
+        self.offset = relay_offset      # the next hop already has everything before this
+        self.sent = 0
+        self.failed = False
+
+    def backfill(self, file_path, upto):
+        """ Send what the next hop is missing from our local copy before the live stream starts. """
+        with ReadAheadFile(file_path, self.offset, BUFFER_SIZE, 0) as file:
+            for pos, chunk in file.iter_with_offsets():
+                if pos >= upto:
+                    break
+                chunk = chunk[:upto - pos]
+                self.sock.sendall(chunk)
+                self.sent += len(chunk)
+        self.offset = upto
+
+    def forward(self, chunk):
+        if not self.failed:
+            skip = self.offset - self.position
+            if skip < len(chunk):
+                try:
+                    data = memoryview(chunk)[max(0, skip):]
+                    self.sock.sendall(data)
+                    self.sent += len(data)
+                except Exception as e:
+                    print(f'[{datetime.datetime.now()}]  Relay to {self.label} failed: {e}')
+                    self.failed = True
+                    self.sock.close()
+        self.position += len(chunk)
+
+    def finish(self):
+        """ Close the hop, returns False if it needs catching up from our copy. """
+        self.sock.close()
+        return not self.failed
+
+
+def relay_policy(sender_policy):
+    """ Nobody sits at a relay to answer prompts, so always hand the next hop a policy. """
+    for policy in (sender_policy, RECV_DATA["conflict_policy"]):
+        if policy != 'prompt':
+            return policy
+    return 'skip'
+
+
+def open_relay(file_path, rel_path, file_size, mtime, digest, policy, stream_offset):
+    """ Negotiate a file with the next hop before our own data phase starts.
+
+        Returns (relay, catch_up): a RelayStream to forward the incoming stream to, or None,
+        and whether the next hop will have to be caught up from our copy afterwards.
+    """
+    host, port = RECV_DATA["relay"]
+    label = f"{host}:{port}"
+    try:
+        ch = open_channel(host, port)
+    except Exception as e:
+        print(f'\tCould not reach relay hop {label}: {e}')
+        return None, True
+    try:
+        outcome, offset = negotiate_send(ch, file_path, rel_path, rel_path, file_size, digest=digest, host_label=label,
+                                         policy=policy, mtime=mtime, crc_limit=stream_offset)
+        if outcome != 'send':
+            ch.close()
+            return None, outcome == 'deferred'
+        relay = RelayStream(ch.sock, label, stream_offset, offset or 0)
+        if relay.offset < stream_offset:
+            relay.backfill(file_path, stream_offset)
+        print(f'\tRelaying {rel_path} to {label}' + (f' from byte {relay.offset}' if relay.offset else ''))
+        return relay, False
+    except Exception as e:
+        print(f'\tRelay of {rel_path} to {label} failed: {e}')
+        ch.close()
+        return None, True
+
+
+RELAY_BACKLOG = queue.Queue()
+RELAY_LOCK = threading.Lock()   # connection threads may all find the worker missing at once
+relay_worker = None
+
+
+def relay_catch_up(file_path, save_dir, policy):
+    """ Resend a file from our complete copy to the next hop, resuming from whatever it has. """
+    global relay_worker
+    # The worker is shared, each file carries the session it belongs to
+    RELAY_BACKLOG.put((file_path, save_dir, policy, dict(vars(SESSION))))
+    with RELAY_LOCK:
+        if relay_worker is None:
+            relay_worker = threading.Thread(target=relay_catch_up_worker, daemon=True)
+            relay_worker.start()
+
+
+def relay_catch_up_worker():
+    while True:
+        file_path, save_dir, policy, sessions = RELAY_BACKLOG.get()
+        with bound_session(**sessions):
+            if not RECV_DATA["relay"]:
+                continue
+            host, port = RECV_DATA["relay"]
+            print(f'[{datetime.datetime.now()}]  Catching up relay hop {host}:{port} with {os.path.relpath(file_path, save_dir)}')
+            send_file(file_path, save_dir, '', host, port, policy=policy)
+
+
+def handle_connection(conn, addr, save_dir, dedup_index=None, catalog=None):
+    """ Receive files over an accepted connection, one unless the sender keeps it open for more. """
+    # Frames are written whole, don't hold our small replies back waiting for more
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if RECV_DATA["tls"]:
+        conn = accept_tls(RECV_DATA["tls"], conn)
+    with conn:
+        ch = server_handshake(conn)
+        try:
+            while True:
+                opcode = ch.peek_opcode() if ch.version >= 2 else None
+                if opcode == OP_MANIFEST:
+                    answer_manifest(ch, save_dir, catalog)
+                elif opcode == OP_PLAN:
+                    answer_plan(ch, addr, save_dir)
+                else:
+                    more = receive_one_file(ch, addr, save_dir, dedup_index, catalog)
+                    release_file(ch)
+                    if not more:
+                        break
+                if not wait_for_next_file(ch):
+                    break
+        finally:
+            release_file(ch)
+
+
+def claim_file(ch, addr, file_path):
+    """ Note that ch is receiving file_path, returns False if it can't be.
+
+        A sender whose connection dropped reconnects to resume, often before we notice the old
+        connection is dead. If it comes from the same address it takes over: the old connection
+        is shut down and waited for, so its partial file is settled before the new one looks at it.
+    """
+    while True:
+        with RECV_LOCK:
+            other = ACTIVE_FILES.get(file_path)
+            if other is None:
+                ACTIVE_FILES[file_path] = ch
+                ch.claimed, ch.released = file_path, threading.Event()
+                return True
+        if other.peer[0] != addr[0]:
+            # Another sender's file, leave them to it as ever
+            return True
+        print(f'\tTaking {file_path} over from an earlier connection from {addr[0]}')
+        other.superseded = True
+        try:
+            other.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if not other.released.wait(TAKEOVER_TIMEOUT):
+            return False
+
+
+def release_file(ch):
+    file_path = getattr(ch, 'claimed', None)
+    if file_path:
+        with RECV_LOCK:
+            if ACTIVE_FILES.get(file_path) is ch:
+                del ACTIVE_FILES[file_path]
+        ch.claimed = None
+        ch.released.set()
+
+
+def answer_manifest(ch, save_dir, catalog=None):
+    """ Tell the sender the size, and the mtime it was sent with, of many files in one go. """
+    rel_paths = [convert_path_to_os_style(p) for p in ch.recv_manifest_request()]
+    if catalog:
+        entries = catalog.manifest(rel_paths)
+    else:
+        entries = []
+        for rel_path in rel_paths:
+            try:
+                entries.append((os.path.getsize(os.path.join(save_dir, rel_path)), 0.0))
+            except OSError:
+                entries.append((-1, 0.0))
+    ch.send_manifest(entries)
+    print(f'[{datetime.datetime.now()}]  Answered a manifest of {len(rel_paths)} file(s)')
+
+
+def file_handled(rel_path, outcome):
+    """ Count a file the receiver is done with: received, deduplicated, rejected or failed, and report it. """
+    RECV_DATA[f"{outcome}_files"] += 1
+    if outcome == 'deduplicated':
+        RECV_DATA["received_files"] += 1
+    report_file(RECV_DATA["on_file"], rel_path, outcome)
+
+
+def describe_refusal(e):
+    return f'{report_data_size(e.needed)} needed, {e.limit} allows {report_data_size(e.available)}'
+
+
+def answer_plan(ch, addr, save_dir):
+    """ Tell the sender up front whether a whole batch of files will fit. """
+    entries = [(convert_path_to_os_style(p), size) for p, size in ch.recv_plan()]
+    admission = RECV_DATA["admission"]
+    try:
+        if admission:
+            admission.check_plan(addr[0], entries)
+    except AdmissionRefused as e:
+        print(f'[{datetime.datetime.now()}]  Refused a batch of {len(entries)} file(s) from {addr[0]}: {describe_refusal(e)}')
+        ch.send_plan_reply(e.available, describe_refusal(e))
+        return
+    ch.send_plan_reply(max(0, admission.free_space()) if admission else 0)
+
+
+def admit_transfer(addr, file_path, rel_path, size, needed):
+    """ Reserve room for a file's data before accepting it.
+
+        Returns (reservation, None), or (None, bytes that could still be taken) if it was refused.
+    """
+    admission = RECV_DATA["admission"]
+    if not admission:
+        return None, None
+    try:
+        return admission.admit(addr[0], file_path, size, needed), None
+    except AdmissionRefused as e:
+        print(f'[{datetime.datetime.now()}]  Refused {rel_path} ({report_data_size(size)}): {describe_refusal(e)}')
+        file_handled(rel_path, 'rejected')
+        return None, e.available
+
+
+def same_mtime(file_path, mtime, window=QUICK_CHECK_WINDOW):
+    try:
+        return abs(os.path.getmtime(file_path) - mtime) <= window
+    except OSError:
+        return False
+
+
+def keep_mtime(file_path, mtime):
+    """ Give a received file the sender's modification time, so the next run can quick-check it. """
+    if mtime is None:
+        return  # v1 senders don't say
+    try:
+        os.utime(file_path, (time.time(), mtime))
+    except OSError as e:
+        print(f'\tCould not set the modification time of {file_path}: {e}')
+
+
+def local_size(file_path, catalog=None):
+    """ Size of a file in the save directory, or None if it isn't there. """
+    if catalog:
+        # Files the catalog doesn't know are new, those it does know are re-checked in case they changed.
+        # Until its first scan is done it may just not have reached a file yet, so look on disk then.
+        return catalog.refresh(file_path) if catalog.exists(file_path) or not catalog.ready else None
+    return os.path.getsize(file_path) if os.path.exists(file_path) else None
+
+
+def proc_net_address(addr):
+    """ An IPv4 (host, port) the way /proc/net/tcp writes it. """
+    host = int.from_bytes(socket.inet_aton(addr[0]), sys.byteorder)
+    return f'{host:08X}:{addr[1]:04X}'
+
+
+def local_peer_uid(sock):
+    """ The user owning the other end of a TCP connection from this host, None if it can't be told (Linux only). """
+    # The sender's side of the connection is the entry running from its address to ours
+    wanted = proc_net_address(sock.getpeername()), proc_net_address(sock.getsockname())
+    try:
+        with open('/proc/net/tcp') as table:
+            for line in table:
+                fields = line.split()
+                if (fields[1], fields[2]) == wanted:
+                    return int(fields[7])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def local_copy_allowed(ch, addr):
+    """ Whether to offer copying this sender's files ourselves, returns (allowed, uid the sender runs as).
+
+        Off by default: a receiver copying a path it was given reads with its own rights, not the sender's.
+        auto takes senders on this host whose user we can tell (and checks each file is theirs to read),
+        any takes every sender on trust, for containers sharing a volume.
+    """
+    mode = RECV_DATA["local_copy"]
+    if mode == 'off' or ch.version < 2:
+        return False, None
+    if mode == 'any':
+        return True, None
+    # Same host: the sender connected over loopback or from the very address it reached us on
+    if not (addr[0].startswith('127.') or addr[0] == ch.sock.getsockname()[0]):
+        return False, None
+    uid = local_peer_uid(ch.sock)
+    return uid is not None, uid
+
+
+def accept_local_source(ch, rel_path, uid=None):
+    """ Ask the sender where its file is, returns (path, identity) if we see the very same file.
+
+        With a uid the file must also be one that user could read.
+    """
+    ch.send_local_request()
+    path, identity = ch.recv_local_source()
+    try:
+        accepted = os.path.isfile(path) and file_identity(os.stat(path)) == identity
+    except OSError:
+        accepted = False
+    if accepted and uid is not None and uid != os.geteuid() and not readable_by(path, uid):
+        print(f'\t{rel_path}: the sender may not read {path} itself, receiving it over the connection instead')
+        accepted = False
+    ch.send_local_reply(accepted)
+    if not accepted:
+        return None
+    print(f'\t{rel_path} is on a filesystem we share with the sender, copying it from {path}')
+    return path, identity
+
+
+def partial_file_crc(file_path, length):
+    """ CRC32 of the first length bytes of a file we hold part of, for the sender to resume against.
+
+        If its last transfer broke off with the file as it still is, the CRC kept then is used
+        instead of reading the whole file again.
+    """
+    checkpoints = (RECV_DATA["partial_crcs"] or {}).pop(file_path, None)
+    return checkpoints.crc_at(length) if checkpoints else calculate_crc32(file_path)
+
+
+def keep_partial_crc(file_path, crc):
+    """ Remember the RunningCrc of a transfer that broke off, while it matches what is on disk. """
+    if crc is None or RECV_DATA["partial_crcs"] is None:
+        return
+    checkpoints = CrcCheckpoints(file_path)
+    # The writer may have failed short of what arrived, then there is nothing to go on
+    if checkpoints.stamp and checkpoints.stamp[0] == crc.length:
+        checkpoints.add(crc.length, crc.crc32)
+        RECV_DATA["partial_crcs"][file_path] = checkpoints
+
+
+def wait_for_next_file(ch):
+    """ Wait on a kept-open connection until the sender starts another file (True) or hangs up. """
+    while not RECV_DATA["canceled"]:
+        # TLS may already hold decrypted bytes that select can't see
+        buffered = tls_pending(ch.sock)
+        readable, _, _ = select.select([ch.sock], [], [], 0 if buffered else 1)
+        if buffered or readable:
+            # TLS sockets can't peek, keep the first byte for the channel instead
+            data = ch.sock.recv(1)
+            ch.pending += data
+            return data != b''
+    return False
+
+
+def receive_one_file(ch, addr, save_dir, dedup_index=None, catalog=None):
+    """ Negotiate and receive a single file, returns True if the sender may follow with another. """
+    file_exists = False
+    different_files = True
+    resuming_transfer = False
+    reservation = None
+
+    def fail_transfer():
+        file_handled(rel_path, 'failed')
+
+    def admitted(needed):
+        """ Reserve room for the data phase, or tell the sender there is none. """
+        nonlocal reservation
+        reservation, available = admit_transfer(addr, file_path, rel_path, sender_file_size, needed)
+        if available is not None:
+            ch.send_msg(NO_ROOM_MSG, available)
+            return False
+        return True
+
+    def release():
+        if reservation:
+            RECV_DATA["admission"].release(reservation)
+
+    def reject_transfer():
+        file_handled(rel_path, 'rejected')
+
+    def copied_locally(n):
+        RECV_DATA["data_received"] += n
+        return not RECV_DATA["canceled"]
+
+    # Receive file name and size
+    rel_path, sender_file_size, sender_mtime, sender_policy, sender_flags, sender_digest = ch.recv_header()
+    sender_policy = CONFLICT_POLICIES[sender_policy]
+    if sender_flags & FLAG_ARCHIVE:
+        return receive_archive(ch, addr, save_dir, rel_path, sender_policy, sender_flags, dedup_index, catalog)
+    keep_open = bool(sender_flags & FLAG_KEEP_OPEN)
+    # Convert the received path to current machine's path style
+    file_path = os.path.join(save_dir, convert_path_to_os_style(rel_path))
+    # Announce transfer request
+    print(f'\n[{datetime.datetime.now()}]  Incoming file: {rel_path} ({report_data_size(sender_file_size)}) from {addr[0]}')
+    ch.peer, ch.superseded = addr, False
+    if not claim_file(ch, addr, file_path):
+        print(f'[{datetime.datetime.now()}]  {rel_path} is still held by an earlier connection, try again later')
+        ch.send_msg(REJECTED_MSG)
+        reject_transfer()
+        return keep_open
+    # Settled first, the rest of the negotiation is the same either way
+    local_source = None
+    if sender_flags & FLAG_LOCAL:
+        allowed, peer_uid = local_copy_allowed(ch, addr)
+        if allowed:
+            local_source = accept_local_source(ch, rel_path, peer_uid)
+
+    # Check if file already exists
+    local_file_size = local_size(file_path, catalog)
+    if local_file_size is not None:
+        file_exists = True
+        print(f'\tFile {rel_path} ({report_data_size(local_file_size)}) exists locally.')
+
+        if sender_flags & FLAG_QUICK_CHECK and sender_file_size == local_file_size and same_mtime(file_path, sender_mtime):
+            # Same size and modification time, take it as the same file without hashing either copy
+            ch.send_msg(SAME_COPY_MSG)
+            print(f'\t{rel_path} ({report_data_size(local_file_size)}) Size and modification time match, no transfer required.')
+            reject_transfer()
+            if RECV_DATA["relay"]:
+                relay_catch_up(file_path, save_dir, relay_policy(sender_policy))
+            return keep_open
+        if sender_file_size >= local_file_size:
+            # Send Request crc32 Message with the local file size
+            ch.send_msg(REQ_CRC32_MSG, local_file_size)
+            # Calc crc32 of local file
+            crc32 = partial_file_crc(file_path, local_file_size)
+            # Wait for crc32 from sender
+            sender_crc32 = ch.recv_crc()
+            # Compare crc32s
+            if sender_crc32 == crc32:
+                different_files = False
+                if sender_file_size == local_file_size:
+                    # We already have this exact file
+                    ch.send_msg(SAME_COPY_MSG)
+                    print(f'\t{rel_path} ({report_data_size(local_file_size)}) Checksum match, and file size match, no overwrite required.')
+                    # Only the mtime differed, bring it in line so the next run can quick-check the file
+                    keep_mtime(file_path, sender_mtime)
+                    if catalog:
+                        catalog.add(file_path, sender_mtime)
+                    reject_transfer()
+                    if RECV_DATA["relay"]:
+                        relay_catch_up(file_path, save_dir, relay_policy(sender_policy))
+                    return keep_open
+                else:
+                    if not admitted(sender_file_size - local_file_size):
+                        return keep_open
+                    resuming_transfer = True
+                    print(f'\t{rel_path} ({report_data_size(local_file_size)}) Checksum match, resuming transfer.')
+        if different_files is True:
+            # Local file is larger or failed checksum match
+            print(f'\t{rel_path} ({report_data_size(local_file_size)}) Checksum match failed.')
+            # The sender's announced policy wins, otherwise fall back to our own
+            policy = sender_policy if sender_policy != 'prompt' else RECV_DATA["conflict_policy"]
+            decision = resolve_conflict(policy, sender_file_size, sender_mtime,
+                                        local_file_size, os.path.getmtime(file_path))
+            if decision is None:
+                # Send different file same name message with our file_size and wait for reply
+                ch.send_msg(DIFF_FILE_MSG, local_file_size)
+
+                # Wait for sender response
+                    #skip   #overwrite  #keepboth
+                msg = ch.recv_msg()
+            else:
+                print(f'\t{rel_path} conflict settled by \'{policy}\' policy')
+                msg = {'O': REQ_OVERWRITE_MSG, 'B': KEEP_BOTH_MSG, 'S': SKIP_FILE_MSG}[decision]
+                if msg == SKIP_FILE_MSG:
+                    # Let the sender know it can move on
+                    ch.send_msg(SKIP_FILE_MSG)
+            if msg == SKIP_FILE_MSG:
+                skipped_by = 'sender' if decision is None else 'conflict policy'
+                print(f'[{datetime.datetime.now()}]  Transfer of file {rel_path} ({report_data_size(local_file_size)}) skipped by {skipped_by}')
+                fail_transfer()
+                return keep_open
+            elif msg == REQ_OVERWRITE_MSG:
+                if not RECV_DATA["overwrite"]:
+                    print(f'[{datetime.datetime.now()}]  File {rel_path} ({report_data_size(local_file_size)}) will not be overwritten.')
+                    ch.send_msg(REJECTED_MSG)
+                    reject_transfer()
+                    return keep_open
+                else:
+                    if not admitted(max(0, sender_file_size - local_file_size)):
+                        return keep_open
+                    # Overwriting is allowed, the go-ahead follows once the file is open
+            elif msg == KEEP_BOTH_MSG:
+                if not admitted(sender_file_size):
+                    return keep_open
+                # Append ( file_version ) to the file name, making sure it is not in use
+                if catalog:
+                    file_path, file_version = catalog.next_free_version(file_path)
+                else:
+                    file_path, file_version = next_free_version(file_path)
+                rel_path = append_to_filename(rel_path, f"({file_version})")
+                # file no longer exists at this path
+                file_exists = False
+
+    else:
+        # New file, see if we already hold the same content somewhere else
+        duplicate = None
+        if sender_digest and dedup_index:
+            duplicate = dedup_index.find(sender_file_size, sender_digest)
+        if duplicate:
+            try:
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                method = clone_file(duplicate, file_path, RECV_DATA["dedup"])
+            except Exception as e:
+                print(f'\tCould not deduplicate {rel_path} from {duplicate}: {e}')
+                duplicate = None
+        if duplicate:
+            ch.send_msg(DEDUP_MSG)
+            if method != 'hardlink':
+                # A hardlink shares its mtime with the file it was linked to
+                keep_mtime(file_path, sender_mtime)
+            dedup_index.add(file_path, sender_digest)
+            if catalog:
+                catalog.add(file_path, sender_mtime)
+            print(f'[{datetime.datetime.now()}]  Deduplicated {rel_path} from {os.path.relpath(duplicate, save_dir)} ({method})')
+            file_handled(rel_path, 'deduplicated')
+            if RECV_DATA["relay"]:
+                relay_catch_up(file_path, save_dir, relay_policy(sender_policy))
+            return keep_open
+        if not admitted(sender_file_size):
+            return keep_open
+
+    # Create file path if necessary
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    statement = "Appended" if resuming_transfer is True else ("Overwrote" if file_exists else "Received")
+
+    sparse = bool(sender_flags & FLAG_SPARSE)
+    # Opened before the sender hears it may go ahead, so new files are created exclusively while
+    # it can still be told no. Network receive and disk writes overlap through the write-behind
+    # queue, sparse files are not preallocated as that would fill in their holes.
+    try:
+        if local_source:
+            source_path, identity = local_source
+            file = LocalCopy(source_path, file_path, resuming_transfer, identity, RECV_DATA["fsync_mode"],
+                             exclusive=not file_exists, cache_limit=RECV_DATA["cache_limit"])
+        else:
+            file = WriteBehindFile(file_path, resuming_transfer, 0 if sparse else sender_file_size,
+                                   RECV_DATA["write_queue_depth"], RECV_DATA["fsync_mode"],
+                                   exclusive=not file_exists, cache_limit=RECV_DATA["cache_limit"],
+                                   direct=RECV_DATA["direct_io"] and not sparse)
+    except FileExistsError:
+        # Created since we looked (or behind the catalog's back), never clobber it
+        if catalog:
+            catalog.refresh(file_path)
+        print(f'[{datetime.datetime.now()}]  {rel_path} appeared on disk unexpectedly, not overwriting it')
+        ch.send_msg(REJECTED_MSG)
+        release()
+        reject_transfer()
+        return keep_open
+    except OSError as e:
+        # The sender is still waiting for our verdict, so it can just move on
+        source = f' from {local_source[0]}' if local_source else ''
+        print(f'[{datetime.datetime.now()}]  Could not {"copy" if local_source else "create"} {rel_path}{source}: {e}')
+        ch.send_msg(REJECTED_MSG)
+        release()
+        fail_transfer()
+        return keep_open
+    # OK the file transfer
+    ch.send_msg(RESUME_MSG if resuming_transfer else ALL_GOOD_MSG)
+    if reservation:
+        reservation.file = file
+    # Pass the stream straight on to the next hop in a relay chain. Sparse files and hops that
+    # need more than we hold yet are caught up from our copy once it is complete.
+    start = local_file_size if resuming_transfer else 0
+    relay, catch_up = None, False
+    if RECV_DATA["relay"]:
+        forward_policy = relay_policy(sender_policy)
+        if sparse or local_source:
+            catch_up = True
+        else:
+            relay, catch_up = open_relay(file_path, rel_path, sender_file_size, sender_mtime, sender_digest,
+                                         forward_policy, start)
+    received_crc = None
+    try:
+        if local_source:
+            received = file.copy(sender_file_size, sparse, copied_locally)
+        else:
+            if sparse:
+                extents = ch.recv_extent_map()
+            elif keep_open:
+                # Exactly the rest of the file, the next header follows straight after
+                extents = [(None, sender_file_size - start)]
+            else:
+                extents = None
+            if not sparse:
+                # Kept up as the data lands, so a resume after a drop needn't read the file again
+                received_crc = RunningCrc(start, crc32 if resuming_transfer else 0)
+            received = receive_file_data(ch.sock, file, extents, relay, received_crc)
+            if ch.superseded:
+                # Whatever arrived before the sender gave up on us, the new connection resumes from it
+                raise ConnectionError("The sender reconnected and took over")
+            if received and received_crc and received_crc.length < sender_file_size:
+                # Without extents the stream just ends, a connection cut short looks the same
+                raise ConnectionError("Connection closed before the whole file arrived")
+        if not received:
+            if relay:
+                relay.finish()
+            file.abort()
+            if local_source:
+                ch.send_msg(REJECTED_MSG)
+            print(f"[{datetime.datetime.now()}]  Cancellation requested during file transfer")
+            print(f'\t Cancelled {rel_path} [{report_data_size(file.bytes_written)} written]')
+            if catalog:
+                catalog.refresh(file_path)
+            release()
+            fail_transfer()
+            return False
+        if sparse:
+            # Recreate any trailing hole
+            file.truncate(sender_file_size)
+        file.close()
+        keep_mtime(file_path, sender_mtime)
+        if local_source:
+            statement += f" ({file.method} from {local_source[0]})"
+            # Only now that it is complete, so a sender that sees this can count on the file
+            ch.send_msg(ALL_GOOD_MSG)
+            local_source = None     # answered, there is nothing more to tell the sender
+        print(f'[{datetime.datetime.now()}]  {statement} {rel_path} [{report_data_size(file.bytes_written)} written]')
+        file_handled(rel_path, 'received')
+        if catalog:
+            catalog.add(file_path, sender_mtime)
+        release()
+        if dedup_index:
+            dedup_index.add(file_path, sender_digest)
+        if relay and not relay.finish():
+            catch_up = True
+        if catch_up:
+            relay_catch_up(file_path, save_dir, forward_policy)
+        return keep_open
+    except Exception as e:
+        if relay:
+            # The next hop resumes from us once the sender retries this file
+            relay.finish()
+        file.abort()
+        keep_partial_crc(file_path, received_crc)
+        if local_source:
+            try:
+                ch.send_msg(REJECTED_MSG)
+            except OSError:
+                pass
+        print(f'[{datetime.datetime.now()}] Error receiving {rel_path} [{report_data_size(file.bytes_written)} written]: {e}')
+        if catalog:
+            catalog.refresh(file_path)
+        release()
+        fail_transfer()
+        return False
+
+
+class ArchiveReader:
+    """ Read end of an incoming tar stream, unwrapping the sender's length-prefixed pieces. """
+    def __init__(self, ch):
+        self.ch = ch
+        self.remaining = 0      # left in the current piece
+        self.done = False
+
+    def read(self, size):
+        if RECV_DATA["canceled"]:
+            raise ConnectionAbortedError("Cancellation requested during archive transfer")
+        if self.done:
+            return b''
+        if not self.remaining:
+            self.remaining = ARCHIVE_CHUNK.unpack(self.ch.recv_exact(ARCHIVE_CHUNK.size))[0]
+            if not self.remaining:
+                self.done = True
+                return b''
+        size = min(size, self.remaining, BUFFER_SIZE)
+        if self.ch.pending:
+            data = self.ch.recv_exact(min(size, len(self.ch.pending)))
+        else:
+            data = self.ch.sock.recv(size)
+            if not data:
+                raise ConnectionError("Connection closed mid-archive")
+        self.remaining -= len(data)
+        RECV_DATA["data_received"] += len(data)
+        return data
+
+
+def receive_archive(ch, addr, save_dir, rel_path, sender_policy, sender_flags, dedup_index=None, catalog=None):
+    """ Extract a directory sent as a tar stream, member by member as it arrives.
+
+        Nobody can be asked mid-stream, so conflicts are settled as at a relay: by the sender's
+        policy, else ours, else the file is skipped. The members left out are named to the
+        sender before the final reply. The connection always ends with the archive.
+    """
+    policy = relay_policy(sender_policy)
+    quick_check = bool(sender_flags & FLAG_QUICK_CHECK)
+    print(f'\n[{datetime.datetime.now()}]  Incoming archive: {rel_path} from {addr[0]}')
+    ch.send_msg(ALL_GOOD_MSG)
+    extracted = 0
+    skipped = []
+    try:
+        reader = ArchiveReader(ch)
+        with tarfile.open(fileobj=reader, mode='r|*', bufsize=BUFFER_SIZE) as tar:
+            for member in tar:
+                written = receive_archive_member(tar, member, addr, save_dir, policy, quick_check, dedup_index, catalog)
+                if written:
+                    extracted += 1
+                elif written is not None:
+                    skipped.append(member.name)
+        # Compressed streams may still have a trailer to come
+        while reader.read(BUFFER_SIZE):
+            pass
+        if skipped:
+            ch.send_archive_skipped(skipped)
+        ch.send_msg(ALL_GOOD_MSG)
+    except Exception as e:
+        print(f'[{datetime.datetime.now()}] Error receiving archive {rel_path} after {extracted} file(s): {e}')
+        file_handled(rel_path, 'failed')
+        return False
+    print(f'[{datetime.datetime.now()}]  Extracted {extracted} file(s) from archive {rel_path}')
+    return False
+
+
+def receive_archive_member(tar, member, addr, save_dir, policy, quick_check=True, dedup_index=None, catalog=None):
+    """ Write one member of an archive stream into save_dir.
+
+        Returns True if it was extracted, None if there was nothing to write (a directory, or a
+        file we already hold) and False if it was left out.
+    """
+    rel_path = os.path.normpath(convert_path_to_os_style(member.name))
+    if os.path.isabs(rel_path) or os.path.splitdrive(rel_path)[0] or rel_path.split(os.sep)[0] == '..':
+        print(f'\tSkipping archive member {member.name}: outside the save directory')
+        file_handled(rel_path, 'rejected')
+        return False
+    file_path = os.path.join(save_dir, rel_path)
+    if member.isdir():
+        os.makedirs(file_path, exist_ok=True)
+        return None
+    if not member.isfile():
+        print(f'\tSkipping archive member {member.name}: not a regular file')
+        file_handled(rel_path, 'rejected')
+        return False
+
+    statement = "Received"
+    needed = member.size
+    keep_both = False
+    local_file_size = local_size(file_path, catalog)
+    file_exists = local_file_size is not None
+    if file_exists:
+        # Tar mtimes are whole seconds
+        if quick_check and local_file_size == member.size and same_mtime(file_path, member.mtime, 1):
+            print(f'\t{rel_path} ({report_data_size(member.size)}) Size and modification time match, no transfer required.')
+            file_handled(rel_path, 'rejected')
+            return None
+        decision = resolve_conflict(policy, member.size, member.mtime, local_file_size, os.path.getmtime(file_path))
+        if decision == 'S':
+            print(f'[{datetime.datetime.now()}]  Transfer of file {rel_path} ({report_data_size(local_file_size)}) skipped by conflict policy')
+            file_handled(rel_path, 'failed')
+            return False
+        if decision == 'O':
+            if not RECV_DATA["overwrite"]:
+                print(f'[{datetime.datetime.now()}]  File {rel_path} ({report_data_size(local_file_size)}) will not be overwritten.')
+                file_handled(rel_path, 'rejected')
+                return False
+            statement = "Overwrote"
+            needed = max(0, member.size - local_file_size)
+        else:
+            keep_both = True
+
+    # Members that don't fit are skipped, the rest of the archive may still
+    reservation, available = admit_transfer(addr, file_path, rel_path, member.size, needed)
+    if available is not None:
+        return False
+    if keep_both:
+        if catalog:
+            file_path, file_version = catalog.next_free_version(file_path)
+        else:
+            file_path, file_version = next_free_version(file_path)
+        rel_path = append_to_filename(rel_path, f"({file_version})")
+        file_exists = False
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    try:
+        file = WriteBehindFile(file_path, False, member.size, RECV_DATA["write_queue_depth"], RECV_DATA["fsync_mode"],
+                               exclusive=bool(catalog) and not file_exists, cache_limit=RECV_DATA["cache_limit"],
+                               direct=RECV_DATA["direct_io"])
+    except FileExistsError:
+        catalog.refresh(file_path)
+        print(f'[{datetime.datetime.now()}]  {rel_path} appeared on disk unexpectedly, not overwriting it')
+        if reservation:
+            RECV_DATA["admission"].release(reservation)
+        file_handled(rel_path, 'failed')
+        return False
+    if reservation:
+        reservation.file = file
+    try:
+        source = tar.extractfile(member)
+        for chunk in iter(lambda: source.read(BUFFER_SIZE), b''):
+            file.write(chunk)
+        file.close()
+    except Exception:
+        file.abort()
+        if catalog:
+            catalog.refresh(file_path)
+        raise
+    finally:
+        if reservation:
+            RECV_DATA["admission"].release(reservation)
+    keep_mtime(file_path, member.mtime)
+    print(f'[{datetime.datetime.now()}]  {statement} {rel_path} [{report_data_size(file.bytes_written)} written]')
+    file_handled(rel_path, 'received')
+    if catalog:
+        catalog.add(file_path, member.mtime)
+    if dedup_index:
+        dedup_index.add(file_path)
+    if RECV_DATA["relay"]:
+        relay_catch_up(file_path, save_dir, policy)
+    return True
+
+
+def connection_thread(conn, addr, save_dir, dedup_index=None, catalog=None):
+    with RECV_LOCK:
+        RECV_DATA["active_transfers"] += 1
+        RECV_DATA["in_progress"] = True
+    try:
+        handle_connection(conn, addr, save_dir, dedup_index, catalog)
+    except Exception as e:
+        print(f'[{datetime.datetime.now()}] Error handling connection from {addr[0]}: {e}')
+    finally:
+        conn.close()
+        with RECV_LOCK:
+            RECV_DATA["active_transfers"] -= 1
+            RECV_DATA["in_progress"] = RECV_DATA["active_transfers"] > 0
+
+
+def receive_files(save_dir, port, overwrite=False, conflict_policy=None, fsync_mode=None, write_queue_depth=None,
+                  dedup=None, relay=None, tls=None, limits=None, ready=None, cache_limit=None, direct_io=False,
+                  local_copy=None):
+    """ Listen for senders and save what they send under save_dir.
+
+        limits are optional AdmissionControl limits: max_file_size, sender_quota, dir_quotas and min_free.
+        ready is an optional Event, set once we are listening on RECV_DATA["port"].
+        cache_limit and direct_io keep received data out of the page cache, see WriteBehindFile.
+        local_copy is one of LOCAL_COPY_MODES, which senders we copy files from ourselves when we can see them.
+    """
     RECV_DATA["overwrite"] = overwrite
+    if conflict_policy:
+        RECV_DATA["conflict_policy"] = conflict_policy
+    if fsync_mode:
+        RECV_DATA["fsync_mode"] = fsync_mode
+    if write_queue_depth:
+        RECV_DATA["write_queue_depth"] = write_queue_depth
+    if dedup:
+        RECV_DATA["dedup"] = dedup
+    if relay:
+        RECV_DATA["relay"] = relay
+    if tls:
+        RECV_DATA["tls"] = tls
+    if cache_limit:
+        RECV_DATA["cache_limit"] = cache_limit
+    if direct_io:
+        RECV_DATA["direct_io"] = direct_io
+    if local_copy:
+        RECV_DATA["local_copy"] = local_copy
+    dedup_index = DedupIndex(save_dir) if RECV_DATA["dedup"] else None
+    # Existence checks, sizes and free version names come from memory instead of the disk
+    catalog = DirCatalog(save_dir)
+    catalog.start()
+    # Transfers that can't fit are refused before any of their data moves
+    RECV_DATA["admission"] = AdmissionControl(save_dir, catalog, **(limits or {}))
+    RECV_DATA["partial_crcs"] = {}
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind(('0.0.0.0', port))
         s.listen()
-        print(f'Listening for incoming connections on port {port}')
+        RECV_DATA["port"] = s.getsockname()[1]
+        print(f'Listening for incoming connections on port {RECV_DATA["port"]}')
+        if ready:
+            ready.set()
+
+        handlers = []
+        try:
+            while True:
+                if RECV_DATA["canceled"]:
+                    # Connections see the flag too, let them wind down before we go
+                    for handler in handlers:
+                        handler.join()
+                    return
+                readable, _, _ = select.select([s], [], [], 1)  # 1 second timeout
+                if s in readable:
+                    conn, addr = s.accept()
+                    # Each connection gets its own thread so several senders (or striped links) run at once
+                    handler = session_thread(connection_thread, args=(conn, addr, save_dir, dedup_index, catalog),
+                                             daemon=True)
+                    handler.start()
+                    handlers = [h for h in handlers if h.is_alive()] + [handler]
+        finally:
+            # However we stop, what was received is made durable and the catalog kept for next time
+            FSYNC_BATCH.flush()
+            catalog.save()
 
-        while True:
-            if RECV_DATA["canceled"]:
-                return
-            readable, _, _ = select.select([s], [], [], 1)  # 1 second timeout
-            if s in readable:
-                conn, addr = s.accept()
-                file_exists = False
-                different_files = True
-                resuming_transfer = False
-                with conn:
-                    def fail_transfer():
-                        RECV_DATA["failed_files"] += 1
-                        RECV_DATA["in_progress"] = False
-                        conn.close()
-
-                    def reject_transfer():
-                        RECV_DATA["rejected_files"] += 1
-                        RECV_DATA["in_progress"] = False
-                        conn.close()
-
-                    # Receive file name and size
-                    rel_path_length = struct.unpack('I', conn.recv(4))[0]
-                    rel_path = conn.recv(rel_path_length).decode('utf-8')
-                    sender_file_size = struct.unpack('Q', conn.recv(8))[0]
-                    # Convert the received path to current machine's path style
-                    file_path = os.path.join(save_dir, convert_path_to_os_style(rel_path))
-                    # Announce transfer request
-                    print(f'\n[{datetime.datetime.now()}]  Incoming file: {rel_path} ({report_data_size(sender_file_size)}) from {addr[0]}')
-
-                    # Check if file already exists
-                    if os.path.exists(file_path):
-                        file_exists = True
-                        local_file_size = os.path.getsize(file_path)
-                        print(f'\tFile {rel_path} ({report_data_size(local_file_size)}) exists locally.')
-
-                        if sender_file_size >= local_file_size:
-                            # Send Request crc32 Message
-                            conn.send(struct.pack('I', len(REQ_CRC32_MSG)))
-                            conn.send(REQ_CRC32_MSG.encode())
-                            # Send local file size
-                            conn.send(struct.pack('Q', local_file_size))
-                            # Calc crc32 of local file
-                            crc32 = calculate_crc32(file_path)
-                            # Wait for crc32 from sender
-                            sender_crc32 = struct.unpack('I', conn.recv(4))[0]
-                            # Compare crc32s
-                            if sender_crc32 == crc32:
-                                different_files = False
-                                if sender_file_size == local_file_size:
-                                    # We already have this exact file
-                                    conn.send(struct.pack('I', len(SAME_COPY_MSG)))
-                                    conn.send(SAME_COPY_MSG.encode())
-                                    print(f'\t{rel_path} ({report_data_size(local_file_size)}) Checksum match, and file size match, no overwrite required.')
-                                    reject_transfer()
-                                    continue
-                                else:
-                                    resuming_transfer = True
-                                    conn.send(struct.pack('I', len(RESUME_MSG)))
-                                    conn.send(RESUME_MSG.encode())
-                                    print(f'\t{rel_path} ({report_data_size(local_file_size)}) Checksum match, resuming transfer.')
-                        if different_files is True:
-                            # Local file is larger or failed checksum match
-                            print(f'\t{rel_path} ({report_data_size(local_file_size)}) Checksum match failed.')
-                            # Send different file same name message then file_size and wait for reply
-                            conn.send(struct.pack('I', len(DIFF_FILE_MSG)))
-                            conn.send(DIFF_FILE_MSG.encode())
-                            # Send local file size
-                            conn.send(struct.pack('Q', local_file_size))
-
-                            # Wait for sender response
-                                #skip   #overwrite  #keepboth
-                            msg_length = struct.unpack('I', conn.recv(4))[0]
-                            msg = conn.recv(msg_length).decode('utf-8')
-                            if msg == SKIP_FILE_MSG:
-                                print(f'[{datetime.datetime.now()}]  Transfer of file {rel_path} ({report_data_size(local_file_size)}) skipped by sender')
-                                fail_transfer()
-                                continue
-                            elif msg == REQ_OVERWRITE_MSG:
-                                if not RECV_DATA["overwrite"]:
-                                    print(f'[{datetime.datetime.now()}]  File {rel_path} ({report_data_size(local_file_size)}) will not be overwritten.')
-                                    conn.send(struct.pack('I', len(REJECTED_MSG)))
-                                    conn.send(REJECTED_MSG.encode())
-                                    reject_transfer()
-                                    continue
-                                else:
-                                    # Allow overwriting of file
-                                    conn.send(struct.pack('I', len(ALL_GOOD_MSG)))
-                                    conn.send(ALL_GOOD_MSG.encode())
-                            elif msg == KEEP_BOTH_MSG:
-                                # Append ( file_version ) to the file name
-                                file_version = 1
-                                new_file_path = append_to_filename(file_path, f"({file_version})")
-                                # make sure file name is not in use
-                                while os.path.exists(new_file_path):
-                                    file_version += 1
-                                    new_file_path = append_to_filename(file_path, f"({file_version})")
-                                file_path = new_file_path
-                                rel_path = append_to_filename(rel_path, f"({file_version})")
-                                # file no longer exists at this path
-                                file_exists = False
-                                # OK the file transfer
-                                conn.send(struct.pack('I', len(ALL_GOOD_MSG)))
-                                conn.send(ALL_GOOD_MSG.encode())
-
-                    else:
-                        conn.send(struct.pack('I', len(ALL_GOOD_MSG)))
-                        conn.send(ALL_GOOD_MSG.encode())
-
-                    # Create file path if necessary
-                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    RECV_DATA["in_progress"] = True
-
-                    statement = "Appended" if resuming_transfer is True else ("Overwrote" if file_exists else "Received")
-
-                    with open(file_path, 'wb' if not resuming_transfer else 'ab') as file:
-                        bytes_written = 0
-                        try:
-                            while chunk := conn.recv(BUFFER_SIZE):
-                                if RECV_DATA["canceled"]:
-                                    print(f"[{datetime.datetime.now()}]  Cancellation requested during file transfer")
-                                    print(f'\t Cancelled {rel_path} [{report_data_size(bytes_written)} written]')
-                                    fail_transfer()
-                                    return 0
-                                if not chunk:
-                                    break
-                                file.write(chunk)
-                                RECV_DATA["data_received"] += len(chunk)
-                                bytes_written += len(chunk)
-                            print(f'[{datetime.datetime.now()}]  {statement} {rel_path} [{report_data_size(bytes_written)} written]')
-                            RECV_DATA["received_files"] += 1
-                        except Exception as e:
-                            print(f'[{datetime.datetime.now()}] Error receiving {rel_path} [{report_data_size(bytes_written)} written]: {e}')
-                            fail_transfer()
-                            continue
-            RECV_DATA["in_progress"] = False
+
+def record_throughput(samples):
+    """ Add a (time, bytes received) sample, keeping about LOAD_WINDOW seconds of them. """
+    now = time.monotonic()
+    samples.append((now, RECV_DATA["data_received"]))
+    while len(samples) > 2 and now - samples[1][0] >= LOAD_WINDOW:
+        samples.popleft()
+
+
+def advertised_load(samples):
+    """ ';key=value' fields telling senders what we speak and how busy we are, see discoverHosts.parse_load. """
+    record_throughput(samples)
+    (start, start_bytes), (now, received) = samples[0], samples[-1]
+    rate = max(0, received - start_bytes) / (now - start) if now > start else 0
+    fields = {'proto': PROTOCOL_VERSION, 'active': RECV_DATA["active_transfers"], 'rate': int(rate)}
+    admission = RECV_DATA["admission"]
+    if admission:
+        fields['free'] = max(0, admission.free_space())
+    return ''.join(f';{key}={value}' for key, value in fields.items())
 
 
 def listen_for_discovery(port, host_port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind(('', port))
+    # Wake up now and then to sample throughput, however rarely we are probed
+    sock.settimeout(1)
     print("Listening for discovery messages...")
+    recent_probes = {}
+    throughput = collections.deque()
 
     while True:
         try:
             data, addr = sock.recvfrom(1024)
-            if data.decode() == DiscoveryCode:
-                response_message = f"{socket.gethostname()}:{host_port}"
+            message = data.decode()
+            response_message = f"{socket.gethostname()}:{host_port}"
+            if message == DiscoveryCode:
+                # Legacy discoverers listen for answers on a fixed port
                 sock.sendto(response_message.encode(), (addr[0], port+1))
+            elif message.startswith(f"{DiscoveryCode}:"):
+                # Answer the probing socket directly, advertising what we speak and how busy we are
+                sock.sendto(f"{response_message}{advertised_load(throughput)}".encode(), addr)
+            else:
+                continue
+            # Probes are retried and sent on every interface, only report each round once
+            now = time.monotonic()
+            recent_probes = {k: t for k, t in recent_probes.items() if now - t < 10}
+            if (addr[0], message) not in recent_probes:
                 print(f"Discovered by: {addr}  [{datetime.datetime.now()}]")
-        except ConnectionResetError as e:
+            recent_probes[(addr[0], message)] = now
+        except socket.timeout:
+            record_throughput(throughput)
+            continue
+        except ConnectionResetError:
             # normally triggers after broadcast ends
             continue
         except Exception as e:
@@ -422,38 +2452,318 @@ def listen_for_discovery(port, host_port):
 
 
 def start_discovery_listener(host_port, discovery_port=DiscoveryPort):
-    discovery_thread = threading.Thread(target=listen_for_discovery, args=(discovery_port, host_port))
+    # Answers with the load of the session starting it
+    discovery_thread = session_thread(listen_for_discovery, args=(discovery_port, host_port))
     discovery_thread.daemon = True
     discovery_thread.start()
 
 
+class TransferClient:
+    """ A sender with its own settings, counters and cancel flag, so many can run in one process.
+
+        Settings are those of SENT_DATA: read_ahead, sparse, dedup, protocol, checksum, journal
+        and tls. Nobody is there to answer a conflict prompt, so conflicts are skipped unless
+        another policy is given. on_file(path, ok) is called as each file finishes, on whichever
+        thread sent it, and stats holds the running counters (bytesSent, processed_files, ...).
+    """
+    def __init__(self, on_file=None, conflict_policy='skip', **settings):
+        self.stats = SENT_DATA.new(on_file=on_file, conflict_policy=conflict_policy, **settings)
+
+    def run(self, send, *args):
+        """ Run one of this module's send functions as this client, returns (path, ok) for every file it finished. """
+        results = []
+        with bound_session(sent=self.stats, results=results):
+            send(*args)
+        return results
+
+    def send_files(self, paths, host, port):
+        """ Send files into the root of the receiver's save directory, returns [(path, ok)]. """
+        def send_all():
+            for path in paths:
+                if self.stats["canceled"]:
+                    file_finished(path, False)
+                else:
+                    send_file(path, os.path.dirname(path), '', host, port)
+        return self.run(send_all)
+
+    def send_tree(self, directory, host, port, archive=None):
+        """ Send a directory, file by file or as an archive stream (tar, gz or xz), returns [(path, ok)]. """
+        if archive:
+            return self.run(send_archive, directory, host, port, archive)
+        return self.run(send_directory, directory, host, port)
+
+    def cancel(self):
+        self.stats["canceled"] = True
+
+
+class TransferServer:
+    """ A receiver with its own settings, counters and stop flag, listening on a background thread.
+
+        Settings are the keyword arguments of receive_files. on_file(rel_path, outcome) is called
+        as each file finishes, with outcome one of received, deduplicated, rejected or failed.
+        Port 0 picks a free port, port holds the real one once started. Relays forward files
+        as relay_client if one is given, otherwise with the default SENT_DATA settings.
+    """
+    def __init__(self, save_dir, port, on_file=None, relay_client=None, **settings):
+        self.save_dir = save_dir
+        self.port = port
+        self.settings = settings
+        self.relay_client = relay_client
+        self.stats = RECV_DATA.new(on_file=on_file)
+        self.thread = None
+        self.error = None
+
+    def start(self):
+        """ Start listening, returns once connections are being accepted. """
+        ready = threading.Event()
+        self.stats["canceled"] = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(ready,), daemon=True)
+        self.thread.start()
+        while not ready.wait(0.1):
+            if not self.thread.is_alive():
+                raise self.error or RuntimeError(f"Receiver on port {self.port} stopped before it was listening")
+        self.port = self.stats["port"]
+        return self
+
+    def _run(self, ready):
+        sessions = {'recv': self.stats}
+        if self.relay_client:
+            sessions['sent'] = self.relay_client.stats
+        with bound_session(**sessions):
+            try:
+                receive_files(self.save_dir, self.port, ready=ready, **self.settings)
+            except Exception as e:
+                self.error = e
+                print(f'[{datetime.datetime.now()}] Receiver on port {self.port} stopped: {e}')
+
+    def stop(self):
+        """ Stop listening, cancel the transfers in progress and wait for them to wind down. """
+        self.stats["canceled"] = True
+        try:
+            if self.thread:
+                self.thread.join()
+                self.thread = None
+        finally:
+            FSYNC_BATCH.flush()
+
+    def wait(self):
+        """ Block until the receiver stops, returns the error it stopped on if any. """
+        # Join in slices so Ctrl-C still reaches the calling thread
+        while self.thread and self.thread.is_alive():
+            self.thread.join(0.5)
+        return self.error
+
+    def start_discovery(self, discovery_port=DiscoveryPort):
+        """ Answer discovery probes with this receiver's port and load, for as long as the process runs. """
+        with bound_session(recv=self.stats):
+            start_discovery_listener(self.port, discovery_port)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
 def main():
     parser = argparse.ArgumentParser(description='File Transfer Program')
-    parser.add_argument('mode', choices=['send', 'receive'], help='Mode: send or receive')
+    parser.add_argument('mode', choices=['send', 'receive', 'sync'], help='Mode: send, receive or sync')
     parser.add_argument('--files', nargs='+', help='Files to send (required in send mode)')
     parser.add_argument('--dir', help='Directory to send (required in send mode)')
-    parser.add_argument('--host', help='Host to connect to (required in send mode)')
+    parser.add_argument('--host', nargs='+', help='Host(s) to connect to as host or host:port, '
+                                                  'several hosts read each file once and send it to all, auto picks '
+                                                  'the least loaded receiver found by discovery (required in send mode)')
+    parser.add_argument('--spread', action='store_true',
+                        help='Send mode: share the files out between the hosts instead of sending each to all, '
+                             'favouring the least loaded ones with room, with --host auto every receiver found (optional)')
     parser.add_argument('--port', type=int, required=True, help='Port to connect/listen on')
     parser.add_argument('--savedir', help='Directory to save the received files (required in receive mode)')
     parser.add_argument('--overwrite', action='store_true', help='Overwrite existing files (optional, default is False)')
+    parser.add_argument('--on-conflict', choices=CONFLICT_POLICIES, default='prompt',
+                        help='How to settle files that differ from the copy on the receiver (optional, default is prompt)')
+    parser.add_argument('--read-ahead', type=int, default=READ_AHEAD_DEPTH,
+                        help=f'Send mode: buffers read ahead of the socket, 0 to disable (optional, default is {READ_AHEAD_DEPTH})')
+    parser.add_argument('--no-sparse', action='store_true',
+                        help='Send mode: send holes in sparse files as zeros instead of skipping them (optional)')
+    parser.add_argument('--dedup', nargs='?', const='reflink', choices=CLONE_MODES,
+                        help='Send mode: send content digests so the receiver can skip data it already holds. '
+                             'Receive mode: answer them with a hardlink, reflink (default) or local copy (optional)')
+    parser.add_argument('--stripe', nargs='*', metavar='SOURCE_IP',
+                        help='Send mode: spread files over one connection per local address, '
+                             'all IPv4 addresses if none are listed (optional)')
+    parser.add_argument('--checksum', action='store_true',
+                        help='Send and sync modes: compare existing files by checksum even when their size and '
+                             'modification time match (optional)')
+    parser.add_argument('--archive', nargs='?', const='tar', choices=ARCHIVE_MODES + ['auto'],
+                        help='Send mode: stream --dir as a single tar archive, optionally gz or xz compressed, or '
+                             'auto to gzip only if it would be faster over this link, the receiver extracts it as it '
+                             'arrives (optional)')
+    parser.add_argument('--relay', metavar='HOST[:PORT]',
+                        help='Receive mode: forward every incoming file to the next receiver in a chain while writing it (optional)')
+    parser.add_argument('--watch', action='store_true',
+                        help='Sync mode: keep running and send new or modified files as they change (optional)')
+    parser.add_argument('--journal', metavar='PATH',
+                        help='Send and sync modes: record what each receiver already has in this file, '
+                             'so a re-run skips finished files and resumes partial ones (optional)')
+    parser.add_argument('--retries', type=int, default=RETRY_ATTEMPTS,
+                        help=f'Send and sync modes: times to reconnect and resume a file after the connection drops, '
+                             f'0 to give up straight away (optional, default is {RETRY_ATTEMPTS})')
+    parser.add_argument('--retry-delay', type=float, default=RETRY_DELAY, metavar='SECONDS',
+                        help=f'Send and sync modes: wait before the first retry, doubling with each one after up to '
+                             f'{RETRY_MAX_DELAY:.0f}s, with some randomness (optional, default is {RETRY_DELAY})')
+    parser.add_argument('--auto-tune', action='store_true',
+                        help='Send mode: measure the link while sending a directory or large file and adjust the '
+                             'number of parallel streams, block size and socket buffers to it, remembering the '
+                             'result for the host (optional)')
+    parser.add_argument('--protocol', choices=PROTOCOL_CHOICES, default='auto',
+                        help='Send mode: wire protocol version, auto uses v2 with receivers that advertise it (optional)')
+    parser.add_argument('--tls', action='store_true',
+                        help='Encrypt connections with TLS, both ends must use it (optional)')
+    parser.add_argument('--tls-cert', metavar='PEM',
+                        help='Receive mode: certificate to present, a self-signed one is generated if not given (optional)')
+    parser.add_argument('--tls-key', metavar='PEM',
+                        help='Receive mode: private key for --tls-cert, if it is not in the same file (optional)')
+    parser.add_argument('--tls-pin', metavar='FINGERPRINT',
+                        help='Send and sync modes: sha256 fingerprint the receiver\'s certificate must have, '
+                             'otherwise it is trusted on first use and remembered (optional)')
+    parser.add_argument('--max-file-size', type=parse_size, metavar='SIZE',
+                        help='Receive mode: refuse files larger than this, e.g. 4G (optional)')
+    parser.add_argument('--sender-quota', type=parse_size, metavar='SIZE',
+                        help='Receive mode: most any one sender may deliver while the receiver runs (optional)')
+    parser.add_argument('--dir-quota', action='append', metavar='DIR=SIZE', default=[],
+                        help='Receive mode: cap the total size of a directory under --savedir, may be repeated (optional)')
+    parser.add_argument('--min-free', type=parse_size, default=0, metavar='SIZE',
+                        help='Receive mode: free space to always leave on the volume (optional, default is 0)')
+    parser.add_argument('--cache-limit', type=parse_size, metavar='SIZE',
+                        help='Keep each file\'s use of the page cache near SIZE, e.g. 256M, by dropping pages once they are '
+                             'sent or written to disk, so a large copy doesn\'t evict everything else (optional)')
+    parser.add_argument('--direct-io', action='store_true',
+                        help='Read (send) or write (receive) file data with O_DIRECT, bypassing the page cache where the '
+                             'filesystem supports it (optional)')
+    parser.add_argument('--local-copy', choices=LOCAL_COPY_MODES,
+                        help='Receive mode: copy files straight from the sender\'s disk when both ends share a filesystem, '
+                             'for senders on this host that may read the file themselves (auto), any sender on trust, '
+                             'or never (the default). Send and sync modes: off sends everything over the connection '
+                             '(optional, senders offer by default)')
+    parser.add_argument('--fsync', choices=FSYNC_MODES, default='none',
+                        help='Receive mode: fsync each file, fsync in batches, or leave it to the OS (optional, default is none)')
+    parser.add_argument('--write-queue', type=int, default=WRITE_QUEUE_DEPTH,
+                        help=f'Receive mode: buffers queued between network and disk (optional, default is {WRITE_QUEUE_DEPTH})')
     args = parser.parse_args()
 
-    if args.mode == 'send':
+    client = None
+    if args.mode in ('send', 'sync'):
         if not args.host:
-            parser.error('send mode requires --host')
+            parser.error(f'{args.mode} mode requires --host')
+        client = TransferClient(conflict_policy=args.on_conflict, read_ahead=args.read_ahead, sparse=not args.no_sparse,
+                                dedup=bool(args.dedup), protocol=args.protocol, checksum=args.checksum,
+                                cache_limit=args.cache_limit, direct_io=args.direct_io,
+                                local_copy=args.local_copy != 'off', retries=max(0, args.retries),
+                                retry_delay=args.retry_delay, auto_tune=args.auto_tune,
+                                journal=TransferJournal(args.journal) if args.journal else None)
+    elif args.relay:
+        # Relays connect onwards as senders
+        client = TransferClient()
+    if args.tls and client:
+        client.stats["tls"] = TlsClient(args.tls_pin)
+    if args.mode == 'sync':
+        if not args.dir or len(args.host) > 1:
+            parser.error('sync mode requires --dir and a single --host')
+        try:
+            client.run(sync_directory, args.dir, *parse_destination(args.host[0], args.port), args.watch)
+        except KeyboardInterrupt:
+            client.cancel()
+    elif args.mode == 'send':
+        if not args.files and not args.dir:
+            parser.error('send mode requires either --files or --dir')
         if args.files:
-            for file in args.files:
-                send_file(file, os.path.dirname(file), '', args.host, args.port)
-        elif args.dir:
-            send_directory(args.dir, args.host, args.port)
+            jobs = [(file, os.path.dirname(file), '') for file in args.files]
+        if args.host == ['auto'] and not args.spread:
+            # Pick the least loaded receiver with room for the whole batch
+            receivers = discover_receivers(args.port)
+            paths = args.files or [job[0] for job in collect_directory_jobs(args.dir)]
+            ranked = rank_receivers(receivers, sum(os.path.getsize(p) for p in paths if os.path.isfile(p)))
+            if not ranked:
+                parser.error(f'none of the {len(receivers)} receiver(s) found on port {args.port} has room for the files')
+            hostname, ip, port, load = ranked[0]
+            print(f'[{datetime.datetime.now()}] Sending to {hostname} ({ip}:{port}, {describe_load(load)})')
+            args.host = [f'{ip}:{port}']
+        destinations = [parse_destination(host, args.port) for host in args.host]
+        if args.spread:
+            if args.archive or args.stripe is not None:
+                parser.error('--spread cannot be combined with --archive or --stripe')
+            if args.host == ['auto']:
+                receivers = discover_receivers(args.port)
+            else:
+                receivers = [(host, host, port, query_load(host) or parse_load(b'')) for host, port in destinations]
+            if not receivers:
+                parser.error(f'no receivers found on port {args.port} to spread the files over')
+            client.run(send_spread, jobs if args.files else collect_directory_jobs(args.dir), receivers)
+        elif args.archive:
+            if not args.dir or args.files or len(destinations) > 1 or args.stripe is not None:
+                parser.error('--archive requires --dir and a single --host')
+            client.send_tree(args.dir, *destinations[0], args.archive)
+        elif len(destinations) > 1 or args.stripe is not None:
+            if not args.files:
+                jobs = collect_directory_jobs(args.dir)
+            if len(destinations) > 1:
+                client.run(send_fanout, jobs, destinations)
+            else:
+                client.run(send_striped, jobs, *destinations[0], args.stripe)
+        elif args.files:
+            client.send_files(args.files, *destinations[0])
         else:
-            parser.error('send mode requires either --files or --dir')
+            client.send_tree(args.dir, *destinations[0])
     elif args.mode == 'receive':
         if not args.savedir:
             parser.error('receive mode requires --savedir')
-        start_discovery_listener(args.port, DiscoveryPort)
-        receive_files(args.savedir, args.port, args.overwrite)
+        relay = parse_destination(args.relay, args.port) if args.relay else None
+        tls = None
+        if args.tls:
+            cert_path, key_path = ensure_certificate(args.tls_cert, args.tls_key)
+            tls = make_server_context(cert_path, key_path)
+            print(f'TLS certificate fingerprint: {certificate_fingerprint(cert_path)}')
+        limits = {'max_file_size': args.max_file_size, 'sender_quota': args.sender_quota, 'min_free': args.min_free,
+                  'dir_quotas': {}}
+        for quota in args.dir_quota:
+            directory, sep, size = quota.rpartition('=')
+            try:
+                if not sep:
+                    raise ValueError(quota)
+                limits['dir_quotas'][directory] = parse_size(size)
+            except ValueError:
+                parser.error(f'--dir-quota expects DIR=SIZE, not {quota}')
+        server = TransferServer(args.savedir, args.port, relay_client=client, overwrite=args.overwrite,
+                                conflict_policy=args.on_conflict, fsync_mode=args.fsync,
+                                write_queue_depth=args.write_queue, dedup=args.dedup, relay=relay, tls=tls,
+                                limits=limits, cache_limit=args.cache_limit, direct_io=args.direct_io,
+                                local_copy=args.local_copy)
+        server.start()
+        server.start_discovery(DiscoveryPort)
+        try:
+            error = server.wait()
+        except KeyboardInterrupt:
+            server.stop()
+            error = None
+        if error:
+            sys.exit(1)
 
+    if not client:
+        return
+    stats = client.stats
+    if stats["retried"]:
+        print(f'[{datetime.datetime.now()}] Reconnected {stats["retried"]} time(s) after dropped connections, '
+              f'{stats["recovered_files"]} file(s) made it on a retry')
+    if stats["local_copies"]:
+        print(f'[{datetime.datetime.now()}] {stats["local_copies"]} file(s) were copied by the receiver straight from this disk')
+    if stats["journal"]:
+        if stats["journal_skipped"]:
+            print(f'[{datetime.datetime.now()}] Skipped {stats["journal_skipped"]} file(s) the journal shows as already sent')
+        stats["journal"].close()
+    if stats["tls"] and stats["tls"].handshakes:
+        tls = stats["tls"]
+        print(f'[{datetime.datetime.now()}] TLS: {tls.handshakes} connection(s), {tls.resumed} resumed without a full handshake')
 
 if __name__ == '__main__':
     main()
@@ -8,11 +8,10 @@ import time
 
 from DiscoveryConsts import DiscoveryPort
 from stdoutputCapture import StdOutputCaptureThread
-from fileTransfer import receive_files, report_data_size, start_discovery_listener, RECV_DATA
+from fileTransfer import report_data_size, TransferServer
 
 
 APP_TITLE = "File Receiver GUI"
-recv_thread = None
 
 
 def is_capture():
@@ -23,19 +22,6 @@ def is_logging():
     return 1    # set this to enable/disable logging
 
 
-def recv_start(savedir, port, overwrite):
-    RECV_DATA["canceled"] = False
-    global recv_thread
-    recv_thread = threading.Thread(target=receive_files, args=(savedir, port, overwrite))
-    recv_thread.start()
-
-
-def recv_stop():
-    RECV_DATA["canceled"] = True
-    global recv_thread
-    recv_thread.join()
-
-
 def get_default_download_folder():
     if os.name == 'posix':  # macOS or Linux
         return os.path.expanduser("~/Downloads")
@@ -80,8 +66,10 @@ class FileReceiverGUI(tk.Tk):
         super().__init__()
         self.savedir = savedir
         self.port = port
-        #self.overwrite = overwrite
-        RECV_DATA["overwrite"] = overwrite
+        # Counters live on across restarts in a new save folder, the overwrite setting is read for every file
+        self.server = TransferServer(savedir, port, overwrite=overwrite)
+        self.stats = self.server.stats
+        self.stats["overwrite"] = overwrite
         self.log_file = log_file
 
         self.title(APP_TITLE)
@@ -112,7 +100,7 @@ class FileReceiverGUI(tk.Tk):
         self.path_text.pack(side=tk.LEFT, padx=(10, 0), pady=0)
 
         # Overwrite checkbox
-        self.overwrite_var = tk.BooleanVar(value=RECV_DATA["overwrite"])
+        self.overwrite_var = tk.BooleanVar(value=self.stats["overwrite"])
         self.overwrite_checkbox = tk.Checkbutton(self.button_frame, text="Overwrite", variable=self.overwrite_var, command=self.toggle_overwrite)
         self.overwrite_checkbox.pack(side=tk.RIGHT, padx=(10, 0))
 
@@ -132,7 +120,7 @@ class FileReceiverGUI(tk.Tk):
         self.text_area.config(state=tk.DISABLED)
 
         # Stats Label
-        self.stats_text = tk.Label(self, text=f"{RECV_DATA['received_files']} files received, {RECV_DATA['failed_files']} failed, {RECV_DATA['rejected_files']} rejected\n{report_data_size(RECV_DATA['data_received'])} received", height=2, justify=tk.LEFT, anchor="w", font=("Helvetica", 10, "bold"))
+        self.stats_text = tk.Label(self, text=f"{self.stats['received_files']} files received, {self.stats['failed_files']} failed, {self.stats['rejected_files']} rejected\n{report_data_size(self.stats['data_received'])} received", height=2, justify=tk.LEFT, anchor="w", font=("Helvetica", 10, "bold"))
         self.stats_text.pack(side=tk.LEFT, padx=(10, 0), pady=0)
 
         # Cler button
@@ -145,12 +133,23 @@ class FileReceiverGUI(tk.Tk):
         if not new_path or new_path == old_path:
             return
 
-        recv_stop()
+        self.recv_stop()
         self.savedir = new_path
         self.path_text.config(text=f"{self.savedir}")
         print(f"[{datetime.datetime.now()}] <<NEW SAVE DIRECTORY SELECTED>>:: {self.savedir}")
 
-        recv_start(self.savedir, self.port, RECV_DATA["overwrite"])
+        self.recv_start()
+
+    def recv_start(self):
+        self.server.save_dir = self.savedir
+        self.server.settings["overwrite"] = self.stats["overwrite"]
+        try:
+            self.server.start()
+        except Exception as e:
+            print(f"[{datetime.datetime.now()}] Could not start receiving on port {self.port}: {e}")
+
+    def recv_stop(self):
+        self.server.stop()
 
     def open_directory(self, dir=None):
         if not dir:
@@ -173,17 +172,17 @@ class FileReceiverGUI(tk.Tk):
             print("Directory does not exist")
 
     def toggle_overwrite(self):
-        RECV_DATA["overwrite"] = self.overwrite_var.get()
+        self.stats["overwrite"] = self.overwrite_var.get()
 
     def clear_func(self):
         self.clear_text_area()
         self.reset_stats()
 
     def reset_stats(self):
-        RECV_DATA["received_files"] = 0
-        RECV_DATA["rejected_files"] = 0
-        RECV_DATA["failed_files"] = 0
-        RECV_DATA["data_received"] = 0
+        self.stats["received_files"] = 0
+        self.stats["rejected_files"] = 0
+        self.stats["failed_files"] = 0
+        self.stats["data_received"] = 0
         self.update_stats_label()
 
     def clear_text_area(self):
@@ -193,10 +192,10 @@ class FileReceiverGUI(tk.Tk):
         self.text_area.config(state=tk.DISABLED)
 
     def update_stats_label(self):
-        self.stats_text.config(text=f"{RECV_DATA['received_files']} files received, {RECV_DATA['failed_files']} failed, {RECV_DATA['rejected_files']} rejected\n{report_data_size(RECV_DATA['data_received'])} received")
+        self.stats_text.config(text=f"{self.stats['received_files']} files received, {self.stats['failed_files']} failed, {self.stats['rejected_files']} rejected\n{report_data_size(self.stats['data_received'])} received")
 
     def auto_updater(self):
-        if not RECV_DATA["in_progress"]:
+        if not self.stats["in_progress"]:
             self.update_stats_label()  # update the stats just to be safe / avoid race conditions
             # self.auto_updater_running = False
             return
@@ -204,7 +203,7 @@ class FileReceiverGUI(tk.Tk):
         if not self.auto_updater_running:
             self.auto_updater_running = True
 
-            while RECV_DATA["in_progress"]:
+            while self.stats["in_progress"]:
                 self.update_stats_label()
                 time.sleep(.3)
 
@@ -233,7 +232,7 @@ class FileReceiverGUI(tk.Tk):
             self.log_file.write(f"{text}\n")
 
     def on_closing(self):
-        save_settings(self.savedir, self.port, RECV_DATA["overwrite"])
+        save_settings(self.savedir, self.port, self.stats["overwrite"])
         self.destroy()
 
 
@@ -268,17 +267,17 @@ def main():
 
     print(f'[{datetime.datetime.now()}] <<< NEW STARTUP >>>')
 
-    # Start host discovery server
-    start_discovery_listener(args.port, DiscoveryPort)
-
     # Start receiving file handling thread
-    recv_start(args.savedir, args.port, args.overwrite)
+    app.recv_start()
+
+    # Start host discovery server, answering with the receiver's load
+    app.server.start_discovery(DiscoveryPort)
 
     # Start main window
     app.mainloop()
 
     # Stop the receiving thread
-    recv_stop()
+    app.recv_stop()
 
     # Stop the output capture thread
     if is_capture():
@@ -1,4 +1,5 @@
 import tkinter as tk
+import tkinter.font as tkfont
 from tkinter import filedialog, messagebox
 import argparse
 import os
@@ -6,15 +7,17 @@ import sys
 import datetime
 from tkinterdnd2 import DND_FILES, TkinterDnD
 
-from discoverHosts import discover_and_list_hosts
-from fileTransfer import report_data_size, send_file, SENT_DATA
+from discoverHosts import HOST_REGISTRY, LoadSpreader, rank_receivers, describe_load
+from fileTransfer import report_data_size, send_file, send_file_fanout, parse_destination, file_finished, \
+    TransferClient, CONFLICT_POLICIES
+from pathScanner import PathScanner
 from progressDialog import ProgressDialog
 
 APP_TITLE = "File Transfer GUI"
-SelectedHost = {
-    "port": None,
-    "ip": None,
-}
+SelectedHosts = []  # (ip, port) picked from the discovery list
+SelectedReceivers = []  # (hostname, ip, port, load) of the same, when they are to share the files out
+FAILED_MARK = "❌"   # prefix for items that failed to send last time
+SCAN_POLL_MS = 100
 
 
 def is_logging():
@@ -22,51 +25,180 @@ def is_logging():
 
 
 class HostListPopup(tk.Toplevel):
-    def __init__(self, parent, host_list):
+    def __init__(self, parent, registry):
         super().__init__(parent)
         self.title("Discovered Hosts")
         x = parent.winfo_x() + 90
         y = parent.winfo_y() + 25
-        self.geometry(f"300x150+{x}+{y}")
+        self.geometry(f"420x180+{x}+{y}")
 
         self.parent = parent
-        self.host_list = host_list
+        self.registry = registry
+        self.host_list = []
 
         self.create_widgets()
+        # Show what we already know right away, then pick up hosts as they answer
+        self.registry.refresh_now()
+        self.refresh_hosts()
 
     def create_widgets(self):
-        self.listbox = tk.Listbox(self)
+        self.listbox = tk.Listbox(self, selectmode=tk.EXTENDED)
         self.listbox.pack(fill=tk.BOTH, expand=True)
 
-        # Add hosts to the listbox
-        for host in self.host_list:
-            self.listbox.insert(tk.END, f"  {host[0]}   :   {host[1]}   :   {host[2]}")
-
         # Bind double click event to select host
         self.listbox.bind("<Double-Button-1>", self.select_host)
 
+        button_frame = tk.Frame(self)
+        button_frame.pack(side=tk.BOTTOM, pady=2)
+        # Ctrl/Shift-click several hosts to send the same files to all of them, or share the files out between them
+        self.select_button = tk.Button(button_frame, text="Use Selected", command=self.select_hosts)
+        self.select_button.pack(side=tk.LEFT, padx=2)
+        self.spread = tk.BooleanVar(value=False)
+        tk.Checkbutton(button_frame, text="Spread files", variable=self.spread).pack(side=tk.LEFT, padx=2)
+        # The least loaded host with room for everything on the list
+        self.best_button = tk.Button(button_frame, text="Least Loaded", command=self.select_least_loaded)
+        self.best_button.pack(side=tk.LEFT, padx=2)
+
+    def refresh_hosts(self):
+        host_list = self.registry.get_receivers()
+        if host_list != self.host_list:
+            self.host_list = host_list
+            self.listbox.delete(0, tk.END)
+            # Add hosts to the listbox
+            for host in self.host_list:
+                self.listbox.insert(tk.END, f"  {host[0]}   :   {host[1]}   :   {host[2]}   ({describe_load(host[3])})")
+        self.after(300, self.refresh_hosts)
+
     def select_host(self, event):
-        index = self.listbox.curselection()[0]
-        selected_host = self.host_list[index]
-        self.parent.title(f"{APP_TITLE} --> {selected_host[0]}")
-        global SelectedHost
-        SelectedHost["ip"] = selected_host[1]
-        SelectedHost["port"] = selected_host[2]
+        if not self.listbox.curselection():
+            return
+        index = self.listbox.nearest(event.y)
+        self.listbox.selection_clear(0, tk.END)
+        self.listbox.selection_set(index)
+        self.select_hosts()
+
+    def select_hosts(self):
+        selected = [self.host_list[index] for index in self.listbox.curselection()]
+        if not selected:
+            return
+        self.use_hosts(selected, self.spread.get() and len(selected) > 1)
+
+    def select_least_loaded(self):
+        ranked = rank_receivers(self.host_list, self.parent.total_file_size)
+        if not ranked:
+            messagebox.showinfo("No Room", "None of the hosts found has room for the files on the list", parent=self)
+            return
+        self.use_hosts(ranked[:1], False)
+
+    def use_hosts(self, selected, spread):
+        joiner = " | " if spread else ", "
+        self.parent.title(f"{APP_TITLE} --> {joiner.join(host[0] for host in selected)}")
+        SelectedHosts.clear()
+        SelectedHosts.extend((host[1], int(host[2])) for host in selected)
+        SelectedReceivers.clear()
+        if spread:
+            SelectedReceivers.extend((host[0], host[1], int(host[2]), host[3]) for host in selected)
         self.destroy()
 
 
+class VirtualListbox(tk.Frame):
+    """ A Listbox that only ever holds the rows on screen, so it stays quick however many items it lists.
+
+        items is the full list; describe(item) gives the text shown for one, and is only
+        called for visible rows when they are drawn.
+    """
+    def __init__(self, parent, describe=str, **kwargs):
+        super().__init__(parent)
+        self.items = []
+        self.describe = describe
+        self.top = 0
+        self.redraw_pending = False
+
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox = tk.Listbox(self, activestyle="none", **kwargs)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.line_height = max(1, tkfont.Font(font=self.listbox.cget("font")).metrics("linespace"))
+
+        self.listbox.bind("<Configure>", lambda event: self.redraw())
+        self.listbox.bind("<MouseWheel>", self.on_wheel)    # Windows and macOS
+        self.listbox.bind("<Button-4>", lambda event: self.scroll(-3))     # X11
+        self.listbox.bind("<Button-5>", lambda event: self.scroll(3))
+
+    def __len__(self):
+        return len(self.items)
+
+    def rows(self):
+        return max(1, self.listbox.winfo_height() // self.line_height)
+
+    def append(self, item):
+        self.items.append(item)
+        self.refresh()
+
+    def remove(self, items):
+        items = set(items)
+        self.items = [item for item in self.items if item not in items]
+        self.refresh()
+
+    def clear(self):
+        self.items = []
+        self.top = 0
+        self.refresh()
+
+    def refresh(self):
+        """ Redraw once the event loop is idle, however many changes come before then. """
+        if not self.redraw_pending:
+            self.redraw_pending = True
+            self.after_idle(self.redraw)
+
+    def redraw(self):
+        self.redraw_pending = False
+        rows = self.rows()
+        self.top = max(0, min(self.top, len(self.items) - rows))
+        self.listbox.delete(0, tk.END)
+        for item in self.items[self.top:self.top + rows]:
+            self.listbox.insert(tk.END, self.describe(item))
+        if self.items:
+            self.scrollbar.set(self.top / len(self.items), min(1, (self.top + rows) / len(self.items)))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def yview(self, *args):
+        if args[0] == "moveto":
+            self.top = int(float(args[1]) * len(self.items))
+            self.redraw()
+        elif args[0] == "scroll":
+            step = int(args[1])
+            self.scroll(step * self.rows() if args[2] == "pages" else step)
+
+    def scroll(self, lines):
+        self.top += lines
+        self.redraw()
+        return "break"
+
+    def on_wheel(self, event):
+        # Windows reports multiples of 120 per notch, macOS small deltas
+        delta = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        return self.scroll(-3 * delta)
+
+
 class FileTransferGUI(TkinterDnD.Tk):
-    def __init__(self, host, port):
+    def __init__(self, destinations, conflict_policy='prompt'):
         super().__init__()
-        self.host = host
-        self.port = port
+        self.destinations = destinations
+        self.host, self.port = destinations[0]
+        self.conflict_policy = conflict_policy
         self.total_file_size = 0
         self.total_file_count = 0
+        self.listed = set()     # paths in the list, with or without FAILED_MARK
+        self.scans = {}         # path -> finished ScanResult, reused when sending
+        self.scanning = {}      # path -> ScanResult still being filled in
+        self.scanner = PathScanner()
+        self.polling = False
+        self.spreader = None    # shares the files out when the selected hosts are to split them
+        self.client = None      # the TransferClient of the batch being sent
 
-        if not host:
-            self.title(APP_TITLE)
-        else:
-            self.title(f"{APP_TITLE} --> {host}")
+        self.title(f"{APP_TITLE} --> {', '.join(host for host, _ in destinations)}")
 
         if sys.platform.startswith('win'):  # Windows
             self.geometry("420x505")
@@ -89,14 +221,18 @@ class FileTransferGUI(TkinterDnD.Tk):
         self.clear_button = tk.Button(self.button_frame, text="Clear", command=self.clear_files)
         self.clear_button.pack(side=tk.RIGHT, padx=10, pady=0)
 
+        # Stop Scan button, only usable while dropped directories are being scanned
+        self.stop_scan_button = tk.Button(self.button_frame, text="Stop Scan", command=self.stop_scan, state=tk.DISABLED)
+        self.stop_scan_button.pack(side=tk.RIGHT, padx=0, pady=0)
+
         # Drop target
         self.drop_target = tk.Label(self, text="Drag and drop files or directories here", bg="lightgray", width=60, height=10)
         self.drop_target.pack(fill=tk.BOTH, expand=True, padx=5, pady=(0, 5))
         self.drop_target.drop_target_register(DND_FILES)
         self.drop_target.dnd_bind('<<Drop>>', self.drop)
 
-        # Listbox
-        self.file_listbox = tk.Listbox(self, selectmode=tk.MULTIPLE, width=60, height=15)
+        # File list, only the visible rows are ever drawn
+        self.file_listbox = VirtualListbox(self, describe=self.describe_item, width=60, height=15)
         self.file_listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=(0, 0))
 
         # Label
@@ -110,63 +246,113 @@ class FileTransferGUI(TkinterDnD.Tk):
     def browse_files(self):
         filepaths = filedialog.askopenfilenames(title="Select Files or Directories")
         for filepath in filepaths:
-            if filepath not in self.file_listbox.get(0, tk.END):
-                self.file_listbox.insert(tk.END, filepath)
-                self.total_file_size += self.get_file_size(filepath)
+            self.add_path(filepath)
         self.update_items_label()
 
     def drop(self, event):
         filepaths = self.tk.splitlist(event.data)
         for filepath in filepaths:
-            filepath_fail = f"❌{filepath}"
-            if (filepath not in self.file_listbox.get(0, tk.END) and
-                    filepath_fail not in self.file_listbox.get(0, tk.END)):
-                self.file_listbox.insert(tk.END, filepath)
-                self.total_file_size += self.get_file_size(filepath)
+            self.add_path(filepath)
         self.update_items_label()
 
     def failed_file_redrop(self, filepath):
-        self.file_listbox.insert(tk.END, f"❌{filepath}")
-        self.total_file_size += self.get_file_size(filepath)
+        self.add_path(filepath, failed=True)
+
+    def add_path(self, filepath, failed=False):
+        """ List a file or directory and count it on the scanner thread, or from the last scan if we have one. """
+        if filepath in self.listed:
+            return
+        self.listed.add(filepath)
+        self.file_listbox.append(f"{FAILED_MARK}{filepath}" if failed else filepath)
+        if filepath in self.scans:
+            self.total_file_count += self.scans[filepath].count
+            self.total_file_size += self.scans[filepath].size
+            return
+        self.scanning[filepath] = self.scanner.scan(filepath)
+        self.stop_scan_button.config(state=tk.NORMAL)
+        if not self.polling:
+            self.polling = True
+            self.after(SCAN_POLL_MS, self.poll_scans)
+
+    def poll_scans(self):
+        """ Pick up finished scans and show the running totals of the ones still going. """
+        for filepath, result in list(self.scanning.items()):
+            if result.done:
+                del self.scanning[filepath]
+                self.scans[filepath] = result
+                self.total_file_count += result.count
+                self.total_file_size += result.size
+        self.update_items_label()
+        self.file_listbox.refresh()
+        if self.scanning:
+            self.after(SCAN_POLL_MS, self.poll_scans)
+        else:
+            self.polling = False
+            self.stop_scan_button.config(state=tk.DISABLED)
+
+    def stop_scan(self):
+        """ Cancel the scans still running and take their paths back off the list. """
+        if not self.scanning:
+            return
+        self.scanner.cancel()
+        dropped = set()
+        for filepath in self.scanning:
+            self.listed.discard(filepath)
+            dropped.update((filepath, f"{FAILED_MARK}{filepath}"))
+        self.scanning.clear()
+        self.file_listbox.remove(dropped)
+        self.update_items_label()
+
+    def describe_item(self, item):
+        result = self.scanning.get(item.lstrip(FAILED_MARK)) or self.scans.get(item.lstrip(FAILED_MARK))
+        if result is None or not result.is_dir:
+            return item
+        if not result.done:
+            return f"{item}   (scanning... {result.count} files)"
+        return f"{item}   ({result.count} files, {report_data_size(result.size)})"
 
     def send_files(self):
-        global SelectedHost
-        if SelectedHost['ip'] and self.host is not SelectedHost['ip']:
-            self.host = SelectedHost['ip']
-        if SelectedHost['port'] and self.port is not int(SelectedHost['port']):
-            self.port = int(SelectedHost['port'])
+        if SelectedHosts:
+            self.destinations = list(SelectedHosts)
+            self.host, self.port = self.destinations[0]
+        self.spreader = LoadSpreader(SelectedReceivers) if SelectedReceivers else None
 
-        # Reset all SEND_DATA
-        SENT_DATA['bytesSent'] = 0
-        SENT_DATA['failed_files'] = 0
-        SENT_DATA['processed_files'] = 0
-        SENT_DATA["canceled"] = False
+        if self.scanning:
+            messagebox.showinfo("Scanning", "Still counting the files to send, wait for the scan to finish or stop it")
+            return
 
-        selected_files = self.file_listbox.get(0, tk.END)
+        selected_files = list(self.file_listbox.items)
 
         if not selected_files:
             messagebox.showerror("Error", "No files or directories selected")
             return
 
+        # Fresh counters for every batch, and "Apply to all remaining" only lasts for one
+        self.client = TransferClient(conflict_policy=self.conflict_policy, using_gui=True)
+        stats = self.client.stats
+
         num_items = self.total_file_count
         self.failed_files.clear()
 
-        tranferWindow = ProgressDialog(self, selected_files, self.total_file_count, self.total_file_size, self.host, self.port, self.transfer_file, self.transfer_directory)
+        tranferWindow = ProgressDialog(self, self.client, selected_files, self.total_file_count, self.total_file_size, self.host, self.port, self.transfer_file, self.transfer_directory)
         tranferWindow.grab_set()  # Make the popup modal
         tranferWindow.wait_window()
 
         self.failed_files = tranferWindow.failed_files
 
         # Update info label
-        num_fails = SENT_DATA["failed_files"]
+        num_fails = stats["failed_files"]
         num_success = num_items - num_fails
+        retries = f", {stats['retried']} reconnects" if stats['retried'] else ""
         if num_fails:
-            self.label_text.config(text=f"Failed to send {num_fails} files ({report_data_size(self.total_file_size-SENT_DATA['bytesSent'])})\nSuccessfully sent {num_success} files ({report_data_size(SENT_DATA['bytesSent'])})")
+            self.label_text.config(text=f"Failed to send {num_fails} files ({report_data_size(self.total_file_size-stats['bytesSent'])})\nSuccessfully sent {num_success} files ({report_data_size(stats['bytesSent'])}){retries}")
         else:
-            self.label_text.config(text=f"Successfully sent {num_success} files ({report_data_size(SENT_DATA['bytesSent'])})\n ")
+            self.label_text.config(text=f"Successfully sent {num_success} files ({report_data_size(stats['bytesSent'])})\n{retries[2:] or ' '}")
 
-        # Clear the listbox after sending files
-        self.file_listbox.delete(0, tk.END)
+        # Clear the listbox after sending files, keeping the scans of the ones going back on it
+        self.file_listbox.clear()
+        self.listed.clear()
+        self.scans = {path: self.scans[path] for path in self.failed_files if path in self.scans}
         self.total_file_size = 0
         self.total_file_count = 0
 
@@ -174,50 +360,61 @@ class FileTransferGUI(TkinterDnD.Tk):
         for path in self.failed_files:
             self.failed_file_redrop(path)
 
+    def send_one(self, filepath, root_dir, base_dir):
+        if self.spreader:
+            # Each file to whichever host is least loaded once the ones before it are counted
+            destination = self.spreader.assign(os.path.getsize(filepath) if os.path.isfile(filepath) else 0)
+            if destination is None:
+                print(f'[{datetime.datetime.now()}] Error sending {filepath}: No host has room for it')
+                file_finished(filepath, False)
+                return 0
+            return send_file(filepath, root_dir, base_dir, *destination)
+        if len(self.destinations) > 1:
+            # Read once, send to every selected host
+            return send_file_fanout(filepath, root_dir, base_dir, self.destinations)
+        return send_file(filepath, root_dir, base_dir, self.host, self.port)
+
     def transfer_file(self, filepath):
-        return send_file(filepath, os.path.dirname(filepath), '', self.host, self.port)
+        return self.send_one(filepath, os.path.dirname(filepath), '')
 
     def transfer_directory(self, directory):
         success = True
         base_dir = os.path.basename(directory)
-        for root, _, files in os.walk(directory):
-            for file in files:
-                if SENT_DATA["canceled"]:
-                    return False
-                full_path = os.path.join(root, file)
-                if not send_file(full_path, directory, base_dir, self.host, self.port):
-                    success = False
+        result = self.scans.get(directory)
+        if result is not None:
+            # The file list from the scan saves walking the tree a second time
+            full_paths = (full_path for full_path, _ in result.files)
+        else:
+            full_paths = (os.path.join(root, file) for root, _, files in os.walk(directory) for file in files)
+        for full_path in full_paths:
+            if self.client.stats["canceled"]:
+                return False
+            if not self.send_one(full_path, directory, base_dir):
+                success = False
         return success
 
     def clear_files(self):
-        self.file_listbox.delete(0, tk.END)
+        self.scanner.cancel()
+        self.scanning.clear()
+        self.scans.clear()
+        self.listed.clear()
+        self.file_listbox.clear()
         self.total_file_size = 0
         self.total_file_count = 0
         self.update_items_label()
 
     def update_items_label(self):
-        num_items = self.total_file_count
-        if self.total_file_size:
-            self.label_text.config(text=f"{num_items} files ({report_data_size(self.total_file_size)})\n ")
-        else:
-            self.label_text.config(text=f"{num_items} files\n ")
-
-    def get_file_size(self, path):
-        total_size = 0
-        if os.path.isdir(path):
-            for dirpath, dirnames, filenames in os.walk(path):
-                for f in filenames:
-                    fp = os.path.join(dirpath, f)
-                    total_size += os.path.getsize(fp)
-                    self.total_file_count += 1
+        num_items = self.total_file_count + sum(result.count for result in self.scanning.values())
+        total_size = self.total_file_size + sum(result.size for result in self.scanning.values())
+        status = "scanning..." if self.scanning else " "
+        if total_size:
+            self.label_text.config(text=f"{num_items} files ({report_data_size(total_size)})\n{status}")
         else:
-            total_size += os.path.getsize(path)
-            self.total_file_count += 1
-        return total_size
+            self.label_text.config(text=f"{num_items} files\n{status}")
 
 
 def main():
-    logfile = None
+    log_file = None
     if is_logging():
         # Open a log file in append mode
         log_file = open("send.log", "a", buffering=1)
@@ -229,20 +426,23 @@ def main():
         print(f'[{datetime.datetime.now()}] <<< NEW SESSION >>>')
 
     parser = argparse.ArgumentParser(description=APP_TITLE)
-    parser.add_argument("--host", help="Host to connect to")
+    parser.add_argument("--host", nargs='+', help="Host(s) to connect to as host or host:port")
     parser.add_argument("--port", type=int, help="Port to connect to")
+    parser.add_argument("--on-conflict", choices=CONFLICT_POLICIES, default='prompt', help="How to settle files that differ from the copy on the host")
     args = parser.parse_args()
 
     if not args.host:
-        args.host = "127.0.0.1"
+        args.host = ["127.0.0.1"]
     if not args.port:
         args.port = 1111
 
-    app = FileTransferGUI(args.host, args.port)
-    SENT_DATA["using_gui"] = True
+    app = FileTransferGUI([parse_destination(host, args.port) for host in args.host], args.on_conflict)
+
+    # Keep the host list warm in the background so the picker opens instantly
+    HOST_REGISTRY.start()
 
     def show_host_list():
-        popup = HostListPopup(app, discover_and_list_hosts())
+        popup = HostListPopup(app, HOST_REGISTRY)
         popup.grab_set()  # Make the popup modal
         popup.wait_window()
 
@@ -251,7 +451,7 @@ def main():
 
     app.mainloop()
 
-    if is_logging():
+    if log_file:
         log_file.close()
 
 
@@ -0,0 +1,348 @@
+""" Load a local receiver with many simultaneous senders and see where it starts to struggle.
+
+    Starts `fileTransfer.py receive` in its own process, then runs stages of synthetic senders
+    against it (threads or processes), each replaying a weighted mix of negotiations: new files,
+    resumes, identical files and conflicts. Reports negotiation latency percentiles, per-connection
+    throughput, errors and the receiver's CPU and memory, and saves it all as JSON so runs of
+    different versions can be compared with --compare.
+"""
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fileTransfer
+from transferIO import ReadAheadFile
+from wireProtocol import PROTOCOL_VERSION
+
+SCENARIOS = ['new', 'resume', 'identical', 'conflict']
+DEFAULT_MIX = 'new=4,resume=2,identical=3,conflict=1'
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def parse_mix(text):
+    """ 'new=4,identical=1' to a {scenario: weight} dict. """
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'unknown scenario {name}, choose from {", ".join(SCENARIOS)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a sorted list, None if it is empty. """
+    if not values:
+        return None
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def plan_operations(senders, files, mix, seed):
+    """ [(rel_path, scenario)] for each sender, the same for the same seed. """
+    names, weights = list(mix), list(mix.values())
+    plans = []
+    for sender in range(senders):
+        rng = random.Random(seed * 7919 + sender)
+        plans.append([(os.path.join('load', f's{sender}', f'{i}-{scenario}.bin'), scenario)
+                      for i, scenario in enumerate(rng.choices(names, weights, k=files))])
+    return plans
+
+
+def seed_receiver(save_dir, plans, source_path, other_path):
+    """ Put what each scenario expects on the receiver's side before it starts. """
+    size = os.path.getsize(source_path)
+    mtime = os.path.getmtime(source_path)
+    for plan in plans:
+        for rel_path, scenario in plan:
+            path = os.path.join(save_dir, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if scenario == 'identical':
+                shutil.copyfile(source_path, path)
+                os.utime(path, (mtime, mtime))
+            elif scenario == 'resume':
+                with open(source_path, 'rb') as src, open(path, 'wb') as dst:
+                    dst.write(src.read(size // 2))
+            elif scenario == 'conflict':
+                shutil.copyfile(other_path, path)
+
+
+def run_sender(sender, plan, source_path, host, port, protocol, start_at):
+    """ Replay one sender's plan, a connection per file. Returns a record per operation. """
+    client = fileTransfer.TransferClient(conflict_policy='overwrite', protocol=protocol)
+    file_size = os.path.getsize(source_path)
+    records = []
+
+    def replay():
+        time.sleep(max(0, start_at - time.time()))
+        for rel_path, scenario in plan:
+            record = {'sender': sender, 'scenario': scenario, 'start': time.time() - start_at, 'ok': False,
+                      'negotiation': None, 'bytes': 0, 'seconds': 0.0, 'error': None}
+            records.append(record)
+            try:
+                begin = time.perf_counter()
+                ch = fileTransfer.open_channel(host, port)
+                with ch.sock:
+                    outcome, offset = fileTransfer.negotiate_send(ch, source_path, rel_path, rel_path, file_size)
+                    record['negotiation'] = time.perf_counter() - begin
+                    if outcome == 'send':
+                        begin = time.perf_counter()
+                        with ReadAheadFile(source_path, offset or 0, fileTransfer.BUFFER_SIZE, 0) as file:
+                            for chunk in file:
+                                ch.sock.sendall(chunk)
+                                record['bytes'] += len(chunk)
+                        record['seconds'] = time.perf_counter() - begin
+                    elif outcome != 'done':
+                        raise ConnectionError(f'negotiation {outcome}')
+                record['ok'] = True
+            except Exception as e:
+                record['error'] = f'{type(e).__name__}: {e}'
+
+    client.run(replay)
+    return records
+
+
+def run_sender_args(args):
+    # A process of its own, so silencing its stdout touches no other sender
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return run_sender(*args)
+
+
+def read_proc_usage(pid):
+    """ (cpu seconds, resident bytes) of a process from /proc, None where that isn't available. """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+    except (OSError, StopIteration, IndexError, ValueError):
+        return None
+    # utime and stime are the 12th and 13th fields after the command name
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), rss
+
+
+class ReceiverMonitor:
+    """ Samples the receiver's CPU use and memory on a background thread. """
+    def __init__(self, pid, interval):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []   # (seconds since start, cpu percent, rss bytes)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _sample(self):
+        start = last_time = time.monotonic()
+        last = read_proc_usage(self.pid)
+        while last and not self.stopped.wait(self.interval):
+            now, usage = time.monotonic(), read_proc_usage(self.pid)
+            if usage is None:
+                return
+            cpu = (usage[0] - last[0]) / (now - last_time) * 100
+            self.samples.append((round(now - start, 3), round(cpu, 1), usage[1]))
+            last, last_time = usage, now
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.samples
+
+
+def start_receiver(save_dir, port, log_path):
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fileTransfer.py'), 'receive',
+           '--port', str(port), '--savedir', save_dir, '--overwrite', '--on-conflict', 'overwrite']
+    log = open(log_path, 'w') if log_path else subprocess.DEVNULL
+    process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('The receiver did not start listening, run it with --receiver-log to see why')
+
+
+def summarize(records, samples, wall):
+    """ The figures reported for one stage. """
+    latencies = sorted(r['negotiation'] for r in records if r['negotiation'] is not None)
+    rates = sorted(r['bytes'] / r['seconds'] for r in records if r['ok'] and r['seconds'] > 0)
+    errors = [r for r in records if not r['ok']]
+    cpu = [s[1] for s in samples]
+    rss = [s[2] for s in samples]
+    summary = {
+        'operations': len(records),
+        'errors': len(errors),
+        'error_rate': len(errors) / len(records) if records else 0,
+        'wall_seconds': wall,
+        'operations_per_second': len(records) / wall if wall else 0,
+        'bytes_sent': sum(r['bytes'] for r in records),
+        'negotiation_ms': {f'p{p}': (percentile(latencies, p) or 0) * 1000 for p in (50, 95, 99)},
+        'connection_mb_per_s': {'p50': (percentile(rates, 50) or 0) / 1e6, 'p5': (percentile(rates, 5) or 0) / 1e6},
+        'receiver_cpu_percent': {'mean': sum(cpu) / len(cpu) if cpu else None, 'max': max(cpu, default=None)},
+        'receiver_rss_mb': {'max': max(rss) / 1e6 if rss else None},
+        'scenarios': {},
+        'error_samples': sorted({r['error'] for r in errors})[:5],
+    }
+    for scenario in SCENARIOS:
+        chosen = sorted(r['negotiation'] for r in records if r['scenario'] == scenario and r['negotiation'] is not None)
+        if chosen:
+            summary['scenarios'][scenario] = {'operations': sum(r['scenario'] == scenario for r in records),
+                                              **{f'p{p}_ms': percentile(chosen, p) * 1000 for p in (50, 95, 99)}}
+    summary['throughput_mb_per_s'] = summary['bytes_sent'] / wall / 1e6 if wall else 0
+    return summary
+
+
+def run_stage(senders, args, mix, source_path, other_path):
+    work_dir = tempfile.mkdtemp(prefix='loadtest-')
+    save_dir = os.path.join(work_dir, 'save')
+    plans = plan_operations(senders, args.files, mix, args.seed)
+    seed_receiver(save_dir, plans, source_path, other_path)
+    port = free_port()
+    receiver = start_receiver(save_dir, port, args.receiver_log)
+    monitor = ReceiverMonitor(receiver.pid, args.sample_interval)
+    try:
+        monitor.start()
+        # Everybody starts at once, after the threads or processes are up
+        start_at = time.time() + 0.5 + senders * (0.02 if args.processes else 0.002)
+        jobs = [(sender, plan, source_path, '127.0.0.1', port, args.protocol, start_at) for sender, plan in enumerate(plans)]
+        if args.processes:
+            with multiprocessing.Pool(senders) as pool:
+                results = pool.map(run_sender_args, jobs)
+        else:
+            results = [None] * senders
+            threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, run_sender(*jobs[i])))
+                       for i in range(senders)]
+            # The per-file log would bury the results. sys.stdout is shared by every thread, so it
+            # is swapped once around the whole pool rather than by each sender.
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        wall = time.time() - start_at
+        # Let the receiver finish writing what was sent last
+        time.sleep(args.sample_interval * 2)
+    finally:
+        samples = monitor.stop()
+        receiver.terminate()
+        receiver.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    records = [record for sender_records in results for record in sender_records]
+    stage = {'senders': senders, **summarize(records, samples, wall), 'receiver_samples': samples}
+    if args.keep_records:
+        stage['records'] = records
+    return stage
+
+
+def code_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return f'protocol {PROTOCOL_VERSION}'
+
+
+def print_stages(stages, baseline=None):
+    base = {stage['senders']: stage for stage in (baseline or {}).get('stages', [])}
+    print(f'{"senders":>7}{"ops":>7}{"errors":>8}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}'
+          f'{"conn MB/s":>11}{"total MB/s":>12}{"cpu % avg/max":>15}{"rss MB":>8}')
+    for stage in stages:
+        cpu = stage['receiver_cpu_percent']
+        cpu_text = f'{cpu["mean"]:.0f}/{cpu["max"]:.0f}' if cpu['mean'] is not None else '-'
+        rss = stage['receiver_rss_mb']['max']
+        latency = stage['negotiation_ms']
+        print(f'{stage["senders"]:>7}{stage["operations"]:>7}{stage["error_rate"]:>8.1%}'
+              f'{latency["p50"]:>9.2f}{latency["p95"]:>9.2f}{latency["p99"]:>9.2f}'
+              f'{stage["connection_mb_per_s"]["p50"]:>11.1f}{stage["throughput_mb_per_s"]:>12.1f}'
+              f'{cpu_text:>15}{(f"{rss:.0f}" if rss else "-"):>8}')
+        old = base.get(stage['senders'])
+        if old:
+            print(f'{"vs base":>7}{"":>7}{stage["error_rate"] - old["error_rate"]:>+8.1%}'
+                  + ''.join(f'{latency[p] / old["negotiation_ms"][p] - 1 if old["negotiation_ms"][p] else 0:>+9.0%}'
+                            for p in ('p50', 'p95', 'p99'))
+                  + f'{stage["throughput_mb_per_s"] / old["throughput_mb_per_s"] - 1 if old["throughput_mb_per_s"] else 0:>+23.0%}')
+        for error in stage['error_samples']:
+            print(f'{"":>14}{error}')
+    print()
+    for stage in stages:
+        print(f'{stage["senders"]} sender(s): ' + ', '.join(
+            f'{name} {s["p50_ms"]:.2f}/{s["p95_ms"]:.2f}/{s["p99_ms"]:.2f} ms' for name, s in stage['scenarios'].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Receiver load test')
+    parser.add_argument('--senders', default='1,4,16,64',
+                        help='Comma separated numbers of simultaneous senders, one stage each (default 1,4,16,64)')
+    parser.add_argument('--files', type=int, default=20, help='Files each sender negotiates per stage (default 20)')
+    parser.add_argument('--file-size', type=int, default=1 << 20, help='Size of each file in bytes (default 1 MiB)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'Weights of the negotiation scenarios (default {DEFAULT_MIX})')
+    parser.add_argument('--processes', action='store_true', help='Run each sender in its own process instead of a thread')
+    parser.add_argument('--protocol', choices=['1', '2'], default='2', help='Wire protocol version (default 2)')
+    parser.add_argument('--sample-interval', type=float, default=0.25,
+                        help='Seconds between receiver CPU and memory samples (default 0.25)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the scenario mix (default 1)')
+    parser.add_argument('--output', help='Save the results here (default loadtest-<time>.json)')
+    parser.add_argument('--compare', metavar='JSON', help='Results of an earlier run to compare against')
+    parser.add_argument('--keep-records', action='store_true', help='Save every operation, not just the summaries')
+    parser.add_argument('--receiver-log', metavar='PATH', help="Write the receiver's output here")
+    args = parser.parse_args()
+    stage_senders = [int(n) for n in args.senders.split(',')]
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    source_dir = tempfile.mkdtemp(prefix='loadtest-src-')
+    try:
+        source_path = os.path.join(source_dir, 'source.bin')
+        other_path = os.path.join(source_dir, 'other.bin')
+        for path in (source_path, other_path):
+            with open(path, 'wb') as f:
+                f.write(os.urandom(args.file_size))
+        stages = []
+        for senders in stage_senders:
+            print(f'[{time.strftime("%H:%M:%S")}] {senders} sender(s) x {args.files} file(s)...', flush=True)
+            stages.append(run_stage(senders, args, args.mix, source_path, other_path))
+    finally:
+        shutil.rmtree(source_dir, ignore_errors=True)
+
+    results = {'version': code_version(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'config': {'files': args.files, 'file_size': args.file_size, 'mix': args.mix, 'protocol': args.protocol,
+                          'senders': 'processes' if args.processes else 'threads', 'seed': args.seed},
+               'stages': stages}
+    output = args.output or f'loadtest-{time.strftime("%Y%m%d-%H%M%S")}.json'
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=1)
+
+    print(f'\n{results["version"]}: {args.files} x {args.file_size} byte file(s) per sender, '
+          f'{results["config"]["senders"]}, protocol v{args.protocol}'
+          + (f', compared with {baseline["version"]}' if baseline else '') + '\n')
+    print_stages(stages, baseline)
+    print(f'\nSaved to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import subprocess
+
 import netifaces as ni
 
 
@@ -22,6 +24,42 @@ def GetNetInfo():
     return get_ip_and_subnet(get_default_interface())
 
 
+def get_ipv4_interfaces(include_loopback=False):
+    """ List (interface, ip, netmask) for every IPv4 address on this machine. """
+    addresses = []
+    for interface in ni.interfaces():
+        for addr in ni.ifaddresses(interface).get(ni.AF_INET, []):
+            ip = addr.get('addr')
+            netmask = addr.get('netmask')
+            if not ip or not netmask:
+                continue
+            if ip.startswith('127.') and not include_loopback:
+                continue
+            addresses.append((interface, ip, netmask))
+    return addresses
+
+
+def interface_of(ip):
+    """ Name of the interface holding a local IPv4 address, None if none does. """
+    for interface, addr, _ in get_ipv4_interfaces(include_loopback=True):
+        if addr == ip:
+            return interface
+    return None
+
+
+def route_interface(dest, source=None):
+    """ Interface the kernel sends traffic for dest (from source) through, None where it won't say.
+
+        Asks iproute2, so policy routing rules are taken into account. Linux only.
+    """
+    cmd = ['ip', 'route', 'get', dest] + (['from', source] if source else [])
+    try:
+        fields = subprocess.run(cmd, capture_output=True, text=True, timeout=2, check=True).stdout.split()
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return fields[fields.index('dev') + 1] if 'dev' in fields[:-1] else None
+
+
 if __name__ == "__main__":
     default_interface = get_default_interface()
     ip_address, subnet_mask = get_ip_and_subnet(default_interface)
@@ -31,4 +69,7 @@ if __name__ == "__main__":
         print(f"IP Address: {ip_address}")
         print(f"Subnet Mask: {subnet_mask}")
     else:
-        print("Could not retrieve IP address and subnet mask.")
\ No newline at end of file
+        print("Could not retrieve IP address and subnet mask.")
+
+    for interface, ip, netmask in get_ipv4_interfaces():
+        print(f"  {interface}: {ip}/{netmask}")
@@ -0,0 +1,91 @@
+import os
+import queue
+import threading
+
+
+class ScanResult:
+    """ Every file found under one picked path, with its size, kept for the transfer phase.
+
+        The scanner fills it in on its own thread, so count and size can be read at any
+        time for a running total and done says when they are final.
+    """
+    def __init__(self, path, generation):
+        self.path = path
+        self.generation = generation
+        self.is_dir = False
+        self.files = []     # (file path, size) in the order they will be sent
+        self.size = 0
+        self.done = False
+
+    @property
+    def count(self):
+        return len(self.files)
+
+
+class PathScanner:
+    """ Walks picked files and directories on a background thread so a huge tree never blocks the GUI.
+
+        cancel() stops the scan in progress and every one still queued, their results
+        are left unfinished and should be thrown away.
+    """
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.generation = 0
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def scan(self, path):
+        """ Queue path for scanning, returns the ScanResult it will fill in. """
+        result = ScanResult(path, self.generation)
+        self.requests.put(result)
+        return result
+
+    def cancel(self):
+        self.generation += 1
+
+    def canceled(self, result):
+        return result.generation != self.generation
+
+    def _worker(self):
+        while True:
+            result = self.requests.get()
+            if self.canceled(result):
+                continue
+            try:
+                self._scan(result)
+            except OSError as e:
+                print(f'Could not scan {result.path}: {e}')
+            result.done = not self.canceled(result)
+
+    def _scan(self, result):
+        if not os.path.isdir(result.path):
+            self._add(result, result.path, os.path.getsize(result.path))
+            return
+        result.is_dir = True
+        # Files of each directory come before its subdirectories, as os.walk lists them
+        pending = [result.path]
+        while pending:
+            if self.canceled(result):
+                return
+            directory = pending.pop()
+            subdirs = []
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            # Symlinked directories are listed but not followed, like os.walk
+                            if entry.is_dir():
+                                if not entry.is_symlink():
+                                    subdirs.append(entry.path)
+                            else:
+                                self._add(result, entry.path, entry.stat().st_size)
+                        except OSError:
+                            pass    # vanished or unreadable, the transfer will report it
+            except OSError:
+                continue
+            pending.extend(reversed(subdirs))
+
+    @staticmethod
+    def _add(result, file_path, size):
+        result.files.append((file_path, size))
+        result.size += size
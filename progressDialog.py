@@ -2,7 +2,7 @@ import os
 import tkinter as tk
 import tkinter.ttk as ttk
 from threading import Thread
-from fileTransfer import SENT_DATA
+from fileTransfer import CONFLICT_RESPONSES
 
 
 def report_data_size(size):
@@ -48,17 +48,24 @@ class FileConflictDialog(tk.Toplevel):
         skip_button = ttk.Button(button_frame, text="Skip", command=lambda: self.set_choice('S'))
         skip_button.grid(row=0, column=2, padx=5)
 
+        # Apply the choice to every remaining conflict in this batch
+        self.apply_all_var = tk.BooleanVar(value=False)
+        apply_all_checkbox = tk.Checkbutton(self, text="Apply to all remaining", variable=self.apply_all_var)
+        apply_all_checkbox.pack(pady=(0, 10))
+
         self.geometry(f"+{x}+{y}")
 
     def set_choice(self, choice):
-        self.user_choice = choice
+        self.user_choice = f"{choice}!" if self.apply_all_var.get() else choice
         self.destroy()
 
 
 class ProgressDialog(tk.Toplevel):
-    def __init__(self, parent, filepaths, totalcount, totalsize, host, port, send_file, send_dir):
+    def __init__(self, parent, client, filepaths, totalcount, totalsize, host, port, send_file, send_dir):
         super().__init__(parent)
         self.parent = parent
+        self.client = client
+        self.stats = client.stats
         x = parent.winfo_x() + 185
         y = parent.winfo_y() + 185
         self.filepaths = filepaths
@@ -85,16 +92,17 @@ class ProgressDialog(tk.Toplevel):
         self.stats_frame = tk.Frame(self)
         self.stats_frame.pack(fill=tk.X, padx=20, pady=3)
 
-        self.files_label = tk.Label(self.stats_frame, text=f"files: {SENT_DATA['processed_files']}/{self.filecount}")
+        self.files_label = tk.Label(self.stats_frame, text=f"files: {self.stats['processed_files']}/{self.filecount}")
         self.files_label.pack(side=tk.LEFT)
 
-        self.data_label = tk.Label(self.stats_frame, text=f"{report_data_size(SENT_DATA['bytesSent'])} / {self.totalsize_readable}")
+        self.data_label = tk.Label(self.stats_frame, text=f"{report_data_size(self.stats['bytesSent'])} / {self.totalsize_readable}")
         self.data_label.pack(side=tk.RIGHT)
 
         self.cancel_button = tk.Button(self, text="Cancel", command=self.cancel_transfer)
         self.cancel_button.pack(pady=10)
 
-        self.transfer_thread = Thread(target=self.perform_transfer)
+        # Sends as the client, whose counters and conflict prompts this dialog follows
+        self.transfer_thread = Thread(target=self.client.run, args=(self.perform_transfer,))
         self.transfer_thread.start()
 
         self.geometry(f"+{x}+{y}")
@@ -102,22 +110,22 @@ class ProgressDialog(tk.Toplevel):
         self.update_progress()
 
     def update_progress(self):
-        if SENT_DATA["gui_response"] == "NEEDED":
-            (file_name, remote_size, local_size) = SENT_DATA["file_info"]
-            while SENT_DATA["gui_response"] not in ['O', 'B', 'S']:
+        if self.stats["gui_response"] == "NEEDED":
+            (file_name, remote_size, local_size) = self.stats["file_info"]
+            while self.stats["gui_response"] not in CONFLICT_RESPONSES:
                 user_prompt = FileConflictDialog(self, file_name, remote_size, local_size)
                 user_prompt.grab_set()  # Make the popup modal
                 user_prompt.wait_window()
-                SENT_DATA["gui_response"] = user_prompt.user_choice
+                self.stats["gui_response"] = user_prompt.user_choice
 
-        self.prog_metric1 = (SENT_DATA["processed_files"] / (self.filecount-(1* self.filecount > 1))) * 100 if self.filecount > 1 else 100
-        self.prog_metric2 = (SENT_DATA["bytesSent"] / self.totalsize) * 100 if self.totalsize > 0 else 100
+        self.prog_metric1 = (self.stats["processed_files"] / (self.filecount-(1* self.filecount > 1))) * 100 if self.filecount > 1 else 100
+        self.prog_metric2 = (self.stats["bytesSent"] / self.totalsize) * 100 if self.totalsize > 0 else 100
         max_metric = max(self.prog_metric1, self.prog_metric2)
         self.progress = (self.prog_metric1 + self.prog_metric2)/2 if max_metric < 90 else max_metric
 
         self.progressbar["value"] = self.progress
-        self.files_label["text"] = f"files: {SENT_DATA['processed_files']}/{self.filecount}"
-        self.data_label["text"] = f"{report_data_size(SENT_DATA['bytesSent'])} / {self.totalsize_readable}"
+        self.files_label["text"] = f"files: {self.stats['processed_files']}/{self.filecount}"
+        self.data_label["text"] = f"{report_data_size(self.stats['bytesSent'])} / {self.totalsize_readable}"
         self.after(100, self.update_progress)
 
     def perform_transfer(self):
@@ -143,5 +151,5 @@ class ProgressDialog(tk.Toplevel):
 
     def cancel_transfer(self):
         self.cancelled = True
-        SENT_DATA["canceled"] = True
-        SENT_DATA["failed_files"] += self.filecount - (SENT_DATA["processed_files"] + 1)  # fail the rest of the files in list
+        self.client.cancel()
+        self.stats["failed_files"] += self.filecount - (self.stats["processed_files"] + 1)  # fail the rest of the files in list
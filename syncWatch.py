@@ -0,0 +1,227 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+DEBOUNCE = 1.0          # a batch goes out once nothing has changed for this long...
+MAX_BATCH_DELAY = 10    # ...or this long after its first change, whichever comes first
+POLL_INTERVAL = 2       # seconds between directory scans when inotify is unavailable
+
+# linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+             IN_DELETE_SELF
+EVENT = struct.Struct('iIII')   # wd, mask, cookie, name length
+
+
+def scan_tree(directory):
+    """ Index every file under directory as {relative path: (size, mtime_ns)}. """
+    index = {}
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            entries = os.scandir(os.path.join(directory, rel_dir))
+        except OSError:
+            continue    # removed or unreadable since we saw it
+        with entries:
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name)
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(rel_path)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        index[rel_path] = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue
+    return index
+
+
+def diff_index(old, new):
+    """ Relative paths that are new or changed in new, and those gone since old. """
+    changed = [path for path, stat in new.items() if old.get(path) != stat]
+    removed = [path for path in old if path not in new]
+    return changed, removed
+
+
+def rescan_paths(directory, paths, index):
+    """ Re-check only these relative paths, returns their current index entries and what is gone from index. """
+    current = {}
+    removed = set()
+    for rel_path in paths:
+        full_path = os.path.join(directory, rel_path)
+        if os.path.isdir(full_path):
+            for sub_path, stat in scan_tree(full_path).items():
+                current[os.path.join(rel_path, sub_path)] = stat
+            prefix = rel_path + os.sep
+            removed.update(p for p in index if p.startswith(prefix) and p not in current)
+            continue
+        try:
+            st = os.stat(full_path)
+            if os.path.isfile(full_path):
+                current[rel_path] = (st.st_size, st.st_mtime_ns)
+                continue
+        except OSError:
+            pass
+        if rel_path in index:
+            removed.add(rel_path)
+        else:
+            # Possibly a directory that was moved away or deleted
+            prefix = rel_path + os.sep
+            removed.update(p for p in index if p.startswith(prefix))
+    return current, removed
+
+
+class PollingWatcher:
+    """ Finds changes by rescanning the tree every POLL_INTERVAL seconds. """
+    def __init__(self, directory, interval=POLL_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.index = scan_tree(directory)
+        self.next_scan = time.monotonic() + interval
+
+    def poll(self, timeout):
+        """ Wait up to timeout for changes, returns the set of relative paths that may have changed. """
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0, wait))
+        self.next_scan = time.monotonic() + self.interval
+        index = scan_tree(self.directory)
+        changed, removed = diff_index(self.index, index)
+        self.index = index
+        return set(changed) | set(removed)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """ Linux inotify through ctypes, one watch per directory in the tree.
+
+        poll() returns None when the kernel queue overflowed and events were lost,
+        the caller should rescan everything then.
+    """
+    def __init__(self, directory):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directory = directory
+        self.watches = {}   # watch descriptor -> relative directory
+        self.add_tree('')
+
+    def add_tree(self, rel_dir):
+        """ Watch rel_dir and every directory under it, returns the files found there. """
+        found = set()
+        stack = [rel_dir]
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(self.directory, rel)
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                continue    # gone already, or out of watches
+            self.watches[wd] = rel
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(os.path.join(rel, entry.name))
+                        else:
+                            found.add(os.path.join(rel, entry.name))
+            except OSError:
+                continue
+        return found
+
+    def poll(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return set()
+            raise
+        changed = set()
+        overflow = False
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, pos)
+            name = data[pos + EVENT.size:pos + EVENT.size + length].rstrip(b'\0')
+            pos += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            rel_dir = self.watches.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            if not name:
+                continue
+            rel_path = os.path.join(rel_dir, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files can land in a new directory before its watch is in place
+                    changed |= self.add_tree(rel_path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    changed.add(rel_path)
+            else:
+                changed.add(rel_path)
+        return None if overflow else changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(directory):
+    """ inotify where we have it, directory scans everywhere else. """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(directory)
+
+
+def watch_batches(watcher, stop, debounce=DEBOUNCE, max_delay=MAX_BATCH_DELAY, due=None):
+    """ Yield sets of relative paths that may have changed, once each burst of changes settles.
+
+        A batch of None means events were lost and the whole tree needs checking. due may return
+        the time.monotonic() at which the caller wants another go at what it is holding back,
+        an empty batch is yielded then even if nothing changed.
+    """
+    while not stop():
+        deadline = due() if due else None
+        if deadline is not None and time.monotonic() >= deadline:
+            yield set()
+            continue
+        batch = watcher.poll(1.0 if deadline is None else min(1.0, deadline - time.monotonic()))
+        if batch is not None and not batch:
+            continue
+        first_change = time.monotonic()
+        while not stop() and time.monotonic() - first_change < max_delay:
+            more = watcher.poll(debounce)
+            if more is not None and not more:
+                break
+            batch = None if batch is None or more is None else batch | more
+        yield batch
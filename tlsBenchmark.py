@@ -0,0 +1,99 @@
+""" Measure what TLS costs over plaintext, sending to a receiver on this machine.
+
+    Runs the same batch of small files and one large file in plaintext, over TLS with a full
+    handshake per connection, and over TLS resuming sessions, then prints the time each took.
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import fileTransfer
+from tlsTransport import TlsClient, ensure_certificate, make_server_context, preferred_ciphers
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_files(directory, small_files, small_size, large_size):
+    small_dir = os.path.join(directory, 'small')
+    os.makedirs(small_dir)
+    for i in range(small_files):
+        with open(os.path.join(small_dir, f'file{i}.bin'), 'wb') as f:
+            f.write(os.urandom(small_size))
+    large_path = os.path.join(directory, 'large.bin')
+    with open(large_path, 'wb') as f:
+        for _ in range(large_size >> 20):
+            f.write(os.urandom(1 << 20))
+    return small_dir, large_path
+
+
+def run(label, small_dir, large_path, server_context, client):
+    save_dir = tempfile.mkdtemp(prefix='tlsbench-')
+    port = free_port()
+    fileTransfer.RECV_DATA["canceled"] = False
+    fileTransfer.RECV_DATA["tls"] = None
+    fileTransfer.SENT_DATA["tls"] = client
+    receiver = threading.Thread(target=fileTransfer.receive_files, args=(save_dir, port), kwargs={'tls': server_context})
+    # The per-file log would bury the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        receiver.start()
+        time.sleep(0.5)
+        try:
+            start = time.perf_counter()
+            fileTransfer.send_directory(small_dir, '127.0.0.1', port)
+            small_time = time.perf_counter() - start
+            start = time.perf_counter()
+            fileTransfer.send_file(large_path, os.path.dirname(large_path), '', '127.0.0.1', port)
+            large_time = time.perf_counter() - start
+        finally:
+            fileTransfer.RECV_DATA["canceled"] = True
+            receiver.join()
+            shutil.rmtree(save_dir, ignore_errors=True)
+    resumed = f'{client.resumed}/{client.handshakes}' if client else '-'
+    return label, small_time, large_time, resumed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TLS overhead benchmark')
+    parser.add_argument('--small-files', type=int, default=500, help='Number of small files (default 500)')
+    parser.add_argument('--small-size', type=int, default=4096, help='Size of each small file in bytes (default 4096)')
+    parser.add_argument('--large-mb', type=int, default=256, help='Size of the large file in MB (default 256)')
+    parser.add_argument('--protocol', choices=['1', '2'], default='2', help='Wire protocol version (default 2)')
+    args = parser.parse_args()
+
+    fileTransfer.SENT_DATA["protocol"] = args.protocol
+    fileTransfer.SENT_DATA["conflict_policy"] = 'overwrite'
+    work_dir = tempfile.mkdtemp(prefix='tlsbench-src-')
+    cert_path, key_path = ensure_certificate()
+    server_context = make_server_context(cert_path, key_path)
+    known_path = os.path.join(work_dir, 'known.json')
+    try:
+        small_dir, large_path = make_files(work_dir, args.small_files, args.small_size, args.large_mb << 20)
+        results = [run('plaintext', small_dir, large_path, None, None),
+                   run('tls, full handshakes', small_dir, large_path, server_context,
+                       TlsClient(known_path=known_path, resume=False)),
+                   run('tls, resumed sessions', small_dir, large_path, server_context,
+                       TlsClient(known_path=known_path))]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    base_small, base_large = results[0][1], results[0][2]
+    print(f'\nTLS 1.2 cipher preference: {preferred_ciphers()}')
+    print(f'{args.small_files} x {args.small_size} byte files, one {args.large_mb} MB file, protocol v{args.protocol}\n')
+    print(f'{"":24}{"small files":>22}{"large file":>22}{"resumed":>10}')
+    for label, small_time, large_time, resumed in results:
+        print(f'{label:24}{small_time:9.2f} s ({small_time / base_small - 1:+6.1%})'
+              f'{args.large_mb / large_time:9.1f} MB/s ({large_time / base_large - 1:+6.1%}){resumed:>10}')
+
+
+if __name__ == '__main__':
+    main()
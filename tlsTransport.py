@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import platform
+import socket
+import ssl
+import subprocess
+import threading
+
+TLS_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'NetworkFileCopyNinja')
+KNOWN_RECEIVERS = os.path.join(TLS_DIR, 'tls-known-receivers.json')
+TLS_HANDSHAKE_TIMEOUT = 10
+# TLS 1.2 suites, AES-GCM first where the CPU accelerates it and ChaCha20 first everywhere else.
+# Python can't reorder the TLS 1.3 suites, OpenSSL's default order applies to those.
+AES_CIPHERS = 'ECDHE+AESGCM:ECDHE+CHACHA20'
+CHACHA_CIPHERS = 'ECDHE+CHACHA20:ECDHE+AESGCM'
+
+
+def cpu_has_aes():
+    """ True if the CPU has AES instructions, which make AES-GCM faster than ChaCha20. """
+    try:
+        with open('/proc/cpuinfo') as f:
+            # x86 lists it under 'flags', ARM under 'Features'
+            return 'aes' in f.read().split()
+    except OSError:
+        pass
+    # Every current x86-64 and ARM64 desktop CPU has them
+    return platform.machine().lower() in ('x86_64', 'amd64', 'arm64', 'aarch64')
+
+
+def preferred_ciphers():
+    return AES_CIPHERS if cpu_has_aes() else CHACHA_CIPHERS
+
+
+def fingerprint(der_cert):
+    return 'sha256:' + hashlib.sha256(der_cert).hexdigest()
+
+
+def normalize_fingerprint(text):
+    """ Accept 'sha256:ab12..', 'AB:12:..' or bare hex for a pinned fingerprint. """
+    text = text.strip().lower()
+    if text.startswith('sha256:'):
+        text = text[len('sha256:'):]
+    return 'sha256:' + text.replace(':', '')
+
+
+def certificate_fingerprint(cert_path):
+    with open(cert_path, 'r') as f:
+        return fingerprint(ssl.PEM_cert_to_DER_cert(f.read()))
+
+
+def ensure_certificate(cert_path=None, key_path=None):
+    """ Paths to the receiver's certificate and key, generating a self-signed pair on first use. """
+    if cert_path:
+        return cert_path, key_path or cert_path
+    cert_path = os.path.join(TLS_DIR, 'tls-cert.pem')
+    key_path = os.path.join(TLS_DIR, 'tls-key.pem')
+    if os.path.exists(cert_path) and os.path.exists(key_path):
+        return cert_path, key_path
+    os.makedirs(TLS_DIR, mode=0o700, exist_ok=True)
+    # The ssl module can't make certificates, but the openssl tool is there wherever it was built
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                        '-nodes', '-days', '3650', '-subj', f'/CN={socket.gethostname()}',
+                        '-keyout', key_path, '-out', cert_path], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RuntimeError(f"Could not generate a TLS certificate ({e}), pass --tls-cert and --tls-key instead")
+    os.chmod(key_path, 0o600)
+    return cert_path, key_path
+
+
+def make_server_context(cert_path, key_path):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_path, key_path)
+    context.set_ciphers(preferred_ciphers())
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    return context
+
+
+def accept_tls(context, conn):
+    """ Run the server side of the handshake on an accepted connection. """
+    conn.settimeout(TLS_HANDSHAKE_TIMEOUT)
+    tls_conn = context.wrap_socket(conn, server_side=True)
+    tls_conn.settimeout(None)
+    return tls_conn
+
+
+def tls_pending(sock):
+    """ Bytes already decrypted and buffered on a TLS socket, which select() can't see. """
+    return sock.pending() if isinstance(sock, ssl.SSLSocket) else 0
+
+
+def idle_but_open(sock):
+    """ For an idle socket that select() reports readable: True if that was only TLS housekeeping
+        such as session tickets, False if the peer hung up.
+    """
+    if not isinstance(sock, ssl.SSLSocket):
+        return False
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        sock.recv(1)
+        return False
+    except ssl.SSLWantReadError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+class ResumableSSLSocket(ssl.SSLSocket):
+    """ Hands its session back to the TlsClient when closed, for the next connection to resume. """
+    tls_client = None
+    session_key = None
+
+    def close(self):
+        if self.tls_client is not None:
+            self.tls_client.remember(self.session_key, self)
+            self.tls_client = None
+        super().close()
+
+
+class TlsClient:
+    """ Sender side of TLS: checks each receiver's certificate and resumes sessions with it.
+
+        Receivers use self-signed certificates, so instead of a CA chain the certificate is
+        checked against a pinned fingerprint, or trusted on first use and remembered in
+        known_path. The connection-per-file design means a full handshake for every file,
+        so sessions are kept per receiver and resumed on the next connection.
+    """
+    def __init__(self, pin=None, known_path=KNOWN_RECEIVERS, resume=True):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE   # checked against the pin instead
+        self.context.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.context.set_ciphers(preferred_ciphers())
+        self.context.sslsocket_class = ResumableSSLSocket
+        self.pin = normalize_fingerprint(pin) if pin else None
+        self.known_path = known_path
+        self.resume = resume
+        self.lock = threading.Lock()
+        self.sessions = {}      # "host:port" -> SSLSession to resume
+        self.handshakes = 0
+        self.resumed = 0
+        try:
+            with open(known_path, 'r', encoding='utf-8') as f:
+                self.known = json.load(f)
+        except (OSError, ValueError):
+            self.known = {}
+
+    def wrap(self, sock, host, port):
+        """ Run the client handshake on a connected socket, returns the TLS socket. """
+        key = f"{host}:{port}"
+        with self.lock:
+            session = self.sessions.get(key) if self.resume else None
+        timeout = sock.gettimeout()
+        sock.settimeout(TLS_HANDSHAKE_TIMEOUT)
+        tls_sock = self.context.wrap_socket(sock, session=session)
+        tls_sock.settimeout(timeout)
+        try:
+            self.check_certificate(key, tls_sock.getpeercert(binary_form=True))
+        except Exception:
+            tls_sock.close()
+            raise
+        tls_sock.tls_client = self
+        tls_sock.session_key = key
+        with self.lock:
+            self.handshakes += 1
+            if tls_sock.session_reused:
+                self.resumed += 1
+        return tls_sock
+
+    def check_certificate(self, key, der_cert):
+        found = fingerprint(der_cert)
+        if self.pin:
+            if found != self.pin:
+                raise ssl.SSLCertVerificationError(f"{key} presented certificate {found}, not the pinned {self.pin}")
+            return
+        with self.lock:
+            known = self.known.get(key)
+            if known is None:
+                print(f'Trusting the certificate of {key} on first use: {found}')
+                self.known[key] = found
+                self.save_known()
+            elif known != found:
+                raise ssl.SSLCertVerificationError(
+                    f"The certificate of {key} changed to {found}, remove it from {self.known_path} if that is expected")
+
+    def save_known(self):
+        try:
+            os.makedirs(os.path.dirname(self.known_path), mode=0o700, exist_ok=True)
+            tmp_path = self.known_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.known, f, indent=1)
+            os.replace(tmp_path, self.known_path)
+        except OSError as e:
+            print(f'Could not save known receivers: {e}')
+
+    def remember(self, key, tls_sock):
+        # TLS 1.3 sessions are only resumable once the server's ticket has arrived
+        session = tls_sock.session
+        if self.resume and session is not None and (session.has_ticket or tls_sock.version() != 'TLSv1.3'):
+            with self.lock:
+                self.sessions[key] = session
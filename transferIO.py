@@ -0,0 +1,721 @@
+import errno
+import mmap
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+WRITE_QUEUE_DEPTH = 64          # buffers held between the socket and the disk
+DIRECT_ALIGN = 4096             # O_DIRECT offsets, sizes and buffers are multiples of this
+DIRECT_WRITE_SIZE = 1 << 20     # receivers stage O_DIRECT writes in aligned buffers of this size
+FSYNC_MODES = ['none', 'file', 'batch']
+FSYNC_BATCH_FILES = 64          # batched fsync flushes after this many files...
+FSYNC_BATCH_BYTES = 256 << 20   # ...or this many bytes, whichever comes first...
+FSYNC_BATCH_IDLE = 2.0          # ...or once no file has joined it for this many seconds
+
+
+def preallocate(fd, offset, length):
+    """ Reserve disk space for length bytes at offset, where the platform supports it. """
+    if length <= 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fd, offset, length)
+        return True
+    except OSError:
+        # Not supported by this filesystem, the writes will allocate as they go
+        return False
+
+
+def fsync_path(path):
+    try:
+        with open(path, 'rb+') as f:
+            os.fsync(f.fileno())
+    except OSError:
+        pass
+
+
+class FsyncBatch:
+    """ Collects finished files and fsyncs them together once enough have piled up, or things go quiet. """
+    def __init__(self, max_files=FSYNC_BATCH_FILES, max_bytes=FSYNC_BATCH_BYTES, idle=FSYNC_BATCH_IDLE):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.idle = idle
+        self.paths = []
+        self.bytes = 0
+        self.last_added = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, path, nbytes):
+        with self.lock:
+            self.paths.append(path)
+            self.bytes += nbytes
+            self.last_added = time.monotonic()
+            if len(self.paths) < self.max_files and self.bytes < self.max_bytes:
+                if self.timer is None:
+                    self._arm(self.idle)
+                return
+            paths, self.paths, self.bytes = self.paths, [], 0
+        for p in paths:
+            fsync_path(p)
+
+    def _arm(self, delay):
+        # Called with the lock held
+        self.timer = threading.Timer(delay, self._idle_flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _idle_flush(self):
+        with self.lock:
+            self.timer = None
+            if not self.paths:
+                return
+            wait = self.last_added + self.idle - time.monotonic()
+            if wait > 0:
+                # More files joined since the timer was set, give them the full quiet period
+                self._arm(wait)
+                return
+            paths, self.paths, self.bytes = self.paths, [], 0
+        for p in paths:
+            fsync_path(p)
+
+    def flush(self):
+        with self.lock:
+            paths, self.paths, self.bytes = self.paths, [], 0
+        for p in paths:
+            fsync_path(p)
+
+
+FSYNC_BATCH = FsyncBatch()
+
+
+def unshare_file(file_path, keep_data):
+    """ Give a file we are about to write its own inode if other names share it (a deduplicated hardlink).
+
+        Writing in place would change every linked copy. keep_data copies the current contents
+        across first, for appending, otherwise the name is just unlinked so a new file replaces it.
+    """
+    try:
+        if os.stat(file_path).st_nlink < 2:
+            return
+    except OSError:
+        return
+    if not keep_data:
+        os.unlink(file_path)
+        return
+    directory, name = os.path.split(file_path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{name}.', dir=directory)
+    os.close(fd)
+    try:
+        shutil.copy2(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class WriteBehindFile:
+    """ Writes received buffers to disk on a dedicated thread so a slow disk never stalls the socket.
+
+        Memory use is capped by queue_depth: write() blocks once that many buffers are waiting.
+    """
+    def __init__(self, file_path, append, expected_size, queue_depth=WRITE_QUEUE_DEPTH, fsync_mode='none',
+                 exclusive=False, cache_limit=None, direct=False):
+        self.file_path = file_path
+        self.fsync_mode = fsync_mode
+        # Resumes open without O_APPEND, which would send writes past the preallocated region.
+        # New files can be created exclusively, raising FileExistsError rather than clobbering one
+        if not exclusive:
+            unshare_file(file_path, append)
+        self.file = open(file_path, 'r+b' if append else ('xb' if exclusive else 'wb'))
+        self.start_offset = self.file.seek(0, os.SEEK_END)
+        self.bytes_written = 0
+        self.error = None
+        self.closed = False
+        self.queue = queue.Queue(maxsize=max(1, queue_depth))
+
+        # Reserve the announced size up front to avoid fragmentation, it is trimmed back on close
+        self.preallocated = preallocate(self.file.fileno(), self.start_offset, expected_size - self.start_offset)
+
+        # Keep what we write from piling up in the page cache: written ranges are flushed and dropped
+        # as they go, see _drop_behind. O_DIRECT skips the cache altogether where the filesystem allows
+        self.cache_limit = cache_limit
+        self.cache_start = self.start_offset    # written since the last flush starts here
+        self.cache_flushing = None              # (offset, length) being written back
+        self.direct = direct and self.start_offset % DIRECT_ALIGN == 0 and set_direct(self.file.fileno(), True)
+        if self.direct:
+            self.stage = mmap.mmap(-1, DIRECT_WRITE_SIZE)
+            self.staged = 0
+
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def _writer(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                if self.direct and not self.error:
+                    try:
+                        self._write_staged(final=True)
+                    except Exception as e:
+                        self.error = e
+                return
+            if self.error:
+                continue    # keep draining so the receiving side never blocks
+            try:
+                if type(chunk) is tuple:
+                    op, arg = chunk
+                    if op == 'seek':
+                        if self.cache_limit:
+                            self._drop_behind()
+                        self.file.seek(arg)
+                        self.cache_start = arg
+                    else:
+                        self.file.truncate(arg)
+                    continue
+                if self.direct:
+                    self._stage(chunk)
+                    continue
+                self.file.write(chunk)
+                self.bytes_written += len(chunk)
+                if self.cache_limit and self.start_offset + self.bytes_written - self.cache_start >= self.cache_limit // 2:
+                    self._drop_behind()
+            except Exception as e:
+                self.error = e
+
+    def _stage(self, chunk):
+        """ Copy into the aligned buffer, writing it out each time it fills. """
+        view = memoryview(chunk)
+        while view:
+            n = min(len(view), DIRECT_WRITE_SIZE - self.staged)
+            self.stage[self.staged:self.staged + n] = view[:n]
+            self.staged += n
+            view = view[n:]
+            if self.staged == DIRECT_WRITE_SIZE:
+                self._write_staged()
+
+    def _write_staged(self, final=False):
+        """ Write the staged buffer with O_DIRECT. The unaligned tail of the file goes through the cache. """
+        fd = self.file.fileno()
+        if final:
+            set_direct(fd, False)
+            self.cache_start = self.start_offset + self.bytes_written
+        view = memoryview(self.stage)[:self.staged]
+        while view:
+            n = os.write(fd, view)
+            self.bytes_written += n
+            view = view[n:]
+        self.staged = 0
+
+    def _drop_behind(self, final=False):
+        """ Start writing back what was written since the last call, and once the range before
+            that is on disk drop it from the page cache. At most about cache_limit stays dirty.
+        """
+        self.file.flush()
+        fd = self.file.fileno()
+        end = self.file.tell()
+        if self.cache_flushing:
+            offset, length = self.cache_flushing
+            flush_range(fd, offset, length, wait=True)
+            advise(fd, offset, length, 'POSIX_FADV_DONTNEED')
+            self.cache_flushing = None
+        if end > self.cache_start:
+            flush_range(fd, self.cache_start, end - self.cache_start, wait=final)
+            if final:
+                advise(fd, self.cache_start, end - self.cache_start, 'POSIX_FADV_DONTNEED')
+            else:
+                self.cache_flushing = (self.cache_start, end - self.cache_start)
+        self.cache_start = end
+
+    def write(self, chunk):
+        if self.error:
+            raise self.error
+        self.queue.put(chunk)
+
+    def seek(self, offset):
+        """ Move the write position once the buffers already queued are written. """
+        self.queue.put(('seek', offset))
+
+    def truncate(self, size):
+        self.queue.put(('truncate', size))
+
+    def close(self):
+        """ Wait for queued buffers to hit the disk, then trim, sync and close the file. """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            self.file.flush()
+            if self.preallocated:
+                # Drop unused preallocated space so a partial file reports its real size for resuming
+                self.file.truncate(self.start_offset + self.bytes_written)
+            if self.cache_limit:
+                self._drop_behind(final=True)
+            if self.fsync_mode == 'file':
+                os.fsync(self.file.fileno())
+        finally:
+            self.file.close()
+            if self.direct:
+                self.stage.close()
+        if self.fsync_mode == 'batch':
+            FSYNC_BATCH.add(self.file_path, self.bytes_written)
+        if self.error:
+            raise self.error
+
+    def abort(self):
+        """ Close after a failed transfer, keeping whatever made it to disk for a later resume. """
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+CLONE_MODES = ['hardlink', 'reflink', 'copy']
+FICLONE = 0x40049409    # linux/fs.h
+
+
+def ficlone(src_fd, dst_fd):
+    """ Make the open file dst_fd share all of src_fd's extents, raises OSError where unsupported. """
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "reflink is only supported on Linux")
+    import fcntl
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def reflink(src, dst):
+    """ Clone src to dst sharing the same extents (btrfs, XFS, ...), raises OSError where unsupported. """
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            ficlone(s.fileno(), d.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+
+def clone_file(src, dst, mode='reflink'):
+    """ Make dst a copy of src as cheaply as mode allows, falling back towards a plain copy.
+
+        Returns the method that was actually used.
+    """
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    if mode in ('hardlink', 'reflink'):
+        try:
+            reflink(src, dst)
+            return 'reflink'
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+LOCAL_COPY_CHUNK = 16 << 20     # bytes per copy_file_range call, the receiver checks for cancellation between them
+# copy_file_range errors that mean "not between these files", rather than a failed copy
+NO_KERNEL_COPY = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.EBADF}
+
+
+def file_identity(st):
+    """ What a sender and receiver compare to be sure they see the very same file: device, inode, size, mtime. """
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def readable_by(path, uid):
+    """ Whether user uid could open path for reading itself, going by permission bits (ACLs count as no).
+
+        Receivers ask this before copying a local sender's file, so a sender can't have them read
+        files it couldn't. Every directory on the way must be searchable too. Unix only.
+    """
+    import grp
+    import pwd
+    if uid == 0:
+        return True
+    try:
+        user = pwd.getpwuid(uid)
+        gids = {user.pw_gid} | {g.gr_gid for g in grp.getgrall() if user.pw_name in g.gr_mem}
+    except KeyError:
+        gids = set()
+
+    def permitted(st, shift):
+        # shift picks the read (2) or search (0) bit out of each of the owner, group and other triples
+        if st.st_uid == uid:
+            return bool(st.st_mode >> (6 + shift) & 1)
+        if st.st_gid in gids:
+            return bool(st.st_mode >> (3 + shift) & 1)
+        return bool(st.st_mode >> shift & 1)
+
+    path = os.path.realpath(path)
+    try:
+        directory = os.path.dirname(path)
+        while True:
+            if not permitted(os.stat(directory), 0):
+                return False
+            if directory == os.path.dirname(directory):
+                break
+            directory = os.path.dirname(directory)
+        return permitted(os.stat(path), 2)
+    except OSError:
+        return False
+
+
+class LocalCopy:
+    """ Stands in for WriteBehindFile when the receiver can read the sender's file itself.
+
+        The data never crosses the socket: a whole new copy is a reflink where the filesystem
+        shares extents, anything else goes through os.copy_file_range so it stays in the kernel,
+        with a plain read and write loop where that isn't possible (another filesystem, old kernel).
+        identity is the sender's file_identity of src, the copy is refused if the file opened differs.
+    """
+    def __init__(self, src, file_path, append, identity, fsync_mode='none', exclusive=False, cache_limit=None):
+        self.file_path = file_path
+        self.fsync_mode = fsync_mode
+        self.cache_limit = cache_limit
+        self.src = open(src, 'rb')
+        try:
+            if file_identity(os.fstat(self.src.fileno())) != tuple(identity):
+                raise OSError(errno.ESTALE, f"{src} changed since the sender offered it")
+            if not exclusive:
+                unshare_file(file_path, append)
+            self.file = open(file_path, 'r+b' if append else ('xb' if exclusive else 'wb'))
+        except Exception:
+            self.src.close()
+            raise
+        self.start_offset = self.file.seek(0, os.SEEK_END)
+        self.bytes_written = 0
+        self.preallocated = False
+        self.method = None
+        self.closed = False
+
+    def copy(self, size, sparse=False, progress=None):
+        """ Copy src from where the file ends up to size, only its data extents if sparse.
+
+            progress(n) is called as pieces land and may return False to stop the copy,
+            copy then returns False as well.
+        """
+        src_fd, dst_fd = self.src.fileno(), self.file.fileno()
+        if self.start_offset == 0:
+            try:
+                ficlone(src_fd, dst_fd)
+                self.method = 'reflink'
+                self.bytes_written = size
+                return progress(size) is not False if progress else True
+            except OSError:
+                pass
+        extents = map_data_extents(self.src.name, self.start_offset) if sparse else \
+            [(self.start_offset, size - self.start_offset)]
+        piece = LOCAL_COPY_CHUNK
+        if self.cache_limit:
+            piece = min(piece, max(DIRECT_ALIGN, self.cache_limit // 2))
+        self.method = 'copy_file_range' if hasattr(os, 'copy_file_range') else 'copy'
+        for offset, length in extents:
+            end = offset + length
+            while offset < end:
+                n = self._copy_piece(src_fd, dst_fd, offset, min(piece, end - offset))
+                if not n:
+                    raise IOError("Source file shrank while it was being copied")
+                if self.cache_limit:
+                    # Same treatment as WriteBehindFile: on disk, then out of the cache, on both ends
+                    flush_range(dst_fd, offset, n, True)
+                    advise(dst_fd, offset, n, 'POSIX_FADV_DONTNEED')
+                    advise(src_fd, offset, n, 'POSIX_FADV_DONTNEED')
+                offset += n
+                self.bytes_written += n
+                if progress and progress(n) is False:
+                    return False
+        return True
+
+    def _copy_piece(self, src_fd, dst_fd, offset, length):
+        if self.method == 'copy_file_range':
+            try:
+                return os.copy_file_range(src_fd, dst_fd, length, offset, offset)
+            except OSError as e:
+                if e.errno not in NO_KERNEL_COPY:
+                    raise
+                self.method = 'copy'
+        data = os.pread(src_fd, length, offset) if hasattr(os, 'pread') else self._read_at(offset, length)
+        self.file.seek(offset)
+        self.file.write(data)
+        self.file.flush()
+        return len(data)
+
+    def _read_at(self, offset, length):
+        self.src.seek(offset)
+        return self.src.read(length)
+
+    def truncate(self, size):
+        self.file.truncate(size)
+
+    def close(self):
+        """ Sync the copy as the fsync mode asks and close both files. """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.file.flush()
+            if self.fsync_mode == 'file':
+                os.fsync(self.file.fileno())
+        finally:
+            self.file.close()
+            self.src.close()
+        if self.fsync_mode == 'batch':
+            FSYNC_BATCH.add(self.file_path, self.bytes_written)
+
+    def abort(self):
+        """ Close after a failed copy, keeping whatever was copied for a later resume. """
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+READ_AHEAD_DEPTH = 4            # buffers the reader may fill before the socket drains them
+
+
+def is_sparse(file_path):
+    """ True if the file has holes we can find with SEEK_DATA/SEEK_HOLE. """
+    if not hasattr(os, 'SEEK_DATA'):
+        return False
+    st = os.stat(file_path)
+    return hasattr(st, 'st_blocks') and st.st_blocks * 512 < st.st_size
+
+
+def map_data_extents(file_path, start=0):
+    """ List the (offset, length) data extents of a file from start onwards, skipping holes. """
+    extents = []
+    with open(file_path, 'rb') as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        pos = start
+        while pos < size:
+            try:
+                data = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break   # nothing but a hole up to the end of the file
+                raise
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), size)
+            if hole > data:
+                extents.append((data, hole - data))
+            pos = hole
+    return extents
+
+
+def advise(fd, offset, length, advice_name):
+    """ Pass a posix_fadvise hint for the range, ignoring platforms and filesystems without it. """
+    advice = getattr(os, advice_name, None)
+    if advice is None or not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+_sync_file_range = False    # not looked up yet
+
+
+def flush_range(fd, offset, length, wait):
+    """ Start writing a range of a file back to disk, with wait until it is there.
+
+        Uses Linux's sync_file_range, which the os module doesn't expose. Elsewhere only a
+        waiting flush does anything, and it syncs the whole file.
+    """
+    global _sync_file_range
+    if _sync_file_range is False:
+        _sync_file_range = None
+        if sys.platform.startswith('linux'):
+            try:
+                import ctypes
+                libc = ctypes.CDLL(None, use_errno=True)
+                _sync_file_range = libc.sync_file_range
+                _sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+            except (OSError, AttributeError):
+                pass
+    if _sync_file_range is not None:
+        flags = SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER if wait \
+            else SYNC_FILE_RANGE_WRITE
+        _sync_file_range(fd, offset, length, flags)
+    elif wait:
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+
+
+def set_direct(fd, on):
+    """ Turn O_DIRECT on or off for an open file, returns False where the platform or filesystem can't. """
+    if not hasattr(os, 'O_DIRECT'):
+        return False
+    import fcntl
+    try:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, (flags | os.O_DIRECT) if on else (flags & ~os.O_DIRECT))
+        return True
+    except OSError:
+        return False
+
+
+class ReadAheadFile:
+    """ Reads a file on a background thread into a small ring of reusable buffers.
+
+        Iterating yields memoryviews of filled buffers. A view is only valid until the next
+        one is requested, after which its buffer goes back to the reader to be refilled.
+        A depth of 0 reads inline with no thread. When extents are given only those
+        (offset, length) ranges are read, one after the other, and offset is ignored.
+        With cache_limit, pages already handed out are dropped from the page cache every
+        cache_limit / 2 bytes. direct reads with O_DIRECT into aligned buffers when the
+        filesystem, block size and offset allow it, and plainly otherwise. resize changes
+        the block size mid-file, buffers take the new size as they come back to be refilled.
+    """
+    def __init__(self, file_path, offset=0, block_size=64 * 1024, depth=READ_AHEAD_DEPTH, extents=None,
+                 cache_limit=None, direct=False):
+        self.file = open(file_path, 'rb', buffering=0)
+        self.direct = (direct and extents is None and offset % DIRECT_ALIGN == 0 and block_size % DIRECT_ALIGN == 0
+                       and set_direct(self.file.fileno(), True))
+        self.cache_limit = cache_limit
+        self.drop_range = None  # (start, end) handed out but still cached
+        self.eof = False
+        if extents is None:
+            self.file.seek(offset)
+            self.extents = iter(())
+            self.remaining = None   # read to the end of the file
+        else:
+            self.extents = iter(extents)
+            self.remaining = 0
+        self.block_size = block_size
+        self.depth = depth
+        self.error = None
+        self.stopped = False
+
+        fd = self.file.fileno()
+        advise(fd, offset, 0, 'POSIX_FADV_SEQUENTIAL')
+
+        if depth > 0:
+            self.free = queue.Queue()
+            self.filled = queue.Queue()
+            for _ in range(depth):
+                self.free.put(self._new_buffer())
+            self.thread = threading.Thread(target=self._reader, daemon=True)
+            self.thread.start()
+
+    def _new_buffer(self):
+        # Anonymous mmaps are page aligned, as O_DIRECT needs
+        return mmap.mmap(-1, self.block_size) if self.direct else bytearray(self.block_size)
+
+    def resize(self, block_size):
+        if not self.direct or block_size % DIRECT_ALIGN == 0:
+            self.block_size = block_size
+
+    def _handed_out(self, offset, n):
+        """ Note that a buffer went to the caller, dropping what has piled up behind it. """
+        if not self.cache_limit:
+            return
+        start, end = self.drop_range or (offset, offset)
+        if offset != end:
+            # A jump to the next extent
+            self._drop_cached()
+            start = offset
+        self.drop_range = (start, offset + n)
+        if offset + n - start >= self.cache_limit // 2:
+            self._drop_cached()
+
+    def _drop_cached(self):
+        if self.drop_range:
+            start, end = self.drop_range
+            advise(self.file.fileno(), start, end - start, 'POSIX_FADV_DONTNEED')
+            self.drop_range = None
+
+    def _reader(self):
+        fd = self.file.fileno()
+        try:
+            while True:
+                buf = self.free.get()
+                if buf is None or self.stopped:
+                    return
+                if len(buf) != self.block_size:
+                    buf = self._new_buffer()
+                # Ask the OS to start fetching the window we are about to need
+                advise(fd, self.file.tell(), self.block_size * self.depth, 'POSIX_FADV_WILLNEED')
+                offset, n = self._readinto(buf)
+                if not n:
+                    self.filled.put(None)
+                    return
+                self.filled.put((buf, offset, n))
+        except Exception as e:
+            self.error = e
+            self.filled.put(None)
+
+    def _readinto(self, buf):
+        """ Fill buf from the current range, returns (file offset, bytes read). """
+        while True:
+            if self.remaining is None:
+                offset = self.file.tell()
+                if self.eof:
+                    return offset, 0
+                n = self.file.readinto(buf)
+                # A short read is the end of the file, reading on from its unaligned end would fail
+                self.eof = self.direct and n < len(buf)
+                return offset, n
+            if self.remaining > 0:
+                offset = self.file.tell()
+                n = self.file.readinto(memoryview(buf)[:min(len(buf), self.remaining)])
+                self.remaining = (self.remaining - n) if n else 0
+                return offset, n
+            extent = next(self.extents, None)
+            if extent is None:
+                return 0, 0
+            self.file.seek(extent[0])
+            self.remaining = extent[1]
+
+    def __iter__(self):
+        for _, chunk in self.iter_with_offsets():
+            yield chunk
+
+    def iter_with_offsets(self):
+        """ Like iterating the file, but yields (file offset, memoryview) pairs. """
+        if self.depth <= 0:
+            buf = self._new_buffer()
+            while True:
+                if len(buf) != self.block_size:
+                    buf = self._new_buffer()
+                offset, n = self._readinto(buf)
+                if not n:
+                    return
+                yield offset, memoryview(buf)[:n]
+                self._handed_out(offset, n)
+        while True:
+            item = self.filled.get()
+            if item is None:
+                if self.error:
+                    raise self.error
+                return
+            buf, offset, n = item
+            yield offset, memoryview(buf)[:n]
+            self.free.put(buf)
+            self._handed_out(offset, n)
+
+    def close(self):
+        if self.depth > 0 and not self.stopped:
+            self.stopped = True
+            self.free.put(None)
+            self.thread.join()
+        self._drop_cached()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
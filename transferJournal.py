@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import threading
+import time
+
+JOURNAL_COMMIT_RECORDS = 500    # commit after this many updates...
+JOURNAL_COMMIT_SECONDS = 2      # ...or this long after the first uncommitted one
+JOURNAL_STATES = ['done', 'partial', 'failed']
+
+
+class TransferJournal:
+    """ Remembers what each destination already has from us, across runs and crashes.
+
+        Items are keyed by destination ("host:port") and the absolute source path, and only
+        trusted while the source still has the size and mtime they were recorded with. Updates
+        are committed in batches to a WAL-mode SQLite database, so a crash loses at most the
+        last few seconds, and those files are simply negotiated with the receiver again.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS items ('
+                        'dest TEXT, source TEXT, size INTEGER, mtime_ns INTEGER, state TEXT, '
+                        'offset INTEGER, crc INTEGER, updated REAL, PRIMARY KEY (dest, source))')
+        self.lock = threading.Lock()
+        self.cache = {}         # dest -> {source: (size, mtime_ns, state, offset, crc)}
+        self.uncommitted = 0
+        self.first_uncommitted = 0
+
+    def _items(self, dest):
+        if dest not in self.cache:
+            rows = self.db.execute('SELECT source, size, mtime_ns, state, offset, crc FROM items WHERE dest = ?', (dest,))
+            self.cache[dest] = {row[0]: row[1:] for row in rows}
+        return self.cache[dest]
+
+    def lookup(self, dest, source):
+        """ The (state, offset, crc) recorded for source, or None if unknown or the file changed since. """
+        source = os.path.abspath(source)
+        try:
+            st = os.stat(source)
+        except OSError:
+            return None
+        with self.lock:
+            item = self._items(dest).get(source)
+        if item is None or item[:2] != (st.st_size, st.st_mtime_ns):
+            return None
+        return item[2:]
+
+    def is_done(self, dest, source):
+        item = self.lookup(dest, source)
+        return item is not None and item[0] == 'done'
+
+    def record(self, dest, source, state, offset=0, crc=None):
+        source = os.path.abspath(source)
+        try:
+            st = os.stat(source)
+        except OSError:
+            return
+        item = (st.st_size, st.st_mtime_ns, state, offset, crc)
+        with self.lock:
+            self._items(dest)[source] = item
+            self.db.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (dest, source) + item + (time.time(),))
+            if not self.uncommitted:
+                self.first_uncommitted = time.monotonic()
+            self.uncommitted += 1
+            if self.uncommitted >= JOURNAL_COMMIT_RECORDS or \
+                    time.monotonic() - self.first_uncommitted >= JOURNAL_COMMIT_SECONDS:
+                self._commit()
+
+    def _commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def flush(self):
+        with self.lock:
+            self._commit()
+
+    def summary(self, dest=None):
+        """ Number of items in each state, for one destination or all of them. """
+        with self.lock:
+            query = 'SELECT state, COUNT(*) FROM items' + (' WHERE dest = ?' if dest else '') + ' GROUP BY state'
+            return dict(self.db.execute(query, (dest,) if dest else ()))
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.db.close()
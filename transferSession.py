@@ -0,0 +1,63 @@
+import contextlib
+import threading
+
+SESSION = threading.local()     # the sessions the current thread works for, by kind
+
+
+class SessionData:
+    """ Settings and counters of whichever session the calling thread works for.
+
+        SENT_DATA and RECV_DATA are SessionData. Threads bound to a TransferClient or
+        TransferServer see that instance's own dict, any other thread (a script calling the
+        module functions directly) sees the default one, so many sessions can run in one process.
+    """
+    def __init__(self, kind, defaults):
+        self.kind = kind
+        self.defaults = dict(defaults)
+        self.default = dict(defaults)
+
+    def new(self, **settings):
+        """ A fresh dict for a session of this kind, the defaults with settings applied. """
+        data = dict(self.defaults)
+        unknown = set(settings) - set(data)
+        if unknown:
+            raise KeyError(f"Unknown {self.kind} settings: {', '.join(sorted(unknown))}")
+        data.update(settings)
+        return data
+
+    def current(self):
+        return getattr(SESSION, self.kind, None) or self.default
+
+    def __getitem__(self, key):
+        return self.current()[key]
+
+    def __setitem__(self, key, value):
+        self.current()[key] = value
+
+    def __contains__(self, key):
+        return key in self.current()
+
+    def get(self, key, default=None):
+        return self.current().get(key, default)
+
+
+@contextlib.contextmanager
+def bound_session(**sessions):
+    """ Work for the given sessions (kind=dict) on this thread until the block ends. """
+    saved = dict(vars(SESSION))
+    vars(SESSION).update(sessions)
+    try:
+        yield
+    finally:
+        vars(SESSION).clear()
+        vars(SESSION).update(saved)
+
+
+def session_thread(target, args=(), **kwargs):
+    """ A Thread that works for the same sessions as the thread creating it. """
+    sessions = dict(vars(SESSION))
+
+    def run(*run_args):
+        with bound_session(**sessions):
+            target(*run_args)
+    return threading.Thread(target=run, args=args, **kwargs)
@@ -0,0 +1,304 @@
+import struct
+
+from dedupIndex import DIGEST_SIZE
+
+PROTOCOL_VERSION = 2            # newest version we speak
+PROTOCOL_CHOICES = ['auto', '1', '2']
+HELLO_MAGIC = b'\xff\xfe'       # can never start a v1 path length, and is too short for a v1 receiver's first read
+HANDSHAKE_TIMEOUT = 5
+
+# Control messages, v1 sends them as length-prefixed ASCII strings
+ALL_GOOD_MSG = "0xB00B1E5"
+REJECTED_MSG = "0xD6EC7ED"
+REQ_CRC32_MSG = "AC710271BE"
+RESUME_MSG = "0x7E50BE"
+SAME_COPY_MSG = "0x5ABEC097"
+DIFF_FILE_MSG = "0xD1FFF1113"
+REQ_OVERWRITE_MSG = "0x0B37717E"
+KEEP_BOTH_MSG = "0x4EE9B074"
+SKIP_FILE_MSG = "0x5419F111E"
+DEDUP_MSG = "0xDED0BED"
+NO_ROOM_MSG = "0xF011D15C"
+# Messages followed by a size: the receiver's file size, or for NO_ROOM_MSG the bytes it could still take
+SIZED_MSGS = (REQ_CRC32_MSG, DIFF_FILE_MSG, NO_ROOM_MSG)
+
+# File header flags
+FLAG_SPARSE = 0x01      # data phase is an extent map followed by the data extents only
+FLAG_DIGEST = 0x02      # header carries a sha256 of the content for deduplication
+FLAG_KEEP_OPEN = 0x04   # data phase is exactly the bytes still needed, and another file may follow (v2 only)
+FLAG_ARCHIVE = 0x08     # data phase is a tar stream of a whole directory, extracted as it arrives
+FLAG_QUICK_CHECK = 0x10 # a file with the same size and mtime may be taken as identical without a checksum
+FLAG_LOCAL = 0x20       # the receiver may ask where the file is and copy it itself, if it can see it (v2 only)
+V2_DATA_FLAGS = FLAG_SPARSE | FLAG_KEEP_OPEN | FLAG_ARCHIVE   # change the data phase, so can't be dropped for v1
+
+# v2 frame opcodes
+OP_HEADER = 0x01
+OP_EXTENTS = 0x02
+OP_CRC32 = 0x03
+OP_MANIFEST = 0x04      # sender: '\0' separated paths, receiver: a MANIFEST_ENTRY per path
+OP_PLAN = 0x05          # sender: a PLAN_ENTRY and path per file, receiver: bytes it could take and why not, if so
+OP_LOCAL = 0x06         # receiver: empty to ask for the source, then 1 or 0 for whether it will copy it itself,
+                        # sender: a LOCAL_SOURCE and the absolute path of its file
+OP_ARCHIVE_SKIPPED = 0x07   # receiver: '\0' separated names of archive members it did not write, before its last reply
+MSG_OPCODES = {
+    ALL_GOOD_MSG: 0x10,
+    REJECTED_MSG: 0x11,
+    REQ_CRC32_MSG: 0x12,
+    RESUME_MSG: 0x13,
+    SAME_COPY_MSG: 0x14,
+    DIFF_FILE_MSG: 0x15,
+    REQ_OVERWRITE_MSG: 0x16,
+    KEEP_BOTH_MSG: 0x17,
+    SKIP_FILE_MSG: 0x18,
+    DEDUP_MSG: 0x19,
+    NO_ROOM_MSG: 0x1A,
+    }
+OPCODE_MSGS = {opcode: msg for msg, opcode in MSG_OPCODES.items()}
+
+FRAME = struct.Struct('!BI')            # opcode, payload length
+V2_HEADER = struct.Struct('!QdBB')      # size, mtime, policy, flags, then the digest if flagged and the path
+MANIFEST_ENTRY = struct.Struct('!qd')   # size or -1 if missing, sender mtime it arrived with or 0
+PLAN_ENTRY = struct.Struct('!QH')       # file size, path length
+PLAN_REPLY = struct.Struct('!Q')        # bytes the receiver could still take, followed by the reason if refused
+ARCHIVE_CHUNK = struct.Struct('!I')     # length of each piece of an archive stream, 0 ends it
+LOCAL_SOURCE = struct.Struct('!QQQq')   # device, inode, size and mtime in ns of the sender's file
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def recv_exact(sock, length):
+    """ Receive exactly length bytes, recv() may return less than asked for. """
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed mid-message")
+        data += chunk
+    return bytes(data)
+
+
+class Channel:
+    """ Protocol v1: native-endian fields and length-prefixed ASCII control messages.
+
+        The header is the path and size alone. Modification time, conflict policy, flags and
+        digest only travel in v2 frames, so a v1 receiver settles conflicts with its own
+        policy and the sender must not use sparse, kept-open or archive data phases.
+    """
+    version = 1
+
+    def __init__(self, sock, pending=b''):
+        self.sock = sock
+        self.pending = pending      # bytes already read while working out the version
+        self.value = None           # file size carried by the last sized message
+
+    def recv_exact(self, length):
+        data, self.pending = self.pending[:length], self.pending[length:]
+        if len(data) < length:
+            data += recv_exact(self.sock, length - len(data))
+        return data
+
+    def send_header(self, path, size, mtime, policy, flags, digest=None):
+        if flags & V2_DATA_FLAGS:
+            raise ProtocolError("Sparse, kept-open and archive transfers need protocol v2")
+        path = path.encode('utf-8')
+        self.sock.sendall(struct.pack('I', len(path)) + path + struct.pack('Q', size))
+
+    def recv_header(self):
+        """ Returns (path, size, mtime, policy index, flags, digest), v1 senders only say the first two. """
+        path = self.recv_exact(struct.unpack('I', self.recv_exact(4))[0]).decode('utf-8')
+        size = struct.unpack('Q', self.recv_exact(8))[0]
+        return path, size, None, 0, 0, None
+
+    def send_msg(self, msg, value=None):
+        data = struct.pack('I', len(msg)) + msg.encode()
+        if value is not None:
+            data += struct.pack('Q', value)
+        self.sock.sendall(data)
+
+    def recv_msg(self):
+        msg = self.recv_exact(struct.unpack('I', self.recv_exact(4))[0]).decode('utf-8')
+        self.value = struct.unpack('Q', self.recv_exact(8))[0] if msg in SIZED_MSGS else None
+        return msg
+
+    def send_crc(self, crc32):
+        self.sock.sendall(struct.pack('I', crc32))
+
+    def recv_crc(self):
+        return struct.unpack('I', self.recv_exact(4))[0]
+
+    def send_extent_map(self, extents):
+        self.sock.sendall(struct.pack('Q', len(extents)) + b''.join(struct.pack('QQ', *e) for e in extents))
+
+    def recv_extent_map(self):
+        count = struct.unpack('Q', self.recv_exact(8))[0]
+        return [struct.unpack('QQ', self.recv_exact(16)) for _ in range(count)]
+
+    def close(self):
+        self.sock.close()
+
+
+class FramedChannel(Channel):
+    """ Protocol v2: every message is one frame of an opcode byte, a payload length and the
+        payload, all in network byte order and written with a single sendall.
+    """
+    version = 2
+
+    def send_frame(self, opcode, payload=b''):
+        self.sock.sendall(FRAME.pack(opcode, len(payload)) + payload)
+
+    def recv_frame(self, expect=None):
+        opcode, length = FRAME.unpack(self.recv_exact(FRAME.size))
+        payload = self.recv_exact(length)
+        if expect is not None and opcode != expect:
+            raise ProtocolError(f"Expected frame {expect:#04x}, got {opcode:#04x}")
+        return opcode, payload
+
+    def send_header(self, path, size, mtime, policy, flags, digest=None):
+        self.send_frame(OP_HEADER, V2_HEADER.pack(size, mtime, policy, flags) + (digest or b'') + path.encode('utf-8'))
+
+    def recv_header(self):
+        _, payload = self.recv_frame(OP_HEADER)
+        size, mtime, policy, flags = V2_HEADER.unpack_from(payload)
+        rest = payload[V2_HEADER.size:]
+        digest = None
+        if flags & FLAG_DIGEST:
+            digest, rest = rest[:DIGEST_SIZE], rest[DIGEST_SIZE:]
+        return rest.decode('utf-8'), size, mtime, policy, flags, digest
+
+    def send_msg(self, msg, value=None):
+        self.send_frame(MSG_OPCODES[msg], b'' if value is None else struct.pack('!Q', value))
+
+    def recv_msg(self):
+        opcode, payload = self.recv_frame()
+        if opcode not in OPCODE_MSGS:
+            raise ProtocolError(f"Unexpected frame {opcode:#04x}")
+        self.value = struct.unpack('!Q', payload)[0] if payload else None
+        return OPCODE_MSGS[opcode]
+
+    def send_crc(self, crc32):
+        self.send_frame(OP_CRC32, struct.pack('!I', crc32))
+
+    def recv_crc(self):
+        return struct.unpack('!I', self.recv_frame(OP_CRC32)[1])[0]
+
+    def send_extent_map(self, extents):
+        self.send_frame(OP_EXTENTS, b''.join(struct.pack('!QQ', *e) for e in extents))
+
+    def recv_extent_map(self):
+        payload = self.recv_frame(OP_EXTENTS)[1]
+        return [struct.unpack_from('!QQ', payload, i) for i in range(0, len(payload), 16)]
+
+    def peek_opcode(self):
+        """ Opcode of the next frame, which is left to be read as usual. """
+        if len(self.pending) < FRAME.size:
+            self.pending += recv_exact(self.sock, FRAME.size - len(self.pending))
+        return FRAME.unpack(self.pending[:FRAME.size])[0]
+
+    def send_manifest_request(self, paths):
+        self.send_frame(OP_MANIFEST, '\0'.join(paths).encode('utf-8'))
+
+    def recv_manifest_request(self):
+        payload = self.recv_frame(OP_MANIFEST)[1]
+        return payload.decode('utf-8').split('\0') if payload else []
+
+    def send_plan(self, entries):
+        payload = bytearray()
+        for path, size in entries:
+            path = path.encode('utf-8')
+            payload += PLAN_ENTRY.pack(size, len(path)) + path
+        self.send_frame(OP_PLAN, bytes(payload))
+
+    def recv_plan(self):
+        """ Returns [(path, size)]. """
+        payload = self.recv_frame(OP_PLAN)[1]
+        entries = []
+        pos = 0
+        while pos < len(payload):
+            size, length = PLAN_ENTRY.unpack_from(payload, pos)
+            pos += PLAN_ENTRY.size
+            entries.append((payload[pos:pos + length].decode('utf-8'), size))
+            pos += length
+        return entries
+
+    def send_plan_reply(self, available, reason=''):
+        self.send_frame(OP_PLAN, PLAN_REPLY.pack(available) + reason.encode('utf-8'))
+
+    def recv_plan_reply(self):
+        """ Returns (available, reason), an empty reason meaning the plan was accepted. """
+        payload = self.recv_frame(OP_PLAN)[1]
+        return PLAN_REPLY.unpack_from(payload)[0], payload[PLAN_REPLY.size:].decode('utf-8')
+
+    def send_local_request(self):
+        self.send_frame(OP_LOCAL)
+
+    def recv_local_request(self):
+        self.recv_frame(OP_LOCAL)
+
+    def send_local_source(self, path, identity):
+        self.send_frame(OP_LOCAL, LOCAL_SOURCE.pack(*identity) + path.encode('utf-8'))
+
+    def recv_local_source(self):
+        """ Returns (path, identity). """
+        payload = self.recv_frame(OP_LOCAL)[1]
+        return payload[LOCAL_SOURCE.size:].decode('utf-8'), LOCAL_SOURCE.unpack_from(payload)
+
+    def send_local_reply(self, accepted):
+        self.send_frame(OP_LOCAL, bytes([bool(accepted)]))
+
+    def recv_local_reply(self):
+        return self.recv_frame(OP_LOCAL)[1] == b'\x01'
+
+    def send_archive_skipped(self, names):
+        self.send_frame(OP_ARCHIVE_SKIPPED, '\0'.join(names).encode('utf-8'))
+
+    def recv_archive_skipped(self):
+        payload = self.recv_frame(OP_ARCHIVE_SKIPPED)[1]
+        return payload.decode('utf-8').split('\0') if payload else []
+
+    def send_manifest(self, entries):
+        self.send_frame(OP_MANIFEST, b''.join(MANIFEST_ENTRY.pack(*e) for e in entries))
+
+    def recv_manifest(self):
+        payload = self.recv_frame(OP_MANIFEST)[1]
+        return [MANIFEST_ENTRY.unpack_from(payload, i) for i in range(0, len(payload), MANIFEST_ENTRY.size)]
+
+
+def make_channel(sock, version, pending=b''):
+    return FramedChannel(sock) if version >= 2 else Channel(sock, pending)
+
+
+def client_handshake(sock, version=PROTOCOL_VERSION):
+    """ Open a channel on a fresh connection, greeting the receiver first for anything past v1.
+
+        Only greet receivers known to speak v2: a v1 receiver has no idea what the greeting is.
+    """
+    if version < 2:
+        return Channel(sock)
+    sock.sendall(HELLO_MAGIC + bytes([version]))
+    timeout = sock.gettimeout()
+    sock.settimeout(HANDSHAKE_TIMEOUT)
+    try:
+        reply = recv_exact(sock, len(HELLO_MAGIC) + 1)
+    except OSError as e:
+        raise ProtocolError(f"No protocol v{version} greeting from receiver: {e}")
+    finally:
+        sock.settimeout(timeout)
+    if reply[:len(HELLO_MAGIC)] != HELLO_MAGIC:
+        raise ProtocolError("Receiver answered the greeting with garbage")
+    return make_channel(sock, reply[-1])
+
+
+def server_handshake(sock):
+    """ Work out which protocol a sender speaks from its first bytes.
+
+        v2 senders greet us and we answer with the version both sides speak. v1 senders start
+        straight on the file header, whose path length never begins with the greeting magic.
+    """
+    first = recv_exact(sock, len(HELLO_MAGIC))
+    if first != HELLO_MAGIC:
+        return Channel(sock, first)
+    version = min(recv_exact(sock, 1)[0], PROTOCOL_VERSION)
+    sock.sendall(HELLO_MAGIC + bytes([version]))
+    return make_channel(sock, version)